@@ -0,0 +1,289 @@
+"""
+Headless bulk transcription and indexing
+
+Transcribes audio files and YouTube videos on a pool of worker processes, writes one JSONL transcript
+per source and builds the same indexes the web app builds, so recordings ingested here are answered
+without transcribing or embedding them again.
+
+Usage:
+    python ingest.py recordings/ https://youtu.be/VIDEO_ID --workers 4
+    python ingest.py --manifest sources.txt --language Hindi --backend openai --api-key sk-...
+
+Completed sources are recorded in a checkpoint file and skipped when the command is run again.
+"""
+from typing import Iterable, Iterator, List, Optional
+
+import argparse
+
+import hashlib
+
+import json
+
+import logging
+
+import multiprocessing
+
+import os
+
+import sys
+
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.constants import ASREngine, EmbeddingRuntime, Language, RetrievalMode
+
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.ogg', '.m4a', '.webm', '.flac', '.opus', '.mp4')
+
+
+def is_url(source: str) -> bool:
+    return source.startswith(('http://', 'https://'))
+
+
+def expand_sources(inputs: Iterable[str], manifest: Optional[str] = None) -> List[str]:
+    """
+    Lists the audio sources to ingest
+
+    Args:
+        inputs: Audio files, directories searched recursively for audio files, and urls
+        manifest: Path of a file with one source per line, blank lines and lines starting with # are ignored
+    Returns:
+        sources: Paths and urls in the order given, without duplicates
+    """
+    inputs = list(inputs)
+    if manifest:
+        with open(manifest, encoding='utf-8') as f:
+            inputs += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    sources = []
+    for source in inputs:
+        if is_url(source):
+            sources.append(source)
+        elif os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                sources += [os.path.join(root, name) for name in sorted(files)
+                            if name.lower().endswith(AUDIO_EXTENSIONS)]
+        elif os.path.isfile(source):
+            sources.append(source)
+        else:
+            logging.warning(f'Skipping {source}, it is neither a url nor an existing file or directory')
+    return list(dict.fromkeys(sources))
+
+
+def transcript_name(source: str) -> str:
+    """
+    File name of the transcript of a source, unique per source
+    """
+    stem = os.path.splitext(os.path.basename(source.rstrip('/')))[0] or 'audio'
+    stem = ''.join(c if c.isalnum() or c in '-_' else '_' for c in stem)[:60]
+    return f'{stem}-{hashlib.sha1(source.encode()).hexdigest()[:8]}.jsonl'
+
+
+def init_worker(ffmpeg: Optional[str], ffprobe: Optional[str], log_level: int) -> None:
+    """
+    Sets up a worker process
+    """
+    from pydub import AudioSegment
+    # Sets the web app's ffmpeg paths on import, so it is imported before they are overridden
+    import speech_tools.audio_processing  # noqa: F401
+
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+    if ffmpeg:
+        AudioSegment.converter = AudioSegment.ffmpeg = ffmpeg
+    if ffprobe:
+        AudioSegment.ffprobe = ffprobe
+
+
+def transcribe_source(source: str, output_path: str, language: Language, engine: ASREngine,
+                      api_key: Optional[str], youtube_dir: str, threads: int,
+                      engine_options: Optional[dict] = None) -> dict:
+    """
+    Transcribes one source to a JSONL file, one line per chunk. Runs in a worker process.
+
+    Args:
+        engine_options: Further arguments of the engine's parser, see make_parser
+
+    Returns:
+        summary: Source, transcript path, audio duration in milliseconds, chunk counts and wall time
+    """
+    from speech_tools.audio_processing import AudioLoader, CustomYoutubeAudioLoader, make_parser
+    from speech_tools.transcription_cache import get_transcription_cache
+
+    start = time.perf_counter()
+    loader = CustomYoutubeAudioLoader([source], save_dir=youtube_dir) if is_url(source) \
+        else AudioLoader(file_paths=[source])
+    parser = make_parser(engine, language, api_key, max_workers=threads, cache=get_transcription_cache(),
+                         **(engine_options or {}))
+
+    duration = chunks = failed = 0
+    # Written under a temporary name, so an interrupted run never leaves a truncated transcript behind
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+        for blob in loader.yield_blobs():
+            for doc in parser.lazy_parse(blob):
+                metadata = doc.metadata
+                duration = metadata['total_duration']
+                chunks += 1
+                failed += not doc.page_content
+                f.write(json.dumps({'source': source, 'chunk': metadata['chunk'],
+                                    'start_time': metadata['start_time'], 'end_time': metadata['end_time'],
+                                    'text': doc.page_content, 'error_message': metadata['error_message']},
+                                   ensure_ascii=False) + '\n')
+    os.replace(output_path + '.tmp', output_path)
+
+    return {'source': source, 'transcript': output_path, 'duration_ms': duration,
+            'chunks': chunks, 'failed_chunks': failed, 'seconds': time.perf_counter() - start}
+
+
+def read_transcript(path: str) -> Iterator:
+    """
+    Yields the non empty chunks of a JSONL transcript as documents, as the web app indexes them
+    """
+    from langchain.schema import Document
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            if row['text']:
+                yield Document(page_content=row['text'],
+                               metadata={'source': row['source'], 'chunk': row['chunk'],
+                                         'start_time': row['start_time'], 'end_time': row['end_time']})
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Returns the summaries of the sources completed by earlier runs, by source
+    """
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    summary = json.loads(line)
+                except ValueError:
+                    # Last line of a run that was killed while writing it
+                    continue
+                done[summary['source']] = summary
+    return done
+
+
+def format_hours(seconds: float) -> str:
+    return f'{seconds / 3600:.2f}h'
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='Audio files, directories and YouTube urls')
+    parser.add_argument('--manifest', help='File listing one source per line')
+    parser.add_argument('--output', default='ingested', help='Directory for transcripts and the checkpoint')
+    parser.add_argument('--language', default=Language.US_English.name, choices=[l.name for l in Language])
+    parser.add_argument('--engine', default=ASREngine.GOOGLE.value, choices=[e.value for e in ASREngine],
+                        help='Speech recognition engine, whisper-api needs --api-key. local-whisper runs '
+                             'offline, set LOCAL_WHISPER_MODEL to a model directory on machines without a network')
+    parser.add_argument('--backend', default='huggingface', choices=['huggingface', 'openai', 'none'],
+                        help='Embeddings to build the indexes with, matching the web app. none only transcribes.')
+    parser.add_argument('--retrieval-mode', default=os.environ.get('RETRIEVAL_MODE', RetrievalMode.VECTOR.value),
+                        choices=[m.value for m in RetrievalMode],
+                        help='Indexes to build, matching the RETRIEVAL_MODE of the web app')
+    parser.add_argument('--embedding-runtime',
+                        default=os.environ.get('EMBEDDING_RUNTIME', EmbeddingRuntime.TORCH.value),
+                        choices=[r.value for r in EmbeddingRuntime],
+                        help='Runtime of the huggingface embeddings, matching the EMBEDDING_RUNTIME of the web app')
+    parser.add_argument('--api-key', help='OpenAI API key')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='Chunks recognized at once per worker')
+    parser.add_argument('--local-model', help='Whisper model of local-whisper, a name or a model directory')
+    parser.add_argument('--speech-endpoint', help='URL of the Google recognition API, e.g. utils.fake_speech_server')
+    parser.add_argument('--youtube-dir', default='outputs/Youtube', help='Download cache shared with the web app')
+    parser.add_argument('--ffmpeg', help='Path to ffmpeg, defaults to the one the web app uses')
+    parser.add_argument('--ffprobe', help='Path to ffprobe, defaults to the one the web app uses')
+    parser.add_argument('--force', action='store_true', help='Ingest sources again even if checkpointed')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    engine = ASREngine(args.engine)
+    if engine == ASREngine.WHISPER_API and not args.api_key:
+        parser.error('--engine whisper-api needs --api-key')
+    if args.backend == 'openai' and not args.api_key:
+        parser.error('--backend openai needs --api-key')
+
+    sources = expand_sources(args.inputs, args.manifest)
+    if not sources:
+        parser.error('no audio sources given')
+
+    transcripts_dir = os.path.join(args.output, 'transcripts')
+    os.makedirs(transcripts_dir, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, 'checkpoint.jsonl')
+    done = {} if args.force else load_checkpoint(checkpoint_path)
+    pending = [source for source in sources if source not in done]
+    logging.info(f'{len(sources)} sources, {len(sources) - len(pending)} already ingested, {len(pending)} to go')
+
+    handler = None
+    if args.backend != 'none' and pending:
+        # Indexes are built here rather than in the workers, so the embedding model is loaded once
+        retrieval_mode = RetrievalMode(args.retrieval_mode)
+        if args.backend == 'openai':
+            from query_handler.openai_query_handler import OpenAIQueryHandler
+            handler = OpenAIQueryHandler(args.api_key, with_llm=False, retrieval_mode=retrieval_mode)
+        else:
+            from query_handler.huggingface_query_handler import HuggingFaceQueryHandler
+            handler = HuggingFaceQueryHandler(with_llm=False, retrieval_mode=retrieval_mode,
+                                              embedding_runtime=EmbeddingRuntime(args.embedding_runtime))
+
+    language = Language[args.language]
+    engine_options = {}
+    if engine == ASREngine.GOOGLE and args.speech_endpoint:
+        engine_options['endpoint'] = args.speech_endpoint
+    elif engine == ASREngine.LOCAL_WHISPER:
+        # Every worker runs its own model, the cores are shared between all chunks being transcribed
+        engine_options['cpu_threads'] = max(1, (os.cpu_count() or 1) // (args.workers * args.threads))
+        if args.local_model:
+            engine_options['model'] = args.local_model
+    start = time.perf_counter()
+    audio_ms = 0
+    failures = 0
+    # Workers are spawned rather than forked from this process, which may already hold the embedding model
+    # and the threads of torch, FAISS and the metrics exporter by now
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(args.ffmpeg, args.ffprobe, log_level),
+                             mp_context=multiprocessing.get_context('spawn')) as executor, \
+            open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        futures = {executor.submit(transcribe_source, source, os.path.join(transcripts_dir, transcript_name(source)),
+                                   language, engine, args.api_key, args.youtube_dir, args.threads,
+                                   engine_options): source
+                   for source in pending}
+
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                summary = future.result()
+                if handler is not None:
+                    docs = list(read_transcript(summary['transcript']))
+                    if docs:
+                        handler.begin_text('ingest')
+                        handler.add_documents(docs, 'ingest')
+                        handler.finish_text('ingest')
+                        summary['index_key'] = handler.sessions.get('ingest', handler.new_memory).index_key
+            except Exception:
+                failures += 1
+                logging.exception(f'Could not ingest {source}')
+                continue
+
+            audio_ms += summary['duration_ms']
+            checkpoint.write(json.dumps(summary, ensure_ascii=False) + '\n')
+            checkpoint.flush()
+            logging.info(f'Ingested {source}: {summary["chunks"]} chunks ({summary["failed_chunks"]} failed), '
+                         f'{format_hours(summary["duration_ms"] / 1000)} of audio in {summary["seconds"]:.0f}s')
+
+    wall = time.perf_counter() - start
+    print(f'Ingested {len(pending) - failures} of {len(pending)} sources ({failures} failed, '
+          f'{len(sources) - len(pending)} skipped) with {args.workers} workers')
+    print(f'{format_hours(audio_ms / 1000)} of audio in {format_hours(wall)} of wall time, '
+          f'{audio_ms / 1000 / wall if wall else 0:.1f} audio-hours per wall-hour')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
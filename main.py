@@ -1,53 +1,117 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional, List, Union
+from typing import TYPE_CHECKING, Callable, Optional, List, Union
 
 import logging
 
 import os
 
-import streamlit as st
-from audio_recorder_streamlit import audio_recorder
+import time
 
-from speech_tools.transcriber import Transcriber
-from query_handler.huggingface_query_handler import HuggingFaceQueryHandler
-from query_handler.openai_query_handler import OpenAIQueryHandler
+import uuid
 
+import streamlit as st
+from audio_recorder_streamlit import audio_recorder
 
-from utils.constants import Language, FileType
+from utils.constants import ASREngine, EmbeddingRuntime, JobState, Language, FileType, RetrievalMode
 from utils.error_handler import openai_error_handler
+from utils.metrics import log_transcript, start_exporters
 
+# Backends are imported on first use, so the first page render does not load torch or langchain
 if TYPE_CHECKING:
     from langchain.schema import Document
+    from speech_tools.transcriber import Transcriber
+    from query_handler.huggingface_query_handler import HuggingFaceQueryHandler
+    from query_handler.openai_query_handler import OpenAIQueryHandler
 
 
+# Appended to, so restarting the app keeps the log of the previous run. Set LOG_LEVEL=DEBUG for more detail,
+# and TRANSCRIPT_LOG_RATE to log a share of the transcribed text as well
 logging.basicConfig(
     filename='debug.log',
-    filemode="w",
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    filemode="a",
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
 )
 
+# Serves metrics on METRICS_PORT and writes them to METRICS_FILE, if set. Only starts once per process
+start_exporters()
+
 
 @st.cache_resource(show_spinner="Loading embeddings..May take several minutes...")
 def query_handler_object(api_key: str) -> Union[HuggingFaceQueryHandler, OpenAIQueryHandler]:
+    # RETRIEVAL_MODE=bm25 serves without an embedding model, hybrid with a small one on the free tier
+    retrieval_mode = RetrievalMode(os.environ.get('RETRIEVAL_MODE', RetrievalMode.VECTOR.value))
     if api_key == 'free':
-        return HuggingFaceQueryHandler()
+        from query_handler.huggingface_query_handler import HuggingFaceQueryHandler
+        # EMBEDDING_RUNTIME=onnx embeds with the int8 export of the model instead of torch
+        embedding_runtime = EmbeddingRuntime(os.environ.get('EMBEDDING_RUNTIME', EmbeddingRuntime.TORCH.value))
+        return HuggingFaceQueryHandler(retrieval_mode=retrieval_mode, embedding_runtime=embedding_runtime)
     else:
-        return OpenAIQueryHandler(api_key)
+        from query_handler.openai_query_handler import OpenAIQueryHandler
+        return OpenAIQueryHandler(api_key, retrieval_mode=retrieval_mode)
 
 
-@st.cache_resource(show_spinner=False)
 def transcriber_object(api_key: str) -> Transcriber:
-    return Transcriber(api_key)
+    from speech_tools.transcriber import Transcriber
 
+    # One transcriber per session, it holds this user's transcribed documents
+    if 'transcriber' not in st.session_state or st.session_state.transcriber.api_key != api_key:
+        st.session_state.transcriber = Transcriber(api_key)
+    return st.session_state.transcriber
 
-@st.cache_resource(show_spinner=False, hash_funcs={list: lambda x: ''.join([str(y.page_content) for y in x])})
-def load_text(docs: List[Document]) -> None:
-    st.session_state.messages = []
+
+def load_text(docs: List[Document], input_key: str) -> None:
     if len(docs) == 0:
         raise ValueError("Transcribed Text is Empty")
 
-    query_handler.load_text(docs)
+    # Builds the retrieval state of this session only, the index itself is shared through the index store
+    query_handler.load_text(docs, st.session_state.session_id, input_key)
+
+
+def document_indexer(session_id: str, input_key: str) -> Callable[[Document], None]:
+    """
+    Returns a callback adding freshly transcribed documents to a session's index while the rest of the audio
+    is still transcribing
+
+    The callback runs on the transcription job's thread, so it is given everything it needs up front
+    instead of reading st.session_state.
+    """
+    started = False
+    stored = False
+
+    def index_document(doc: Document) -> None:
+        nonlocal started, stored
+        if not started:
+            # An input indexed before gets its stored index, nothing is embedded or indexed again
+            stored = query_handler.load_input(input_key, session_id)
+            if not stored:
+                query_handler.begin_text(session_id)
+            started = True
+        if not stored:
+            query_handler.add_documents([doc], session_id)
+
+    return index_document
+
+
+def start_transcription(data: Union[bytes, str], file_path: str, input_type: FileType) -> None:
+    """
+    Starts transcribing the input in the background, unless it is already transcribed
+    """
+    previous = transcriber.job
+    result = openai_error_handler(lambda data: transcriber.transcribe(
+        data=data,
+        file_path=file_path,
+        input_type=input_type,
+        language=language,
+        on_document=document_indexer(st.session_state.session_id,
+                                     transcriber.input_key(data, language, asr_engine)),
+        engine=asr_engine,
+    ), data)
+    if result['error_occured']:
+        transcribe_col.markdown(result['result'])
+    elif result['result'] is not previous:
+        # Clear the chat history of the previous transcript
+        st.session_state.messages = []
 
 
 st.title('Chat with Audio')
@@ -57,6 +121,10 @@ st.title('Chat with Audio')
 if 'api_key' not in st.session_state:
     st.session_state.api_key = None
 
+# Identifies this session's retrieval state in the shared query handler
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 # Select Free or Paid mode
 if not st.session_state.api_key:
     api_key_container = st.container()
@@ -92,6 +160,13 @@ transcribe_col, chat_col = st.columns(2)
 # Input Options
 input_options = ['Load Audio File', 'Record Audio', 'Youtube URL']
 
+# Speech recognition engines as shown to the user
+asr_engine_names = {
+    ASREngine.GOOGLE: 'Google Speech Recognition (online, free)',
+    ASREngine.WHISPER_API: 'OpenAI Whisper API (online, paid)',
+    ASREngine.LOCAL_WHISPER: 'Local Whisper (offline, runs on this server)',
+}
+
 
 def change_option():
     global option
@@ -129,6 +204,15 @@ if st.session_state.api_key:
             format_func=lambda x: str(x).split('.')[1],
         )
 
+    # Select speech recognition engine, the Whisper API is billed to the OpenAI key
+    with input_container.container():
+        asr_engine = st.selectbox(
+            label='Select Speech Recognition',
+            options=[engine for engine in ASREngine
+                     if engine != ASREngine.WHISPER_API or st.session_state.api_key != 'free'],
+            format_func=lambda x: asr_engine_names[x],
+        )
+
     # Upload Audio File
     if option == input_options[0]:
         with input_container.container():
@@ -138,15 +222,12 @@ if st.session_state.api_key:
                 # Extract file type from uploaded file
                 file_type = audio_file.type.split('/')[1]
 
-                with transcribe_col:
-                    with st.spinner('Transcribing Audio...'):
-                        transcriber.transcribe(
-                            # Get bytes from Uploaded file
-                            data=audio_file.getvalue(),
-                            file_path='outputs/audio.'+file_type,
-                            input_type=FileType.FILE,
-                            language=language
-                        )
+                start_transcription(
+                    # Get bytes from Uploaded file
+                    data=audio_file.getvalue(),
+                    file_path='outputs/audio.'+file_type,
+                    input_type=FileType.FILE,
+                )
 
     # Record Audio
     elif option == input_options[1]:
@@ -166,28 +247,28 @@ if st.session_state.api_key:
                 with input_container.container():
                     st.audio(audio_bytes)
 
-                with transcribe_col:
-                    with st.spinner('Transcribing Audio...'):
-                        transcriber.transcribe(
-                            data=audio_bytes,
-                            file_path='outputs/audio.wav',
-                            input_type=FileType.RECORD,
-                            language=language
-                        )
+                start_transcription(
+                    data=audio_bytes,
+                    file_path='outputs/audio.wav',
+                    input_type=FileType.RECORD,
+                )
 
     # Youtube Url Input
     else:
         with input_container.container():
             if youtube_url := st.text_input("Enter Youtube url", key='youtube_url'):
 
-                with transcribe_col:
-                    with st.spinner('Transcribing Audio...'):
-                        transcriber.transcribe(
-                            data=youtube_url,
-                            file_path='outputs/Youtube',
-                            input_type=FileType.YOUTUBE,
-                            language=language
-                        )
+                start_transcription(
+                    data=youtube_url,
+                    file_path='outputs/Youtube',
+                    input_type=FileType.YOUTUBE,
+                )
+
+    # Transcription carries on in the background, show how far it got
+    transcriber.render()
+    if transcriber.processing:
+        if transcribe_col.button('Cancel', key='cancel_transcription'):
+            transcriber.jobs.cancel(transcriber.job)
 
     # Initialize chat history
     if "messages" not in st.session_state:
@@ -203,19 +284,31 @@ if st.session_state.api_key:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
 
-    if transcriber.got_input and not transcriber.processing:
-        st.session_state.process_prompt = False
-        with chat_col:
-            with st.spinner('Connecting To LLM'):
-                docs = transcriber.get_docs()
-                logging.debug('Transcribed Text is'+transcriber.get_text())
-                result = openai_error_handler(load_text, docs)
-                if result['error_occured']:
-                    chat_col.markdown(result['result'])
-
-                else:
-                    st.session_state.process_prompt = True
-                    load_text(docs)
+    job = transcriber.job
+    if job is not None and job.state == JobState.DONE:
+        # Load each transcript once per session, not on every rerun
+        if st.session_state.get('loaded_transcript') != job.key:
+            with chat_col:
+                with st.spinner('Connecting To LLM'):
+                    docs = job.docs
+                    log_transcript(lambda: 'Transcribed Text is'+transcriber.get_text())
+                    if docs and job.indexed == len(docs):
+                        # Documents were indexed while transcribing, only the finished index needs saving
+                        result = openai_error_handler(
+                            lambda session_id: query_handler.finish_text(session_id, job.key),
+                            st.session_state.session_id)
+                    else:
+                        result = openai_error_handler(lambda docs: load_text(docs, job.key), docs)
+                    if result['error_occured']:
+                        chat_col.markdown(result['result'])
+
+                    else:
+                        st.session_state.loaded_transcript = job.key
+
+    # Questions can be asked about the part indexed so far while the rest is still transcribing
+    st.session_state.process_prompt = job is not None and (
+        st.session_state.get('loaded_transcript') == job.key
+        or (job.active and job.indexed > 0 and not job.indexing_failed))
 
     if st.session_state.process_prompt:
         if prompt := st.chat_input("Ask a question", key='chat_input'):
@@ -226,16 +319,25 @@ if st.session_state.api_key:
 
             st.session_state.process_prompt = False
 
-            with chat_col:
-                with st.spinner('The Bot is thinking...'):
-                    try:
-                        reply = None
-                        reply = query_handler.query(prompt)
-                    except ConnectionError:
-                        reply = ':red[Failed to Connect]'
-
             with chat_col.chat_message("bot"):
-                st.markdown(reply)
+                # Render the answer as the tokens arrive
+                answer = st.empty()
+                answer.markdown('The Bot is thinking...')
+                try:
+                    reply = ''
+                    for token in query_handler.stream_query(
+                            prompt, st.session_state.session_id):
+                        reply += token
+                        answer.markdown(reply + '▌')
+                except ConnectionError:
+                    reply = ':red[Failed to Connect]'
+
+                answer.markdown(reply)
                 st.session_state.messages.append(
                     {"role": "bot", "content": reply})
                 st.session_state.process_prompt = True
+
+    if transcriber.processing:
+        # Reruns the script to show the chunks transcribed in the meantime
+        time.sleep(1)
+        st.experimental_rerun()
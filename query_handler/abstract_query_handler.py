@@ -1,10 +1,26 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, List, Union
+from typing import TYPE_CHECKING, Callable, Hashable, Iterator, List, Optional, Tuple, Union
 
 from abc import ABC, abstractmethod
 
+import asyncio
+
+import hashlib
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import logging
 
+import os
+
+import queue
+
+import threading
+
+import time
+
+from functools import partial
+
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain import PromptTemplate
 from langchain.memory import ConversationBufferWindowMemory
@@ -13,7 +29,19 @@ from langchain.vectorstores import FAISS
 from langchain.chains import RetrievalQA
 
 
+from query_handler.admission import SingleFlight, get_admission_controller
+from query_handler.answer_cache import get_answer_cache
+from query_handler.bm25 import BM25Index, HybridIndex
+from query_handler.context_packing import ContextPacker, PromptTokenCallbackHandler
+from query_handler.faiss_index import IndexOptions, faiss_from_embeddings, rebuild_for_size, set_search_params
+from query_handler.index_store import IndexKey, get_index_store, index_key
+from query_handler.sessions import LockedRetriever, RetrievalSession, SessionManager
+from query_handler.streaming import TokenQueueCallbackHandler
+from query_handler.timing import StageTimingCallbackHandler
+
+from utils.constants import RetrievalMode
 from utils.error_handler import openai_error_handler
+from utils.metrics import get_metrics, span
 
 if TYPE_CHECKING:
     from langchain.schema import Document
@@ -21,8 +49,41 @@ if TYPE_CHECKING:
 
 # Abstract class to abstract common methods and attributes of Open Ai and Hugging Face Query handlers
 class AbstractQueryHandler(ABC):
-    def __init__(self):
-        self.qa_chain = None
+    # Name of the embedding model, part of the key of saved indexes
+    embedding_model_name: str
+    # Name of the LLM, answers are only reused for the same model
+    llm_model_name: str
+    # LLM calls running at once and waiting for a slot, further calls are shed
+    max_concurrent_queries: int = 4
+    max_queued_queries: int = 16
+    # Whether FAISS indexes keep vectors as float16 instead of float32
+    index_float16: bool = False
+
+    def __init__(self, with_llm: Optional[bool] = True,
+                 retrieval_mode: Optional[RetrievalMode] = RetrievalMode.VECTOR):
+        """
+        Args:
+            with_llm: Whether to load the LLM. Without it documents can still be indexed, e.g. by the
+                      ingest command, but not queried.
+            retrieval_mode: How the transcript is searched for the context of a question. vector uses the
+                            embedding model, bm25 scores words only and loads no embedding model,
+                            hybrid fuses both rankings.
+        """
+        self.retrieval_mode = RetrievalMode(retrieval_mode)
+        # The embedding model and LLM are shared by all sessions, retrieval state is per session. Indexes of
+        # inactive sessions are unloaded beyond SESSION_MAX_BYTES of loaded indexes, 1 GiB by default
+        self.sessions = SessionManager(int(os.environ.get('SESSION_MAX_BYTES', 1024 * 1024 * 1024)))
+        self.index_store = get_index_store()
+        self.answer_cache = get_answer_cache()
+
+        # Identical questions asked at the same time share one LLM call
+        self.single_flight = SingleFlight()
+        self.admission = get_admission_controller(
+            self.llm_model_name, self.max_concurrent_queries, self.max_queued_queries)
+        # Runs the queries of aquery, sized so every admitted or queued call has a thread
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrent_queries + self.max_queued_queries,
+            thread_name_prefix='query')
 
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1500,
@@ -44,11 +105,23 @@ class AbstractQueryHandler(ABC):
         """
 
         self.prompt_template = PromptTemplate.from_template(template_string)
-        self.memory = ConversationBufferWindowMemory(
-            k=1, memory_key="chat_history", return_messages=True)
 
-        self.load_embeddings()
-        self.load_llm()
+        # Index types by transcript length and search parameters, tunable with environment variables
+        self.index_options = IndexOptions.from_env()
+
+        # Trims the retrieved documents to the tokens of transcript a prompt holds, 0 keeps all of them
+        self.context_packer = None
+        if with_llm:
+            self.context_packer = ContextPacker(int(os.environ.get('CONTEXT_TOKENS', 600)), self.llm_model_name,
+                                                max_overlap=150)
+
+        self.falcon_llm = None
+        # Without embeddings the answer cache is off, it matches questions by their embedding
+        self.embeddings = None
+        if self.retrieval_mode != RetrievalMode.BM25:
+            self.load_embeddings()
+        if with_llm:
+            self.load_llm()
 
     @abstractmethod
     def load_embeddings(self):
@@ -58,33 +131,457 @@ class AbstractQueryHandler(ABC):
     def load_llm(self):
         pass
 
-    def load_text(self, _docs: List[Document]) -> None:
+    def new_memory(self) -> ConversationBufferWindowMemory:
+        return ConversationBufferWindowMemory(
+            k=1, memory_key="chat_history", return_messages=True)
+
+    @property
+    def index_model_name(self) -> str:
         """
-        Create Retrieval QA chain from documents list.
+        Name of what the index of the retrieval mode is built with, part of the key of saved indexes
         """
+        if self.retrieval_mode == RetrievalMode.BM25:
+            return 'bm25'
+        if self.retrieval_mode == RetrievalMode.HYBRID:
+            return f'{self.embedding_model_name}+bm25'
+        return self.embedding_model_name
 
-        texts = self.text_splitter.split_documents(_docs)
+    def _build_index(self, texts: List[Document],
+                     vectors: Optional[List[List[float]]]) -> Union[FAISS, BM25Index, HybridIndex]:
+        """
+        Builds the index of the retrieval mode from the first split documents of a transcript
+        """
+        db = None
+        if vectors is not None:
+            db = faiss_from_embeddings([(text.page_content, vector) for text, vector in zip(texts, vectors)],
+                                       self.embeddings, metadatas=[text.metadata for text in texts],
+                                       float16=self.index_float16)
+        if self.retrieval_mode == RetrievalMode.VECTOR:
+            return db
 
-        db = FAISS.from_documents(texts, self.embeddings)
+        lexical = BM25Index()
+        lexical.add_documents(texts)
+        return lexical if db is None else HybridIndex(db, lexical)
 
-        retriever = db.as_retriever(search_kwargs={"k": 3})
+    def _extend_index(self, db: Union[FAISS, BM25Index, HybridIndex], texts: List[Document],
+                      vectors: Optional[List[List[float]]]) -> None:
+        """
+        Adds further split documents of a transcript to its index
+        """
+        if isinstance(db, HybridIndex):
+            self._extend_index(db.vector, texts, vectors)
+            db.lexical.add_documents(texts)
+        elif isinstance(db, BM25Index):
+            db.add_documents(texts)
+        else:
+            db.add_embeddings([(text.page_content, vector) for text, vector in zip(texts, vectors)],
+                              metadatas=[text.metadata for text in texts])
 
-        self.memory.clear()
+    @staticmethod
+    def _vector_db(db: Union[FAISS, BM25Index, HybridIndex]) -> Optional[FAISS]:
+        """
+        The FAISS part of an index, None for BM25 indexes
+        """
+        if isinstance(db, HybridIndex):
+            return db.vector
+        return None if isinstance(db, BM25Index) else db
+
+    def _attach_index(self, session: RetrievalSession, db: Union[FAISS, BM25Index, HybridIndex]) -> None:
+        """
+        Builds the Retrieval QA chain of a session on top of a loaded index
+        """
+        session.db = db
+        if (vector_db := self._vector_db(db)) is not None:
+            set_search_params(vector_db.index, self.index_options)
+        if self.falcon_llm is None:
+            return
 
-        self.qa_chain = RetrievalQA.from_llm(
+        # Chains run without the session lock, only their index search takes it
+        retriever = self.context_packer.as_retriever(
+            LockedRetriever(retriever=db.as_retriever(search_kwargs={"k": self.index_options.k}), lock=session.lock))
+        session.qa_chain = RetrievalQA.from_llm(
             llm=self.falcon_llm,
             retriever=retriever,
-            memory=self.memory,
+            memory=session.memory,
             prompt=self.prompt_template,
             verbose=False,
         )
 
-    def query(self, query: str) -> dict[str, Union[str, bool]]:
-        if not self.qa_chain:
-            result = {"result": "Couldn't connect to the LLM",
-                      "error_occured": True}
+    def _input_alias(self, input_key: str) -> str:
+        """
+        Key an index is linked under in the index store for the input it was transcribed from
+        """
+        return hashlib.sha256(f'{input_key}\0{self.index_model_name}'.encode()).hexdigest()
 
-        else:
-            result = openai_error_handler(self.qa_chain.run, query)
+    def _load_stored(self, session: RetrievalSession, key: str,
+                     db: Union[FAISS, BM25Index, HybridIndex]) -> None:
+        """
+        Attaches an index of the store, shared read-only with the other sessions, to a session
+        """
+        with session.lock:
+            session.index_key = key
+            session.pending_key = None
+            session.memory.clear()
+            self._attach_index(session, db)
+
+        self.sessions.evict()
+
+    def load_text(self, _docs: List[Document], session_id: str, input_key: Optional[str] = None) -> None:
+        """
+        Create Retrieval QA chain of a session from documents list.
+
+        Args:
+            _docs: Transcribed documents
+            session_id: Id of the session
+            input_key: Hash of the input the documents were transcribed from, see load_input
+        """
+
+        # Reuse the index if this transcript was already embedded by any session
+        key = index_key(_docs, self.index_model_name)
+        db = self.index_store.load(key, self.embeddings)
+        get_metrics().counter('index_store_lookups_total', 'Transcript indexes looked up in the index store').inc(
+            outcome='miss' if db is None else 'hit')
+        if db is None:
+            self.begin_text(session_id)
+            self.add_documents(_docs, session_id)
+            self.finish_text(session_id, input_key)
+            return
+
+        self._load_stored(self.sessions.get(session_id, self.new_memory), key, db)
+        if input_key is not None:
+            self.index_store.link(self._input_alias(input_key), key)
+
+    def load_input(self, input_key: str, session_id: str) -> bool:
+        """
+        Attaches the stored index of an input transcribed and indexed before, by any session, so its transcript
+        is neither embedded nor indexed again
+
+        Args:
+            input_key: Hash of the input, as the transcription job is keyed
+            session_id: Id of the session
+        Returns:
+            found: Whether the index was found. If not, the transcript has to be indexed with begin_text.
+        """
+        key = self.index_store.resolve(self._input_alias(input_key))
+        db = self.index_store.load(key, self.embeddings) if key is not None else None
+        get_metrics().counter('index_store_lookups_total', 'Transcript indexes looked up in the index store').inc(
+            outcome='miss' if db is None else 'hit')
+        if db is None:
+            return False
+
+        self._load_stored(self.sessions.get(session_id, self.new_memory), key, db)
+        return True
+
+    def begin_text(self, session_id: str) -> None:
+        """
+        Starts building the index of a new transcript for a session, documents are added with add_documents
+        """
+        session = self.sessions.get(session_id, self.new_memory)
+        with session.lock:
+            session.unload()
+            session.index_key = None
+            session.pending_key = IndexKey(self.index_model_name)
+            session.memory.clear()
+
+    def add_documents(self, _docs: List[Document], session_id: str) -> None:
+        """
+        Splits, embeds if the retrieval mode needs it, and adds transcribed documents to the index the session is
+        building
+
+        The session can be queried as soon as the first documents are added, answers cover what was added so far.
+        """
+        with span('split'):
+            texts = self.text_splitter.split_documents(_docs)
+        if not texts:
+            return
+
+        # Embedded outside the lock, so the session can still be queried meanwhile
+        vectors = None
+        if self.embeddings is not None:
+            with span('embed', model=self.embedding_model_name):
+                vectors = self.embeddings.embed_documents(
+                    [text.page_content for text in texts])
+
+        session = self.sessions.get(session_id, self.new_memory)
+        with session.lock:
+            if session.pending_key is None:
+                return
+
+            session.pending_key.update(_docs)
+            with span('index_build', mode=self.retrieval_mode.value):
+                if session.db is None:
+                    self._attach_index(session, self._build_index(texts, vectors))
+                else:
+                    self._extend_index(session.db, texts, vectors)
+
+        self.sessions.evict()
+
+    def finish_text(self, session_id: str, input_key: Optional[str] = None) -> None:
+        """
+        Marks the index the session was building as complete and saves it to the index store
+
+        Documents are added to a flat index while a transcript is indexed. Long transcripts get the index type
+        of their size here, once all vectors are known. If the store already has the index of the same
+        transcript, the session shares it instead and its own copy is dropped.
+
+        Args:
+            session_id: Id of the session
+            input_key: Hash of the input the transcript was transcribed from, see load_input
+        """
+        session = self.sessions.get(session_id, self.new_memory)
+        with session.lock:
+            if session.pending_key is None:
+                return
+            if session.db is None:
+                raise ValueError("Transcribed Text is Empty")
 
+            session.index_key = session.pending_key.hexdigest()
+            session.pending_key = None
+            if (stored := self.index_store.load(session.index_key, self.embeddings)) is not None:
+                self._attach_index(session, stored)
+            else:
+                if (vector_db := self._vector_db(session.db)) is not None:
+                    rebuild_for_size(vector_db, self.index_options, self.index_float16)
+                with span('index_save'):
+                    self.index_store.save(session.index_key, session.db)
+            key = session.index_key
+
+        if input_key is not None:
+            self.index_store.link(self._input_alias(input_key), key)
+
+    def _get_session(self, session_id: str) -> RetrievalSession:
+        """
+        Returns a session, reloading its index if it was unloaded while the session was inactive. Caller holds no lock.
+        """
+        session = self.sessions.get(session_id, self.new_memory)
+        with session.lock:
+            if session.qa_chain is None and session.index_key is not None:
+                if (db := self.index_store.load(session.index_key, self.embeddings)) is not None:
+                    self._attach_index(session, db)
+                    self.sessions.evict()
+        return session
+
+    def _lookup_answer(self, session: RetrievalSession, transcript_key: Optional[str],
+                       query: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """
+        Looks for a cached answer to a similar question about a transcript. Caller holds no lock.
+
+        Args:
+            session: Session whose chat memory a cached answer is saved to
+            transcript_key: Index key of the session's transcript when the chain was taken, None while it is indexed
+            query: The question
+
+        Returns:
+            answer: The cached answer, or None on a miss
+            vector: Embedding of the query, to store the answer under after a miss. None if caching does not apply.
+        """
+        # Answers about a transcript that is still being indexed are incomplete, so they are neither used nor cached
+        if transcript_key is None or self.embeddings is None:
+            return None, None
+
+        try:
+            vector = self.embeddings.embed_query(query)
+        except Exception:
+            logging.exception('Could not embed the query for the answer cache')
+            return None, None
+
+        answer = self.answer_cache.lookup(f'{transcript_key}:{self.llm_model_name}', vector)
+        if answer is not None:
+            # Keep the chat memory as if the chain had answered
+            with session.lock:
+                session.memory.save_context({'query': query}, {'result': answer})
+        return answer, vector
+
+    def _store_answer(self, transcript_key: Optional[str], query: str,
+                      vector: Optional[List[float]], answer: str, latency: float) -> None:
+        """
+        Caches an answer under the transcript the chain that gave it was built on, even if the session moved on since
+        """
+        if vector is None or transcript_key is None:
+            return
+        self.answer_cache.store(f'{transcript_key}:{self.llm_model_name}',
+                                query, vector, answer, latency)
+
+    @staticmethod
+    def _snapshot(session: RetrievalSession) -> Tuple[Optional[RetrievalQA], Optional[str]]:
+        """
+        The chain of a session and the key of the transcript it answers about, taken together under the session lock
+
+        The chain runs without the lock, so adding documents to the session does not wait for the LLM.
+        """
+        with session.lock:
+            return session.qa_chain, session.index_key
+
+    def _flight_key(self, session: RetrievalSession, session_id: str, query: str) -> Hashable:
+        """
+        Key under which identical in flight questions are coalesced
+
+        Questions about a complete transcript are shared across sessions, questions about a transcript
+        that is still being indexed only within the session.
+        """
+        return (session.index_key or session_id, self.llm_model_name, ' '.join(query.lower().split()))
+
+    def _run_chain(self, run: Callable[[str], str], query: str) -> str:
+        """
+        Runs the chain once the backend admits the call, raising OverloadedError if it is shed
+
+        Retriever and LLM calls are timed as the retrieval and llm stages, the whole run as the answer stage.
+        """
+        with self.admission.admit(), span('answer', model=self.llm_model_name):
+            return run(query)
+
+    def _callbacks(self) -> list:
+        """
+        Callbacks every chain run is given, inherited by its retriever and LLM
+        """
+        return [StageTimingCallbackHandler(self.llm_model_name),
+                PromptTokenCallbackHandler(self.context_packer, self.llm_model_name)]
+
+    def _answer(self, session: RetrievalSession, query: str) -> dict[str, Union[str, bool]]:
+        """
+        Answers a query from the answer cache or the chain of the session
+        """
+        qa_chain, transcript_key = self._snapshot(session)
+        if not qa_chain:
+            return {"result": "Couldn't connect to the LLM", "error_occured": True}
+
+        answer, vector = self._lookup_answer(session, transcript_key, query)
+        if answer is not None:
+            return {"result": answer, "error_occured": False}
+
+        start = time.perf_counter()
+        result = openai_error_handler(
+            partial(self._run_chain, partial(qa_chain.run, callbacks=self._callbacks())), query)
+        if not result['error_occured']:
+            self._store_answer(transcript_key, query, vector, result['result'],
+                               time.perf_counter() - start)
+        return result
+
+    def _remember(self, session: RetrievalSession, query: str, result: dict[str, Union[str, bool]]) -> None:
+        """
+        Saves an answer shared by another caller to the chat memory of the session
+        """
+        if result['error_occured']:
+            return
+        with session.lock:
+            session.memory.save_context({'query': query}, {'result': result['result']})
+
+    def query(self, query: str, session_id: str) -> dict[str, Union[str, bool]]:
+        session = self._get_session(session_id)
+        result, shared = self.single_flight.do(
+            self._flight_key(session, session_id, query), partial(self._answer, session, query))
+        if shared:
+            self._remember(session, query, result)
+
+        return result['result']
+
+    async def aquery(self, query: str, session_id: str) -> str:
+        """
+        Answers a query without blocking the event loop
+
+        Identical questions in flight share one answer. When the backend already has as many calls
+        running and queued as it accepts, the query is shed right away instead of waiting.
+
+        Args:
+            query: The question to answer
+            session_id: Id of the session whose transcript and memory are used
+        Returns:
+            result: The answer, or the error message if the query failed or was shed
+        """
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(self.executor, self._get_session, session_id)
+
+        key = self._flight_key(session, session_id, query)
+        future, leader = self.single_flight.join(key)
+        if leader:
+            if self.admission.is_full():
+                error = self.admission.overloaded('queue is full')
+                self.single_flight.complete(key, {"result": f':orange[{error}]', "error_occured": True})
+            else:
+                def settle(answer: Future) -> None:
+                    if answer.exception() is not None:
+                        self.single_flight.complete(key, exception=answer.exception())
+                    else:
+                        self.single_flight.complete(key, answer.result())
+
+                self.executor.submit(self._answer, session, query).add_done_callback(settle)
+
+        # Shielded so a cancelled caller does not cancel the answer other callers wait for
+        result = await asyncio.shield(asyncio.wrap_future(future))
+        if not leader:
+            await loop.run_in_executor(self.executor, self._remember, session, query, result)
         return result['result']
+
+    def stream_query(self, query: str, session_id: str) -> Iterator[str]:
+        """
+        Answers a query, yielding the answer in pieces as the LLM generates them
+
+        Concatenating everything yielded gives the same text query would return. A caller asking
+        the same question as one already in flight gets the whole answer at once when it is ready.
+
+        Args:
+            query: The question to answer
+            session_id: Id of the session whose transcript and memory are used
+        Yields:
+            token: The next piece of the answer, or the error message if the query failed
+        """
+        session = self._get_session(session_id)
+        key = self._flight_key(session, session_id, query)
+        future, leader = self.single_flight.join(key)
+        if not leader:
+            result = future.result()
+            self._remember(session, query, result)
+            yield result['result']
+            return
+
+        # Set once the flight is completed, or will be by the chain thread
+        settled = False
+        try:
+            result = None
+            qa_chain, transcript_key = self._snapshot(session)
+            if not qa_chain:
+                result = {"result": "Couldn't connect to the LLM", "error_occured": True}
+            else:
+                cached, vector = self._lookup_answer(session, transcript_key, query)
+                if cached is not None:
+                    result = {"result": cached, "error_occured": False}
+
+            if result is not None:
+                settled = True
+                self.single_flight.complete(key, result)
+                yield result['result']
+                return
+
+            # The chain runs on its own thread and hands tokens over through the queue
+            tokens = queue.Queue()
+            finished = object()
+            result = {}
+
+            def run_chain() -> None:
+                run = partial(qa_chain.run,
+                              callbacks=[TokenQueueCallbackHandler(tokens), *self._callbacks()])
+                result.update(openai_error_handler(
+                    partial(self._run_chain, run), query))
+                self.single_flight.complete(key, dict(result))
+                tokens.put(finished)
+
+            start = time.perf_counter()
+            threading.Thread(target=run_chain, daemon=True).start()
+            settled = True
+
+            streamed = False
+            while (token := tokens.get()) is not finished:
+                streamed = True
+                yield token
+
+            # LLMs that cannot stream hand back the whole answer at the end
+            if result['error_occured'] or not streamed:
+                yield result['result']
+
+            if not result['error_occured']:
+                self._store_answer(transcript_key, query, vector, result['result'],
+                                   time.perf_counter() - start)
+        finally:
+            if not settled:
+                self.single_flight.complete(
+                    key, exception=RuntimeError('The query was interrupted'))
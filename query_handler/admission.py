@@ -0,0 +1,155 @@
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from concurrent.futures import Future
+
+from contextlib import contextmanager
+
+import logging
+
+import threading
+
+import time
+
+from utils.error_handler import OverloadedError
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrency: int, max_queue: int,
+                 queue_timeout: Optional[float] = 30.0) -> None:
+        """
+        Limits the number of concurrent LLM calls of a backend, with a bounded queue of waiting calls
+
+        Calls arriving while the queue is full, or waiting longer than queue_timeout, are shed with an
+        OverloadedError instead of piling up, so latency degrades gracefully under bursts.
+
+        Args:
+            name: Name of the backend, used in logs
+            max_concurrency: Maximum number of calls running at once
+            max_queue: Maximum number of calls waiting for a slot
+            queue_timeout: Maximum seconds a call waits for a slot
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self.condition = threading.Condition()
+
+    def is_full(self) -> bool:
+        """
+        Whether a new call would be shed right away
+        """
+        with self.condition:
+            return self.active >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def overloaded(self, reason: str) -> OverloadedError:
+        """
+        Counts a shed call and returns the error to raise or report for it
+        """
+        self.shed += 1
+        logging.warning(f'Shedding {self.name} query, {reason}')
+        return OverloadedError('Too many questions are being answered right now, please try again shortly')
+
+    def acquire(self) -> None:
+        with self.condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return
+
+            if self.waiting >= self.max_queue:
+                raise self.overloaded('queue is full')
+
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self.overloaded('waited too long for a slot')
+                    self.condition.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def admit(self):
+        """
+        Holds a slot for the duration of the with block
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time into one
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+    def join(self, key: Hashable) -> Tuple[Future, bool]:
+        """
+        Returns the future of the call with the given key and whether the caller is the leader
+
+        The leader must run the call and pass its outcome to complete, everyone else waits on the future.
+        """
+        with self.lock:
+            if key in self.calls:
+                return self.calls[key], False
+            future = Future()
+            self.calls[key] = future
+            return future, True
+
+    def complete(self, key: Hashable, result: Any = None, exception: Optional[BaseException] = None) -> None:
+        with self.lock:
+            future = self.calls.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Runs func unless an identical call is already in flight, in which case its result is shared
+
+        Returns:
+            result: Result of func
+            shared: Whether the result came from another caller's call
+        """
+        future, leader = self.join(key)
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = func()
+        except BaseException as e:
+            self.complete(key, exception=e)
+            raise
+        self.complete(key, result=result)
+        return result, False
+
+
+_controllers: Dict[str, AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(name: str, max_concurrency: int, max_queue: int) -> AdmissionController:
+    """
+    Returns the admission controller of a backend, shared by every query handler using it
+    """
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = AdmissionController(name, max_concurrency, max_queue)
+        return _controllers[name]
@@ -0,0 +1,199 @@
+from typing import List, Optional
+
+from collections import OrderedDict
+
+import logging
+
+import os
+
+import sqlite3
+
+import threading
+
+import time
+
+import numpy as np
+
+from utils.metrics import get_metrics
+
+
+class _TranscriptAnswers:
+    """
+    In memory nearest neighbour index over the cached questions of one transcript
+    """
+
+    def __init__(self, dimension: int) -> None:
+        import faiss
+
+        self.index = faiss.IndexFlatIP(dimension)
+        self.row_ids: List[int] = []
+        self.created: List[float] = []
+
+    def add(self, row_id: int, vector: np.ndarray, created: float) -> None:
+        self.index.add(vector.reshape(1, -1))
+        self.row_ids.append(row_id)
+        self.created.append(created)
+
+
+def normalize(vector: List[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class AnswerCache:
+    def __init__(self, path: Optional[str] = 'cache/answers.sqlite3',
+                 threshold: Optional[float] = 0.95,
+                 ttl: Optional[float] = 7 * 24 * 60 * 60,
+                 max_entries: Optional[int] = 10000,
+                 max_transcripts_in_memory: Optional[int] = 256) -> None:
+        """
+        Cache of LLM answers per transcript, matched on the similarity of the question embeddings
+
+        Args:
+            path: Path of the SQLite database the answers are kept in
+            threshold: Minimum cosine similarity between a new question and a cached one to reuse its answer
+            ttl: Answers older than this many seconds are not used
+            max_entries: Least recently used answers are deleted beyond this count
+            max_transcripts_in_memory: Number of transcripts whose question index is kept in memory
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_transcripts_in_memory = max_transcripts_in_memory
+
+        self.hits = 0
+        self.misses = 0
+        # Sum of the LLM latency of the answers served from the cache
+        self.saved_seconds = 0.0
+
+        self.transcripts: OrderedDict[str, _TranscriptAnswers] = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS answers '
+                '(id INTEGER PRIMARY KEY, transcript TEXT NOT NULL, question TEXT NOT NULL, '
+                'vector BLOB NOT NULL, answer TEXT NOT NULL, latency REAL NOT NULL, '
+                'created REAL NOT NULL, last_used REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS answers_transcript ON answers (transcript)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)')
+
+    def _transcript_answers(self, transcript: str, dimension: int) -> _TranscriptAnswers:
+        """
+        Returns the in memory index of a transcript, loading it from disk if needed. Caller holds the lock.
+        """
+        if transcript in self.transcripts:
+            self.transcripts.move_to_end(transcript)
+            return self.transcripts[transcript]
+
+        answers = _TranscriptAnswers(dimension)
+        rows = self.connection.execute(
+            'SELECT id, vector, created FROM answers WHERE transcript = ? AND created > ?',
+            (transcript, time.time() - self.ttl))
+        for row_id, vector, created in rows:
+            answers.add(row_id, np.frombuffer(vector, dtype=np.float32), created)
+
+        self.transcripts[transcript] = answers
+        while len(self.transcripts) > self.max_transcripts_in_memory:
+            self.transcripts.popitem(last=False)
+        return answers
+
+    def lookup(self, transcript: str, question_vector: List[float]) -> Optional[str]:
+        """
+        Returns the cached answer of the most similar question asked about the transcript, or None on a miss
+        """
+        vector = normalize(question_vector)
+        now = time.time()
+        with self.lock, self.connection:
+            answers = self._transcript_answers(transcript, len(vector))
+            if answers.index.ntotal:
+                scores, positions = answers.index.search(vector.reshape(1, -1), 1)
+                score, position = float(scores[0][0]), int(positions[0][0])
+                if score >= self.threshold and answers.created[position] > now - self.ttl:
+                    row = self.connection.execute(
+                        'SELECT answer, latency FROM answers WHERE id = ?',
+                        (answers.row_ids[position],)).fetchone()
+                    if row is not None:
+                        self.connection.execute(
+                            'UPDATE answers SET last_used = ? WHERE id = ?', (now, answers.row_ids[position]))
+                        self.hits += 1
+                        self.saved_seconds += row[1]
+                        return row[0]
+
+            self.misses += 1
+            return None
+
+    def store(self, transcript: str, question: str, question_vector: List[float],
+              answer: str, latency: float) -> None:
+        """
+        Caches the answer to a question about a transcript
+
+        Args:
+            transcript: Key of the transcript the question was asked about
+            question: The question, kept for inspection
+            question_vector: Embedding of the question
+            answer: The answer of the LLM
+            latency: Seconds the LLM took to answer, reported as saved time on later hits
+        """
+        vector = normalize(question_vector)
+        now = time.time()
+        with self.lock, self.connection:
+            answers = self._transcript_answers(transcript, len(vector))
+            row_id = self.connection.execute(
+                'INSERT INTO answers (transcript, question, vector, answer, latency, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (transcript, question, vector.tobytes(), answer, latency, now, now)).lastrowid
+            answers.add(row_id, vector, now)
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """
+        Deletes expired answers and least recently used answers beyond max_entries. Caller holds the lock.
+        """
+        expired = self.connection.execute(
+            'SELECT id, transcript FROM answers WHERE created <= ?', (now - self.ttl,)).fetchall()
+        count = self.connection.execute('SELECT COUNT(*) FROM answers').fetchone()[0] - len(expired)
+        if count > self.max_entries:
+            expired += self.connection.execute(
+                'SELECT id, transcript FROM answers WHERE created > ? ORDER BY last_used LIMIT ?',
+                (now - self.ttl, count - self.max_entries)).fetchall()
+        if not expired:
+            return
+
+        self.connection.executemany(
+            'DELETE FROM answers WHERE id = ?', [(row_id,) for row_id, _ in expired])
+        for transcript in {transcript for _, transcript in expired}:
+            # Rebuilt from disk on next use, without the deleted answers
+            self.transcripts.pop(transcript, None)
+        logging.debug(f'Evicted {len(expired)} answers from the answer cache')
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns hit and miss counters, the hit rate and the LLM time saved by hits
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'saved_seconds': self.saved_seconds}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """
+    Returns the answer cache shared by every query handler in the process
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache()
+            get_metrics().register_collector('answer_cache', 'Answer cache counters', _cache.stats)
+        return _cache
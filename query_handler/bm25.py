@@ -0,0 +1,186 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from array import array
+
+from collections import Counter
+
+import math
+
+import os
+
+import pickle
+
+import re
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+if TYPE_CHECKING:
+    from langchain.vectorstores import FAISS
+
+
+# Words too common to tell transcript chunks apart, left out of the index
+STOP_WORDS = frozenset('''
+a an and are as at be but by for from has have he her his i in is it its me my of on or our she so that the
+their them they this to was we were what when where which who will with you your
+'''.split())
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower cased words of a text without stop words, works for any script \\w matches
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    def __init__(self, k1: Optional[float] = 1.5, b: Optional[float] = 0.75) -> None:
+        """
+        In memory inverted index over documents, ranked with Okapi BM25
+
+        Builds in a single pass over the text without any model, and takes a few bytes per word of the
+        transcript. Documents can be added while the index is being queried, as with FAISS.
+
+        Args:
+            k1: Term frequency saturation
+            b: Strength of the document length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.docs: List[Document] = []
+        self.doc_lengths: List[int] = []
+        self.total_length = 0
+        # Term to the document number and term frequency of every document containing it, interleaved
+        self.postings: Dict[str, array] = {}
+
+    def add_documents(self, docs: List[Document]) -> None:
+        for doc in docs:
+            number = len(self.docs)
+            tokens = tokenize(doc.page_content)
+            for term, frequency in Counter(tokens).items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = array('I')
+                postings.extend((number, frequency))
+            self.doc_lengths.append(len(tokens))
+            self.total_length += len(tokens)
+            self.docs.append(doc)
+
+    def search(self, query: str, k: Optional[int] = 3) -> List[Tuple[Document, float]]:
+        """
+        Returns the k best matching documents for the query with their scores, best first
+        """
+        count = len(self.docs)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            frequency_of_term = len(postings) // 2
+            # Never negative, unlike the original formula for terms in more than half the documents
+            idf = math.log(1 + (count - frequency_of_term + 0.5) / (frequency_of_term + 0.5))
+            for number, frequency in zip(postings[::2], postings[1::2]):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[number] / average_length)
+                scores[number] = scores.get(number, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.docs[number], score) for number, score in best]
+
+    def nbytes(self) -> int:
+        """
+        Approximate resident size of the postings and document lengths. The documents are not counted, as
+        they are not for FAISS indexes.
+        """
+        # A term costs its string, its dictionary slot and the array header besides the postings
+        return (sum(len(term) + 200 + postings.itemsize * len(postings) for term, postings in self.postings.items())
+                + 8 * len(self.doc_lengths))
+
+    def as_retriever(self, search_kwargs: Optional[dict] = None) -> BM25Retriever:
+        return BM25Retriever(index=self, k=(search_kwargs or {}).get('k', 3))
+
+    def save_local(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'bm25.pkl'), 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load_local(folder: str) -> BM25Index:
+        with open(os.path.join(folder, 'bm25.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+
+class BM25Retriever(BaseRetriever):
+    """
+    Retrieves the k best matching documents of a BM25Index
+    """
+    index: Any
+    k: int = 3
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [doc for doc, _ in self.index.search(query, self.k)]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: Optional[int] = 60) -> List[Document]:
+    """
+    Merges rankings of documents, scoring each document by the sum of 1 / (k + rank) over the rankings
+
+    Only ranks are used, so rankings with incomparable scores such as BM25 and cosine similarity can be fused.
+    Documents are matched on their text.
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1 / (k + rank)
+            docs.setdefault(doc.page_content, doc)
+    return [docs[text] for text in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridIndex:
+    def __init__(self, vector: FAISS, lexical: BM25Index) -> None:
+        """
+        A FAISS index and a BM25 index over the same documents, queried together
+
+        Args:
+            vector: Index of the document embeddings
+            lexical: Index of the document words
+        """
+        self.vector = vector
+        self.lexical = lexical
+
+    def nbytes(self) -> int:
+        from query_handler.faiss_index import faiss_nbytes
+
+        return faiss_nbytes(self.vector) + self.lexical.nbytes()
+
+    def as_retriever(self, search_kwargs: Optional[dict] = None) -> HybridRetriever:
+        k = (search_kwargs or {}).get('k', 3)
+        # Each ranking contributes more candidates than are kept, so documents ranked well by both win
+        return HybridRetriever(retrievers=[self.vector.as_retriever(search_kwargs={'k': 2 * k}),
+                                           self.lexical.as_retriever(search_kwargs={'k': 2 * k})], k=k)
+
+    def save_local(self, folder: str) -> None:
+        self.vector.save_local(folder)
+        self.lexical.save_local(folder)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the results of several retrievers with reciprocal rank fusion and keeps the k best
+    """
+    retrievers: List[BaseRetriever]
+    k: int = 3
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        rankings = [retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+                    for retriever in self.retrievers]
+        return reciprocal_rank_fusion(rankings)[:self.k]
@@ -0,0 +1,143 @@
+from typing import Dict, List, Optional, Tuple
+
+import hashlib
+
+import logging
+
+import os
+
+import sqlite3
+
+import threading
+
+import numpy as np
+
+from langchain.embeddings.base import Embeddings
+
+from utils.concurrency import ordered_map
+
+
+# SQLite limits the number of bound parameters per statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class EmbeddingStore:
+    def __init__(self, path: Optional[str] = 'cache/embeddings.sqlite3') -> None:
+        """
+        On disk store of embedding vectors keyed by model and text hash, stored as packed float32
+
+        Args:
+            path: Path of the SQLite database
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings '
+                '(model TEXT NOT NULL, hash BLOB NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, hash)) '
+                'WITHOUT ROWID')
+
+    def get_many(self, model: str, hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Returns the stored vectors of the given text hashes, missing hashes are left out
+        """
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f'SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({",".join("?" * len(batch))})',
+                    (model, *batch))
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, hashes: List[bytes], vectors: List[List[float]]) -> None:
+        """
+        Stores vectors for the given text hashes
+        """
+        rows = [(model, key, np.asarray(vector, dtype=np.float32).tobytes())
+                for key, vector in zip(hashes, vectors)]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)', rows)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model_name: str,
+                 store: Optional[EmbeddingStore] = None,
+                 batch_size: Optional[int] = 32,
+                 max_concurrency: Optional[int] = 1) -> None:
+        """
+        Wraps an embedding model so that only texts never embedded before are sent to it
+
+        Args:
+            embeddings: The embedding model to wrap
+            model_name: Name of the model, vectors are only shared between identical names
+            store: Where vectors are kept. Defaults to the store shared by the process.
+            batch_size: Number of texts per call to the wrapped model
+            max_concurrency: Number of batches embedded at once. Use 1 for local models, more for API models.
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store = store or get_embedding_store()
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.store.get_many(self.model_name, list(set(hashes)))
+
+        # Each distinct text that is not in the store is embedded once
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        logging.debug(
+            f'{len(missing)} distinct texts out of {len(texts)} not found in the embedding cache')
+
+        if missing:
+            keys, missing_texts = list(missing.keys()), list(missing.values())
+            batches = [(keys[start:start + self.batch_size], missing_texts[start:start + self.batch_size])
+                       for start in range(0, len(keys), self.batch_size)]
+            for batch_keys, batch_vectors in ordered_map(self._embed_batch, batches,
+                                                         max_workers=self.max_concurrency):
+                vectors.update(zip(batch_keys, (np.asarray(v, dtype=np.float32) for v in batch_vectors)))
+
+        return [vectors[key].tolist() for key in hashes]
+
+    def _embed_batch(self, batch: Tuple[List[bytes], List[str]]) -> Tuple[List[bytes], List[List[float]]]:
+        """
+        Embeds one batch of texts with the wrapped model and stores the vectors. Runs on a worker thread.
+        """
+        keys, texts = batch
+        batch_vectors = self.embeddings.embed_documents(texts)
+        self.store.put_many(self.model_name, keys, batch_vectors)
+        return keys, batch_vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> EmbeddingStore:
+    """
+    Returns the embedding store shared by every query handler in the process
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EmbeddingStore()
+        return _store
@@ -0,0 +1,263 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import logging
+
+import math
+
+import re
+
+from collections import Counter
+
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+from query_handler.bm25 import tokenize
+
+from utils.metrics import get_metrics
+
+
+# Encoding of the OpenAI chat models, token counts of other LLMs such as Falcon are approximated with it
+DEFAULT_ENCODING = 'cl100k_base'
+# Prompt lengths in tokens, from a single short chunk to a full context window
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192)
+# Shorter common text of two chunks is a coincidence rather than the overlap of the text splitter
+MIN_OVERLAP = 20
+# Marks text left out between two packed spans of a chunk
+GAP = ' ... '
+# Characters per token of English text, to count tokens when no tiktoken encoding can be loaded
+CHARS_PER_TOKEN = 4
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def get_encoding(model_name: str):
+    """
+    tiktoken encoding of an LLM, the encoding of the OpenAI chat models for LLMs tiktoken does not know
+
+    Encodings are downloaded on first use. Offline, None is returned unless TIKTOKEN_CACHE_DIR holds them.
+
+    Raises:
+        ValueError: If tiktoken is not installed
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        raise ValueError(
+            "tiktoken package not found, please install it with "
+            "`pip install tiktoken`"
+        )
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logging.warning(f'Could not load the tiktoken encoding of {model_name}, tokens are estimated: {e}')
+        return None
+
+
+def overlap_length(first: str, second: str, max_overlap: int) -> int:
+    """
+    Length of the longest end of first that second starts with, up to max_overlap characters, 0 if shorter
+    than MIN_OVERLAP
+    """
+    for length in range(min(max_overlap, len(first), len(second)), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def split_spans(text: str, max_words: int) -> List[str]:
+    """
+    Splits text into sentences, and sentences longer than max_words into pieces of max_words words
+
+    Transcripts recognized without punctuation come out as pieces of max_words words.
+    """
+    spans = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        words = sentence.split()
+        spans += [' '.join(words[i:i + max_words]) for i in range(0, len(words), max_words)]
+    return spans
+
+
+class ContextPacker:
+    def __init__(self, max_tokens: Optional[int] = 600,
+                 model_name: Optional[str] = 'gpt-3.5-turbo',
+                 max_overlap: Optional[int] = 150,
+                 max_span_words: Optional[int] = 40) -> None:
+        """
+        Assembles the context of a question from retrieved documents within a budget of tokens
+
+        Text the documents share because of the chunk overlap of the text splitter is kept once. If the
+        documents still do not fit the budget, they are split into sentences and the sentences sharing the most
+        rare words with the question are kept first, then the sentences around them and those of the best ranked
+        documents while the budget lasts, in their order in the transcript.
+
+        Args:
+            max_tokens: Most tokens of context, 0 to keep all documents once their overlap is removed
+            model_name: LLM whose tokenizer the tokens are counted with
+            max_overlap: Chunk overlap of the text splitter, in characters
+            max_span_words: Most words of a span, the unit text is kept or left out in
+        Raises:
+            ValueError: If tiktoken is not installed
+        """
+        self.max_tokens = max_tokens
+        self.max_overlap = max_overlap
+        self.max_span_words = max_span_words
+        self.encoding = get_encoding(model_name)
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def deduplicate(self, docs: List[Document]) -> List[Document]:
+        """
+        Drops documents contained in a better ranked one and trims the text they share with better ranked
+        neighbors in the transcript
+        """
+        kept: List[Document] = []
+        for doc in docs:
+            text = doc.page_content.strip()
+            for other in kept:
+                if text in other.page_content:
+                    text = ''
+                    break
+                # The end of the chunk before it in the transcript, then the start of the chunk after it
+                text = text[overlap_length(other.page_content, text, self.max_overlap):].lstrip()
+                text = text[:len(text) - overlap_length(text, other.page_content, self.max_overlap)].rstrip()
+            if text:
+                kept.append(Document(page_content=text, metadata=doc.metadata))
+        return kept
+
+    def _select(self, query: str, spans: List[Tuple[int, int, str]]) -> List[Tuple[int, int, str]]:
+        """
+        Picks the spans, as (document rank, position, text), to spend the budget on
+
+        Spans sharing the most rare words with the query come first. The budget left is filled with the spans
+        next to those picked, so a match keeps the sentences around it, then with the other spans of the best
+        ranked documents, as when a question paraphrases the transcript and only the vector search found them.
+        """
+        terms = [set(tokenize(text)) for _, _, text in spans]
+        frequencies = Counter(term for span_terms in terms for term in span_terms)
+        query_terms = set(tokenize(query))
+        # Robertson-Sparck Jones weights, words in half of the spans or more tell nothing about them
+        weights = {term: max(0.0, math.log((len(spans) - frequencies[term] + 0.5) / (frequencies[term] + 0.5)))
+                   for term in query_terms}
+        scores = [sum(weights[term] for term in query_terms & span_terms) for span_terms in terms]
+        # One more token for the space or gap the span is joined with
+        tokens = [self.count_tokens(text) + 1 for _, _, text in spans]
+        positions = {(rank, position): i for i, (rank, position, _) in enumerate(spans)}
+
+        selected = []
+        tried = set()
+        remaining = self.max_tokens
+
+        def pick(i: int) -> bool:
+            nonlocal remaining
+            tried.add(i)
+            if tokens[i] > remaining:
+                return False
+            selected.append(i)
+            remaining -= tokens[i]
+            return True
+
+        # Ties go to the better ranked document, then to the earlier span
+        for i in sorted(range(len(spans)), key=lambda i: (-scores[i], spans[i][0], spans[i][1])):
+            if scores[i] > 0:
+                pick(i)
+
+        # Grows the picked passages by a span on each side at a time, around the best matches first
+        edge = list(selected)
+        while edge:
+            grown = []
+            for i in edge:
+                rank, position, _ = spans[i]
+                for j in (positions.get((rank, position - 1)), positions.get((rank, position + 1))):
+                    if j is not None and j not in tried and pick(j):
+                        grown.append(j)
+            edge = grown
+
+        for i in sorted(range(len(spans)), key=lambda i: (spans[i][0], spans[i][1])):
+            if i not in tried:
+                pick(i)
+        return sorted(spans[i] for i in selected)
+
+    def pack(self, query: str, docs: List[Document]) -> List[Document]:
+        """
+        Returns the documents to stuff into the prompt of query, most relevant first
+        """
+        retrieved_tokens = sum(self.count_tokens(doc.page_content) for doc in docs)
+        docs = self.deduplicate(docs)
+        tokens = [self.count_tokens(doc.page_content) for doc in docs]
+
+        if self.max_tokens and sum(tokens) > self.max_tokens:
+            spans = [(rank, position, text) for rank, doc in enumerate(docs)
+                     for position, text in enumerate(split_spans(doc.page_content, self.max_span_words))]
+            texts: Dict[int, List[Tuple[int, str]]] = {}
+            for rank, position, text in self._select(query, spans):
+                texts.setdefault(rank, []).append((position, text))
+
+            packed = []
+            for rank, doc in enumerate(docs):
+                if rank not in texts:
+                    continue
+                text = ''
+                last = None
+                for position, span in texts[rank]:
+                    if last is not None:
+                        text += ' ' if position == last + 1 else GAP
+                    text += span
+                    last = position
+                packed.append(Document(page_content=text, metadata=doc.metadata))
+            docs = packed
+            tokens = [self.count_tokens(doc.page_content) for doc in docs]
+
+        histogram = get_metrics().histogram(
+            'context_tokens', 'Tokens of the documents retrieved for a question and of the context packed from them',
+            TOKEN_BUCKETS)
+        histogram.observe(retrieved_tokens, stage='retrieved')
+        histogram.observe(sum(tokens), stage='packed')
+        logging.debug(f'Packed {retrieved_tokens} retrieved tokens into {sum(tokens)} tokens of context')
+        return docs
+
+    def as_retriever(self, retriever: BaseRetriever) -> 'PackedRetriever':
+        return PackedRetriever(retriever=retriever, packer=self)
+
+
+class PackedRetriever(BaseRetriever):
+    """
+    Packs the documents of another retriever into the token budget of a ContextPacker
+    """
+    retriever: BaseRetriever
+    packer: Any
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        docs = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        return self.packer.pack(query, docs)
+
+
+class PromptTokenCallbackHandler(BaseCallbackHandler):
+    """
+    Counts the tokens of the prompts a chain run sends to the LLM in the prompt_tokens histogram
+
+    Chat models pass their messages as one text, so their counts leave out the few tokens per message of the
+    chat format.
+    """
+
+    def __init__(self, packer: ContextPacker, llm_model_name: str) -> None:
+        self.packer = packer
+        self.llm_model_name = llm_model_name
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     **kwargs: Any) -> None:
+        histogram = get_metrics().histogram('prompt_tokens', 'Tokens of the prompts sent to the LLM', TOKEN_BUCKETS)
+        for prompt in prompts:
+            tokens = self.packer.count_tokens(prompt)
+            histogram.observe(tokens, model=self.llm_model_name)
+            logging.debug(f'Prompt of {tokens} tokens sent to {self.llm_model_name}')
@@ -0,0 +1,239 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+import logging
+
+import math
+
+import os
+
+import numpy as np
+
+from langchain.docstore import InMemoryDocstore
+from langchain.vectorstores import FAISS
+
+from utils.constants import IndexType
+from utils.metrics import span
+
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+
+
+class IndexOptions:
+    def __init__(self, k: Optional[int] = 3,
+                 hnsw_min_vectors: Optional[int] = 10000,
+                 ivfpq_min_vectors: Optional[int] = 100000,
+                 hnsw_m: Optional[int] = 32,
+                 ef_construction: Optional[int] = 80,
+                 ef_search: Optional[int] = 64,
+                 nprobe: Optional[int] = 16,
+                 refine_factor: Optional[int] = 16,
+                 threads: Optional[int] = None) -> None:
+        """
+        How FAISS indexes are built and searched, by the number of vectors they hold
+
+        Small transcripts get a flat index of exact searches. Long ones get an HNSW graph, which answers in
+        about a millisecond at a small loss of recall, and the longest an IVF-PQ index whose candidates are
+        re-ranked with 8 bit vectors, which takes under a third of the memory of a flat index.
+
+        Args:
+            k: Documents retrieved per question
+            hnsw_min_vectors: Vectors from which an HNSW index is built instead of a flat one
+            ivfpq_min_vectors: Vectors from which an IVF-PQ index is built instead of an HNSW one
+            hnsw_m: Neighbors per node of the HNSW graph
+            ef_construction: Candidates considered while building the HNSW graph
+            ef_search: Candidates considered per HNSW search, higher is slower with better recall
+            nprobe: Inverted lists scanned per IVF-PQ search, higher is slower with better recall
+            refine_factor: IVF-PQ candidates re-ranked per result, PQ distances alone miss many neighbors
+            threads: Threads building and training indexes. Defaults to one per core.
+        """
+        self.k = k
+        self.hnsw_min_vectors = hnsw_min_vectors
+        self.ivfpq_min_vectors = ivfpq_min_vectors
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.refine_factor = refine_factor
+        self.threads = threads
+
+    @staticmethod
+    def from_env() -> IndexOptions:
+        """
+        Options with the defaults overridden by the RETRIEVAL_K, FAISS_HNSW_MIN_VECTORS, FAISS_IVFPQ_MIN_VECTORS,
+        FAISS_EF_SEARCH, FAISS_NPROBE, FAISS_REFINE_FACTOR and FAISS_THREADS environment variables
+        """
+        options = IndexOptions()
+        for name, attribute in (('RETRIEVAL_K', 'k'), ('FAISS_HNSW_MIN_VECTORS', 'hnsw_min_vectors'),
+                                ('FAISS_IVFPQ_MIN_VECTORS', 'ivfpq_min_vectors'), ('FAISS_EF_SEARCH', 'ef_search'),
+                                ('FAISS_NPROBE', 'nprobe'), ('FAISS_REFINE_FACTOR', 'refine_factor'),
+                                ('FAISS_THREADS', 'threads')):
+            if value := os.environ.get(name):
+                setattr(options, attribute, int(value))
+        return options
+
+    def index_type(self, count: int) -> IndexType:
+        """
+        Type of index to build for count vectors
+        """
+        if count >= self.ivfpq_min_vectors:
+            return IndexType.IVF_PQ
+        if count >= self.hnsw_min_vectors:
+            return IndexType.HNSW
+        return IndexType.FLAT
+
+
+def index_type_of(index) -> IndexType:
+    import faiss
+
+    if hasattr(index, 'hnsw'):
+        return IndexType.HNSW
+    if faiss.try_extract_index_ivf(index) is not None:
+        return IndexType.IVF_PQ
+    return IndexType.FLAT
+
+
+def set_search_params(index, options: IndexOptions) -> None:
+    """
+    Applies the search parameters of options to an index, they are not all kept when an index is saved
+    """
+    import faiss
+
+    if hasattr(index, 'hnsw'):
+        # Fewer candidates than results would cut the results short
+        index.hnsw.efSearch = max(options.ef_search, options.k)
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+        ivf.nprobe = options.nprobe
+    if hasattr(index, 'k_factor'):
+        index.k_factor = options.refine_factor
+
+
+def pq_subquantizers(dimension: int) -> int:
+    """
+    Number of PQ sub-quantizers, one byte each, for vectors of a dimension: one per 8 dimensions where that divides
+    """
+    m = max(1, dimension // 8)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def build_index(vectors: np.ndarray, index_type: IndexType, options: IndexOptions,
+                float16: Optional[bool] = False):
+    """
+    Builds a FAISS index of a type over vectors, with search parameters applied
+
+    FAISS builds HNSW graphs and trains IVF-PQ indexes on all the threads of options.
+
+    Args:
+        vectors: float32 array of shape (count, dimension)
+        index_type: Type of index to build
+        options: Build and search parameters
+        float16: Store full vectors as float16 in flat and HNSW indexes
+    Returns:
+        index: The FAISS index, with vector i at position i
+    """
+    import faiss
+
+    faiss.omp_set_num_threads(options.threads or os.cpu_count() or 1)
+    count, dimension = vectors.shape
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    if index_type == IndexType.HNSW:
+        if float16:
+            index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, options.hnsw_m)
+        else:
+            index = faiss.IndexHNSWFlat(dimension, options.hnsw_m)
+        index.hnsw.efConstruction = options.ef_construction
+    elif index_type == IndexType.IVF_PQ:
+        # About 4 sqrt(n) lists, each with enough vectors to train its centroid
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        index = faiss.index_factory(dimension, f'IVF{nlist},PQ{pq_subquantizers(dimension)},Refine(SQ8)')
+        # Only speeds up Hamming distance filtering, which is not used, and takes most of the training time
+        faiss.downcast_index(index.base_index).do_polysemous_training = False
+        # k-means of the lists and the PQ codebooks are trained on a sample, 256 vectors per list is plenty
+        sample = vectors
+        if count > 256 * nlist:
+            sample = vectors[np.random.default_rng(0).choice(count, 256 * nlist, replace=False)]
+        index.train(sample)
+    elif float16:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+
+    index.add(vectors)
+    set_search_params(index, options)
+    return index
+
+
+def faiss_from_embeddings(text_embeddings: Iterable[Tuple[str, List[float]]], embeddings: Embeddings,
+                          metadatas: Optional[List[dict]] = None, float16: Optional[bool] = False) -> FAISS:
+    """
+    Builds a FAISS index of exact searches over embedded texts
+
+    Args:
+        text_embeddings: Texts with their vectors
+        embeddings: Model the queries are embedded with
+        metadatas: Metadata of each text
+        float16: Store the vectors as float16, halving the memory of the index. Search results barely
+                 change, the vectors of the embedding models agree to far fewer digits than float16 keeps.
+    Returns:
+        db: The index, with the texts in its docstore
+    """
+    text_embeddings = list(text_embeddings)
+    if not float16:
+        return FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
+
+    import faiss
+
+    # Needs no training, unlike the other scalar quantizers
+    index = faiss.IndexScalarQuantizer(len(text_embeddings[0][1]), faiss.ScalarQuantizer.QT_fp16)
+    db = FAISS(embeddings.embed_query, index, InMemoryDocstore({}), {})
+    db.add_embeddings(text_embeddings, metadatas=metadatas)
+    return db
+
+
+def rebuild_for_size(db: FAISS, options: IndexOptions, float16: Optional[bool] = False) -> bool:
+    """
+    Replaces the flat index of a complete transcript with the type of index options choose for its size
+
+    The vectors are read back from the flat index, so nothing is embedded again. The docstore and the
+    retrievers of db stay valid.
+
+    Returns:
+        rebuilt: Whether the index was replaced
+    """
+    index_type = options.index_type(db.index.ntotal)
+    if index_type == index_type_of(db.index):
+        return False
+
+    logging.info(f'Rebuilding the index of {db.index.ntotal} vectors as {index_type.value}')
+    with span('index_rebuild', type=index_type.value):
+        db.index = build_index(db.index.reconstruct_n(0, db.index.ntotal), index_type, options, float16)
+    return True
+
+
+def faiss_index_nbytes(index) -> int:
+    """
+    Approximate resident size of a FAISS index
+    """
+    import faiss
+
+    if hasattr(index, 'hnsw'):
+        storage = faiss.downcast_index(index.storage)
+        # Full vectors and the links of the bottom layer, upper layers hold few nodes
+        return index.ntotal * (getattr(storage, 'code_size', index.d * 4) + 4 * index.hnsw.nb_neighbors(0))
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+        refine = faiss.downcast_index(index.refine_index) if hasattr(index, 'refine_index') else None
+        # Codes and ids in the inverted lists and the re-ranking codes, plus the centroids of the lists
+        # and of the PQ codebooks
+        return (index.ntotal * (ivf.code_size + 8 + getattr(refine, 'code_size', 0))
+                + ivf.nlist * index.d * 4 + 256 * index.d * 4)
+    return index.ntotal * getattr(index, 'code_size', index.d * 4)
+
+
+def faiss_nbytes(db: FAISS) -> int:
+    """
+    Approximate resident size of the vectors of a FAISS index
+    """
+    return faiss_index_nbytes(db.index)
@@ -1,42 +1,110 @@
-
-
-from langchain import HuggingFaceHub
-from langchain.embeddings import HuggingFaceInstructEmbeddings
-
-
-import torch
+from typing import Optional
 
 import logging
 
+import os
+
 from query_handler.abstract_query_handler import AbstractQueryHandler
+from query_handler.cached_embeddings import CachedEmbeddings
 
-# Loading API Keys
+from utils.constants import EmbeddingRuntime, RetrievalMode
 
 
-import streamlit as st
+# torch, transformers and the Hugging Face token are only loaded when this handler is first used,
+# so sessions on the OpenAI path do not pay for them
 
-HUGGINGFACEHUB_API_TOKEN = st.secrets["HUGGINGFACEHUB_API_TOKEN"]
 
+def get_device() -> str:
+    """
+    Returns cuda if a GPU is available, else cpu
+    """
+    import torch
 
-# Check if GPU is available
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    return "cuda" if torch.cuda.is_available() else "cpu"
 
 
 class HuggingFaceQueryHandler(AbstractQueryHandler):
+    embedding_model_name = 'hkunlp/instructor-xl'
+    # Used in hybrid mode, where BM25 makes up for a smaller model
+    hybrid_embedding_model_name = 'sentence-transformers/all-MiniLM-L6-v2'
+    llm_model_name = 'tiiuae/falcon-7b-instruct'
+    # The hosted inference API rate limits aggressively
+    max_concurrent_queries = 2
+    max_queued_queries = 16
+
+    def __init__(self, with_llm: Optional[bool] = True,
+                 retrieval_mode: Optional[RetrievalMode] = RetrievalMode.VECTOR,
+                 embedding_runtime: Optional[EmbeddingRuntime] = EmbeddingRuntime.TORCH,
+                 onnx_model_dir: Optional[str] = None):
+        """
+        Args:
+            with_llm: Whether to load the LLM
+            retrieval_mode: How the transcript is searched, see AbstractQueryHandler
+            embedding_runtime: torch runs the embedding model in full precision, onnx runs an int8 export of it
+                               made with utils.export_onnx_embeddings
+            onnx_model_dir: Folder of the export. Defaults to the ONNX_EMBEDDING_MODEL environment variable,
+                            then to models/<model>-onnx-int8.
+        """
+        if RetrievalMode(retrieval_mode) == RetrievalMode.HYBRID:
+            self.embedding_model_name = self.hybrid_embedding_model_name
+        self.embedding_runtime = EmbeddingRuntime(embedding_runtime)
+        if self.embedding_runtime == EmbeddingRuntime.ONNX:
+            from query_handler.onnx_embeddings import default_onnx_dir
+
+            self.onnx_model_dir = (onnx_model_dir or os.environ.get('ONNX_EMBEDDING_MODEL')
+                                   or default_onnx_dir(self.embedding_model_name))
+            # The int8 vectors differ slightly, so they get their own embedding cache and index keys.
+            # At that precision float16 storage loses nothing more.
+            self.embedding_model_name = f'{self.embedding_model_name}-onnx-int8'
+            self.index_float16 = True
+        super().__init__(with_llm, retrieval_mode)
+
     def load_embeddings(self):
+        if self.embedding_runtime == EmbeddingRuntime.ONNX:
+            from query_handler.onnx_embeddings import OnnxEmbeddings
+
+            # Batched by OnnxEmbeddings itself, sorted by length, and parallel within each batch.
+            # ONNX_THREADS limits the threads, e.g. when other processes share the machine
+            threads = int(os.environ.get('ONNX_THREADS', 0)) or None
+            self.embeddings = CachedEmbeddings(
+                OnnxEmbeddings(self.onnx_model_dir, intra_op_threads=threads),
+                model_name=self.embedding_model_name,
+                batch_size=256,
+                max_concurrency=1,
+            )
+            return
+
+        from langchain.embeddings import HuggingFaceEmbeddings, HuggingFaceInstructEmbeddings
+
         logging.debug('Loading HuggingFace Instruct Embeddings')
-        self.embeddings = HuggingFaceInstructEmbeddings(
-            model_name='hkunlp/instructor-xl',
-            model_kwargs={"device": DEVICE},
+        # Instructor models take an instruction with each text, sentence-transformers models do not
+        embeddings_class = (HuggingFaceInstructEmbeddings if self.embedding_model_name.startswith('hkunlp/instructor')
+                            else HuggingFaceEmbeddings)
+        # Large batches, the local model runs best with a few big calls on one thread
+        self.embeddings = CachedEmbeddings(
+            embeddings_class(
+                model_name=self.embedding_model_name,
+                model_kwargs={"device": get_device()},
+            ),
+            model_name=self.embedding_model_name,
+            batch_size=64,
+            max_concurrency=1,
         )
         logging.debug('Loading HuggingFace Instruct Embeddings')
 
     def load_llm(self):
+        from query_handler.streaming import StreamingHuggingFaceHub
+
+        # Loading API Keys
+        import streamlit as st
+
         logging.debug('Loading Falcon LLM')
-        self.falcon_llm = HuggingFaceHub(
-            repo_id='tiiuae/falcon-7b-instruct',
+        # Streams tokens through the callbacks, for stream_query
+        self.falcon_llm = StreamingHuggingFaceHub(
+            repo_id=self.llm_model_name,
             model_kwargs={"temperature": 0.1,
                           "max_new_tokens": 500, "use_cache": False},
+            huggingfacehub_api_token=st.secrets["HUGGINGFACEHUB_API_TOKEN"],
 
         )
         logging.debug('Loaded Falcon LLM')
@@ -0,0 +1,211 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import hashlib
+
+import logging
+
+import os
+
+import pickle
+
+import shutil
+
+import threading
+
+import uuid
+
+import weakref
+
+from langchain.vectorstores import FAISS
+
+from query_handler.bm25 import BM25Index, HybridIndex
+
+if TYPE_CHECKING:
+    from langchain.embeddings.base import Embeddings
+    from langchain.schema import Document
+
+
+class IndexKey:
+    def __init__(self, model_name: str) -> None:
+        """
+        Content address of a transcript for a given embedding model, updated as documents arrive
+
+        Args:
+            model_name: Name of the embedding model the index is built with
+        """
+        self.digest = hashlib.sha256(model_name.encode())
+
+    def update(self, docs: List[Document]) -> None:
+        for doc in docs:
+            self.digest.update(b'\0')
+            self.digest.update(doc.page_content.encode())
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+def index_key(docs: List[Document], model_name: str) -> str:
+    """
+    Content address of a transcript for a given embedding model
+
+    Args:
+        docs: Transcribed documents
+        model_name: Name of the embedding model the index is built with
+    Returns:
+        key: Hex digest of the transcript text and the model name
+    """
+    key = IndexKey(model_name)
+    key.update(docs)
+    return key.hexdigest()
+
+
+class IndexStore:
+    def __init__(self, root: Optional[str] = 'cache/indexes',
+                 max_bytes: Optional[int] = 2 * 1024 * 1024 * 1024) -> None:
+        """
+        On disk store of built FAISS, BM25 and hybrid indexes, shared by all sessions in the process
+
+        Args:
+            root: Directory the indexes are saved in, one folder per index key
+            max_bytes: Least recently used indexes are deleted once the store exceeds this size on disk
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        # Indexes already loaded by some session, handed out read-only instead of being loaded again
+        self.loaded = weakref.WeakValueDictionary()
+
+    def _folder(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    @staticmethod
+    def _load_faiss(folder: str, embeddings: Embeddings) -> FAISS:
+        """
+        Loads a saved FAISS index, memory mapping the index file where FAISS supports it so sessions share its pages
+        """
+        import faiss
+
+        index_path = os.path.join(folder, 'index.faiss')
+        try:
+            index = faiss.read_index(
+                index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type can be memory mapped
+            index = faiss.read_index(index_path)
+
+        with open(os.path.join(folder, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        return FAISS(embeddings.embed_query, index,
+                     docstore, index_to_docstore_id)
+
+    def load(self, key: str, embeddings: Optional[Embeddings]) -> Optional[Union[FAISS, BM25Index, HybridIndex]]:
+        """
+        Returns a previously built index, or None if it is not in the store
+
+        Args:
+            key: Key the index was saved under
+            embeddings: Embeddings of the query handler, None for BM25 indexes
+        """
+        with self.lock:
+            if (db := self.loaded.get(key)) is not None:
+                return db
+
+            folder = self._folder(key)
+            if not os.path.isdir(folder):
+                return None
+
+            if not os.path.exists(os.path.join(folder, 'bm25.pkl')):
+                db = self._load_faiss(folder, embeddings)
+            elif os.path.exists(os.path.join(folder, 'index.faiss')):
+                db = HybridIndex(self._load_faiss(folder, embeddings), BM25Index.load_local(folder))
+            else:
+                db = BM25Index.load_local(folder)
+            self.loaded[key] = db
+
+            # Mark as recently used for eviction
+            os.utime(folder)
+            logging.debug(f'Loaded index {key} from the index store')
+            return db
+
+    def save(self, key: str, db: Union[FAISS, BM25Index, HybridIndex]) -> None:
+        """
+        Saves a built index under key and evicts old indexes if the store is over budget
+        """
+        with self.lock:
+            folder = self._folder(key)
+            if not os.path.isdir(folder):
+                # Write to a temporary folder first so other processes never see a partial index
+                temporary = os.path.join(self.root, f'.{key}.{uuid.uuid4().hex}')
+                db.save_local(temporary)
+                try:
+                    os.replace(temporary, folder)
+                    # Sessions loading the index from now on share this copy
+                    self.loaded.setdefault(key, db)
+                except OSError:
+                    # Saved by another process in the meantime
+                    shutil.rmtree(temporary, ignore_errors=True)
+
+            self._evict()
+
+    def _link_path(self, alias: str) -> str:
+        # A file rather than a folder, so eviction leaves it alone
+        return os.path.join(self.root, f'{alias}.link')
+
+    def link(self, alias: str, key: str) -> None:
+        """
+        Makes an index also found under another key, such as the hash of the audio it was transcribed from
+        """
+        temporary = os.path.join(self.root, f'.{alias}.{uuid.uuid4().hex}')
+        with open(temporary, 'w') as f:
+            f.write(key)
+        os.replace(temporary, self._link_path(alias))
+
+    def resolve(self, alias: str) -> Optional[str]:
+        """
+        Returns the key linked to alias, or None. The index itself may have been evicted since.
+        """
+        try:
+            with open(self._link_path(alias)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _evict(self) -> None:
+        """
+        Deletes least recently used indexes until the store is within max_bytes. Caller holds the lock.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            folder = self._folder(name)
+            if name.startswith('.') or not os.path.isdir(folder):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(folder))
+            entries.append((os.stat(folder).st_mtime, size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # Memory mapped copies stay valid for sessions still using them
+            shutil.rmtree(self._folder(name), ignore_errors=True)
+            self.loaded.pop(name, None)
+            total -= size
+            logging.debug(f'Evicted index {name} from the index store')
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_index_store() -> IndexStore:
+    """
+    Returns the index store shared by every query handler in the process
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = IndexStore()
+        return _store
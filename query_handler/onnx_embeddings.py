@@ -0,0 +1,167 @@
+from typing import List, Optional
+
+import json
+
+import logging
+
+import os
+
+import numpy as np
+
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.huggingface import DEFAULT_EMBED_INSTRUCTION, DEFAULT_QUERY_INSTRUCTION
+
+
+# Files of an exported model, written by utils.export_onnx_embeddings
+MODEL_FILE = 'model.int8.onnx'
+CONFIG_FILE = 'config.json'
+HEAD_FILE = 'head.npz'
+TOKENIZER_FILE = 'tokenizer.json'
+
+
+def default_onnx_dir(model_name: str) -> str:
+    """
+    Folder an exported model is looked for in when no folder is given
+    """
+    return os.path.join('models', f'{model_name.split("/")[-1]}-onnx-int8')
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, folder: str,
+                 intra_op_threads: Optional[int] = None,
+                 inter_op_threads: Optional[int] = 1,
+                 max_batch_size: Optional[int] = 64,
+                 max_batch_tokens: Optional[int] = 16384,
+                 embed_instruction: Optional[str] = DEFAULT_EMBED_INSTRUCTION,
+                 query_instruction: Optional[str] = DEFAULT_QUERY_INSTRUCTION) -> None:
+        """
+        Sentence-transformers or Instructor model exported to ONNX with int8 weights, run with onnxruntime on the CPU
+
+        Needs neither torch nor transformers. Texts are sorted by length and batched up to a number of tokens,
+        so batches of short texts are large and little time is spent on padding.
+
+        Args:
+            folder: Folder written by utils.export_onnx_embeddings
+            intra_op_threads: Threads one batch is computed with. Defaults to one per core.
+            inter_op_threads: Threads running independent operators of the graph at once
+            max_batch_size: Most texts per batch
+            max_batch_tokens: Most tokens per batch, padding included
+            embed_instruction: Instruction documents are embedded with, for Instructor models
+            query_instruction: Instruction queries are embedded with, for Instructor models
+        Raises:
+            ValueError: If onnxruntime or tokenizers is not installed or the folder is not an exported model
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ValueError(
+                "onnxruntime package not found, please install it with "
+                "`pip install onnxruntime`"
+            )
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ValueError(
+                "tokenizers package not found, please install it with "
+                "`pip install tokenizers`"
+            )
+
+        if not os.path.exists(os.path.join(folder, MODEL_FILE)):
+            raise ValueError(f'No exported model in {folder}, export one with '
+                             f'`python -m utils.export_onnx_embeddings <model> --output {folder}`')
+
+        with open(os.path.join(folder, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        head = np.load(os.path.join(folder, HEAD_FILE))
+        self.dense_weight = head['weight'] if 'weight' in head else None
+        self.dense_bias = head['bias'] if 'bias' in head else None
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(folder, TOKENIZER_FILE))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(self.config['max_seq_length'])
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        logging.info(f'Loading ONNX embeddings of {self.config["model_name"]} from {folder} '
+                     f'with {options.intra_op_num_threads} threads')
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(folder, MODEL_FILE), options, providers=['CPUExecutionProvider'])
+
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.embed_instruction = embed_instruction if self.config['instructor'] else ''
+        self.query_instruction = query_instruction if self.config['instructor'] else ''
+
+    def _instruction_length(self, instruction: str) -> int:
+        """
+        Number of leading tokens of the instruction, left out of the pooling as the Instructor models do
+        """
+        if not instruction:
+            return 0
+        # Without the end of sequence token the tokenizer appends
+        return len(self.tokenizer.encode(instruction.strip()).ids) - 1
+
+    def _batches(self, lengths: List[int]) -> List[List[int]]:
+        """
+        Groups the positions of texts, shortest first, into batches within max_batch_size and max_batch_tokens
+        """
+        batches = []
+        batch = []
+        for position in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # Sorted by length, so the batch is padded to the length of the text being added
+            if batch and (len(batch) == self.max_batch_size
+                          or (len(batch) + 1) * lengths[position] > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(position)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _embed(self, instruction: str, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.config['dimension']), dtype=np.float32)
+
+        encodings = self.tokenizer.encode_batch([instruction.strip() + text.strip() for text in texts])
+        instruction_length = self._instruction_length(instruction)
+        lengths = [len(encoding.ids) for encoding in encodings]
+
+        vectors = np.zeros((len(texts), self.config['dimension']), dtype=np.float32)
+        for batch in self._batches(lengths):
+            length = max(lengths[position] for position in batch)
+            input_ids = np.full((len(batch), length), self.config['pad_token_id'], dtype=np.int64)
+            attention_mask = np.zeros((len(batch), length), dtype=np.int64)
+            for row, position in enumerate(batch):
+                input_ids[row, :lengths[position]] = encodings[position].ids
+                attention_mask[row, :lengths[position]] = 1
+
+            hidden = self.session.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+
+            pooling_mask = attention_mask.astype(np.float32)
+            pooling_mask[:, :instruction_length] = 0
+            if self.config['pooling'] == 'cls':
+                pooled = hidden[:, 0]
+            else:
+                pooled = ((hidden * pooling_mask[..., None]).sum(axis=1)
+                          / np.maximum(pooling_mask.sum(axis=1, keepdims=True), 1e-9))
+
+            if self.dense_weight is not None:
+                pooled = pooled @ self.dense_weight.T
+                if self.dense_bias is not None:
+                    pooled += self.dense_bias
+                if self.config['dense_activation'] == 'tanh':
+                    pooled = np.tanh(pooled)
+            if self.config['normalize']:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+            vectors[batch] = pooled
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(self.embed_instruction, texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(self.query_instruction, [text])[0].tolist()
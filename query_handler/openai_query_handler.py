@@ -2,30 +2,48 @@
 import logging
 
 
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-
-
 from query_handler.abstract_query_handler import AbstractQueryHandler
+from query_handler.cached_embeddings import CachedEmbeddings
+
+from utils.constants import RetrievalMode
 
 from typing import Optional
 
 
 class OpenAIQueryHandler(AbstractQueryHandler):
-    def __init__(self, api_key: Optional[str] = None):
+    embedding_model_name = 'text-embedding-ada-002'
+    llm_model_name = 'gpt-3.5-turbo'
+    max_concurrent_queries = 8
+    max_queued_queries = 32
+
+    def __init__(self, api_key: Optional[str] = None, with_llm: Optional[bool] = True,
+                 retrieval_mode: Optional[RetrievalMode] = RetrievalMode.VECTOR):
         self.openai_api_key = api_key
-        super().__init__()
+        super().__init__(with_llm, retrieval_mode)
 
     def load_embeddings(self):
+        from langchain.embeddings import OpenAIEmbeddings
+
         logging.debug('Loading OpenAI Embeddings')
-        self.embeddings = OpenAIEmbeddings(openai_api_key=self.openai_api_key)
+        # Smaller batches sent concurrently, the API is latency bound
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(
+                model=self.embedding_model_name, openai_api_key=self.openai_api_key),
+            model_name=self.embedding_model_name,
+            batch_size=100,
+            max_concurrency=4,
+        )
         logging.debug('Loading OpenAI Embeddings')
 
     def load_llm(self):
+        from langchain.chat_models import ChatOpenAI
+
         logging.debug('Loading GPT LLM')
         self.falcon_llm = ChatOpenAI(
-            model_name='gpt-3.5-turbo',
+            model_name=self.llm_model_name,
             temperature=0,
-            openai_api_key=self.openai_api_key
+            openai_api_key=self.openai_api_key,
+            # Tokens are passed to the callbacks as they arrive, for stream_query
+            streaming=True,
         )
         logging.debug('Loaded GPT LLM')
@@ -0,0 +1,125 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Union
+
+from collections import OrderedDict
+
+import logging
+
+import threading
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+if TYPE_CHECKING:
+    from query_handler.bm25 import BM25Index, HybridIndex
+    from query_handler.index_store import IndexKey
+    from langchain.chains import RetrievalQA
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.vectorstores import FAISS
+
+
+class RetrievalSession:
+    def __init__(self, memory: ConversationBufferWindowMemory) -> None:
+        """
+        Retrieval state of a single user session
+
+        The index can be dropped to free memory, index_key is kept so it can be loaded again from the index store.
+
+        Args:
+            memory: Chat memory of this session
+        """
+        self.memory = memory
+        self.index_key: Optional[str] = None
+        # Key of a transcript whose index is still being built, see AbstractQueryHandler.add_documents
+        self.pending_key: Optional[IndexKey] = None
+        self.db: Optional[Union[FAISS, BM25Index, HybridIndex]] = None
+        self.qa_chain: Optional[RetrievalQA] = None
+        self.lock = threading.Lock()
+
+    def unload(self) -> None:
+        self.db = None
+        self.qa_chain = None
+
+
+class LockedRetriever(BaseRetriever):
+    """
+    Searches another retriever holding a session lock, so an index is not searched while documents are added to it
+
+    Only the search holds the lock, the LLM a chain runs on the documents does not.
+    """
+    retriever: BaseRetriever
+    lock: Any
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with self.lock:
+            return self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+
+
+def index_nbytes(db: Union[FAISS, BM25Index, HybridIndex]) -> int:
+    """
+    Approximate resident size of an index
+    """
+    from query_handler.faiss_index import faiss_nbytes
+
+    if hasattr(db, 'nbytes'):
+        return db.nbytes()
+    return faiss_nbytes(db)
+
+
+class SessionManager:
+    def __init__(self, max_bytes: Optional[int] = 1024 * 1024 * 1024,
+                 max_sessions: Optional[int] = 1000) -> None:
+        """
+        Keeps the retrieval sessions of all users, evicting the indexes of inactive sessions
+
+        Args:
+            max_bytes: Indexes of least recently used sessions are unloaded once loaded indexes exceed this size
+            max_sessions: Least recently used sessions are forgotten entirely beyond this count
+        """
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict[str, RetrievalSession] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str,
+            memory_factory: Callable[[], ConversationBufferWindowMemory]) -> RetrievalSession:
+        """
+        Returns the session with the given id, creating it with a new memory if needed, and marks it as recently used
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = RetrievalSession(memory_factory())
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+
+    def evict(self) -> None:
+        """
+        Unloads indexes of least recently used sessions until loaded indexes fit in max_bytes
+
+        Indexes shared by several sessions are counted once, the most recently used session and indexes
+        still being built are never evicted.
+        """
+        with self.lock:
+            sizes = {}
+            for session in self.sessions.values():
+                if session.db is not None:
+                    sizes[id(session.db)] = index_nbytes(session.db)
+
+            total = sum(sizes.values())
+            sessions = list(self.sessions.items())[:-1]
+            for session_id, session in sessions:
+                if total <= self.max_bytes:
+                    break
+                # Indexes still being built cannot be loaded again from the store
+                if session.db is None or session.pending_key is not None:
+                    continue
+
+                db_id = id(session.db)
+                session.unload()
+                # Only frees memory once no other session uses the same index
+                if not any(other.db is not None and id(other.db) == db_id for other in self.sessions.values()):
+                    total -= sizes[db_id]
+                logging.debug(f'Unloaded index of inactive session {session_id}')
@@ -0,0 +1,53 @@
+from typing import Any, Dict, List, Optional
+
+import queue
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+
+class TokenQueueCallbackHandler(BaseCallbackHandler):
+    """
+    Puts every new token generated by the LLM on a queue, so another thread can render it as it arrives
+    """
+
+    def __init__(self, tokens: queue.Queue) -> None:
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.put(token)
+
+
+class StreamingHuggingFaceHub(LLM):
+    """
+    Hugging Face Hub text generation LLM that streams tokens through the callbacks
+
+    Same parameters as langchain's HuggingFaceHub, which only returns the answer once it is complete.
+    """
+    repo_id: str
+    model_kwargs: Dict[str, Any] = {}
+    huggingfacehub_api_token: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'streaming_huggingface_hub'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        from huggingface_hub import InferenceClient
+
+        client = InferenceClient(model=self.repo_id, token=self.huggingfacehub_api_token)
+        parameters = {key: value for key, value in {**self.model_kwargs, **kwargs}.items()
+                      if key in ('temperature', 'max_new_tokens', 'top_p', 'top_k', 'repetition_penalty')}
+
+        text = ''
+        for token in client.text_generation(prompt, stream=True, stop_sequences=stop or [], **parameters):
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            text += token
+
+        # Cut the answer at the first stop sequence, as HuggingFaceHub does
+        for sequence in stop or []:
+            text = text.split(sequence)[0]
+        return text
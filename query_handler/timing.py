@@ -0,0 +1,60 @@
+from typing import Any, Dict, List
+
+import threading
+
+import time
+
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from utils.metrics import get_metrics, observe_stage
+
+
+class StageTimingCallbackHandler(BaseCallbackHandler):
+    """
+    Times the retriever and LLM calls of a chain run as the retrieval and llm pipeline stages
+
+    Passed to the chain when it is run, so the retriever and LLM inherit it.
+    """
+
+    def __init__(self, llm_model_name: str) -> None:
+        self.llm_model_name = llm_model_name
+        self.starts: Dict[UUID, float] = {}
+        self.lock = threading.Lock()
+
+    def _start(self, run_id: UUID) -> None:
+        with self.lock:
+            self.starts[run_id] = time.perf_counter()
+
+    def _finish(self, run_id: UUID, stage: str, failed: bool, **labels: str) -> None:
+        with self.lock:
+            start = self.starts.pop(run_id, None)
+        if start is None:
+            return
+        observe_stage(stage, time.perf_counter() - start, **labels)
+        if failed:
+            get_metrics().counter('stage_errors_total', 'Failed runs of pipeline stages').inc(stage=stage, **labels)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, **kwargs: Any) -> None:
+        # Retrievers run by another retriever, as by the hybrid retriever, are part of its run
+        with self.lock:
+            if kwargs.get('parent_run_id') in self.starts:
+                return
+        self._start(run_id)
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, 'retrieval', False)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, 'retrieval', True)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, 'llm', False, model=self.llm_model_name)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, 'llm', True, model=self.llm_model_name)
@@ -1,8 +1,5 @@
-
-from typing import Iterable, Iterator, List, Optional
-
-import openai
-import io
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from langchain.document_loaders.base import BaseBlobParser
 from langchain.document_loaders.blob_loaders import YoutubeAudioLoader
@@ -12,20 +9,34 @@ from langchain.schema import Document
 
 from pydub import AudioSegment
 
+import json
+
 import logging
 
 import os
 
-from math import ceil
+import threading
 
-import speech_recognition as sr
+from math import ceil
 
 from datetime import timedelta
 
-from utils.constants import Language
+from speech_tools.local_whisper_engine import LocalWhisperEngine
+from speech_tools.decoding import SAMPLE_RATE, SAMPLE_WIDTH, probe_duration, iter_pcm_windows, \
+    mute_ranges
+from speech_tools.resilient_recognizer import ResilientRecognizer, get_circuit_breaker
+from speech_tools.segmentation import SilenceSegmenter
+from speech_tools.transcription_cache import TranscriptionCache, chunk_key
+from speech_tools.whisper_engine import WhisperEngine
+from speech_tools.youtube import GrowingFile, fetch_skip_ranges, parse_video_id
 
-# To use secrets
-import streamlit as st
+from utils.constants import ASREngine, Language
+from utils.concurrency import ordered_async_map, ordered_map
+from utils.metrics import get_metrics, span, timed_iter
+
+# openai, speech_recognition and streamlit are imported where they are used, so importing this module stays cheap
+if TYPE_CHECKING:
+    import speech_recognition as sr
 
 
 AudioSegment.ffmpeg = 'ffmpeg.exe'
@@ -46,78 +57,312 @@ def format_time(millis: int) -> str:
     return str(timedelta(seconds=millis/1000))
 
 
+class StreamingBlob(Blob):
+    """
+    Blob of an audio file that may still be downloading
+
+    Parsers decode it while the download is in progress, using the duration reported by the source
+    since the file cannot be probed before it is complete.
+    """
+    # Duration of the audio in milliseconds, probed from the file if None
+    duration_ms: Optional[int] = None
+    # Start and end times in milliseconds of audio to leave out, e.g. sponsor segments
+    skip_ranges: List[Tuple[int, int]] = []
+    # The download writing the file, None once the file is complete
+    download: Optional[Any] = None
+    # Whether the container can be decoded front to back while downloading
+    streamable: bool = True
+
+
+def count_chunk(engine: str, outcome: str) -> None:
+    """
+    Counts a transcribed chunk by engine and outcome, one of cached, transcribed, not_understood and failed
+    """
+    get_metrics().counter('chunks_total', 'Chunks of audio by speech recognition outcome').inc(
+        engine=engine, outcome=outcome)
+
+
+def blob_duration(blob: Blob) -> int:
+    """
+    Duration of the audio of a blob in milliseconds
+    """
+    if isinstance(blob, StreamingBlob):
+        if blob.duration_ms is not None:
+            return blob.duration_ms
+        if blob.download is not None:
+            # Not reported by the source, so the file has to be complete to be probed
+            blob.download.wait()
+    return probe_duration(blob.path)
+
+
+def blob_windows(blob: Blob, window_ms: int) -> Iterator[Tuple[int, bytes]]:
+    """
+    Decodes the audio of a blob one window at a time, see iter_pcm_windows
+
+    Blobs still downloading are decoded from the bytes downloaded so far, skip ranges are muted.
+    """
+    if not isinstance(blob, StreamingBlob):
+        return iter_pcm_windows(blob.path, window_ms)
+
+    if blob.download is None:
+        windows = iter_pcm_windows(blob.path, window_ms)
+    elif blob.streamable:
+        windows = iter_pcm_windows(blob.download.iter_bytes(), window_ms)
+    else:
+        # Containers with their index at the end have to be complete to be decoded
+        blob.download.wait()
+        windows = iter_pcm_windows(blob.path, window_ms)
+
+    return mute_ranges(windows, blob.skip_ranges) if blob.skip_ranges else windows
+
+
 class WhisperParser(BaseBlobParser):
-    def __init__(self, api_key: str, save_dir: str, language: Optional[Language] = Language.US_English) -> None:
+    def __init__(self, api_key: str, save_dir: str, language: Optional[Language] = Language.US_English,
+                 cache: Optional[TranscriptionCache] = None,
+                 api_base: Optional[str] = None,
+                 max_concurrency: Optional[int] = 4) -> None:
+        """
+        Initializes the Whisper API parser
+
+        Args:
+            api_key: OpenAI API key
+            save_dir: Prefix of the names chunks are uploaded under
+            language: The language of the audio
+            cache: Cache of previously transcribed chunks. Chunks found here are not uploaded.
+            api_base: Base URL of the OpenAI API, defaults to the public API
+            max_concurrency: Maximum number of chunks uploaded at once
+        """
         self.api_key = api_key
         # Directory to save the chunks in
         self.save_dir = save_dir
         self.language = language
-        self.api_key = api_key
-        st.secrets["OPENAI_API_KEY"] = api_key
+        # Previously transcribed chunks are reused from here
+        self.cache = cache
+        self.engine = WhisperEngine(api_key, language, api_base=api_base,
+                                    max_concurrency=max_concurrency)
+
+    async def _transcribe_chunk(self, chunk: Tuple[memoryview, dict]) -> Document:
+        """
+        Transcribes one chunk with the Whisper API. Runs on the event loop of ordered_async_map.
+
+        Args:
+            chunk: Tuple of the raw PCM of the chunk and its metadata
+        Returns:
+            document: Document with the transcribed text, or empty text and an error message
+        """
+        from openai.error import APIConnectionError, APIError, RateLimitError, \
+            ServiceUnavailableError, Timeout, TryAgain
+
+        pcm, metadata = chunk
+        start_time, end_time = metadata['start_time'], metadata['end_time']
+
+        key = chunk_key(pcm, str(self.language.value), self.engine.model)
+        if self.cache is not None and (text := self.cache.get(key)) is not None:
+            count_chunk('whisper', 'cached')
+            return Document(page_content=text, metadata=metadata)
+
+        logging.debug(f"Transcribing part {metadata['chunk']}!")
+        try:
+            with span('recognition', engine='whisper'):
+                text = await self.engine.transcribe(bytes(pcm), f"{self.save_dir}/chunk{metadata['chunk']}")
+        except (APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain) as e:
+            # Still failing after all retries, or rejected by the API, the other chunks are kept
+            logging.exception(
+                f"Could not transcribe the audio from {format_time(start_time)} to {format_time(end_time)}")
+            metadata['error_message'] = f"Could not request results from the Whisper API: {e}"
+            count_chunk('whisper', 'failed')
+            return Document(page_content='', metadata=metadata)
+
+        if self.cache is not None:
+            self.cache.put(key, text)
+        count_chunk('whisper', 'transcribed')
+        return Document(page_content=text, metadata=metadata)
+
+    def _split_chunks(self, blob: Blob) -> Iterator[Tuple[memoryview, dict]]:
+        """
+        Splits the audio into chunks that fit the upload limit and yields the raw PCM of each chunk with its metadata
+        """
+        max_chunk_ms = self.engine.max_chunk_ms
+
+        # Duration from container or download metadata, the audio itself is streamed one chunk at a time.
+        # Chunks end in pauses and silence is skipped, so total_chunks is an estimate
+        total_duration = blob_duration(blob)
+        total_chunks = ceil(total_duration/max_chunk_ms)
+
+        logging.info(
+            f'Audio has a total duration of {total_duration/60000} minutes')
+        logging.info(f'Audio split into about {total_chunks} chunks')
+
+        # Split the audio into chunks of at most max_chunk_ms, cut in pauses with the silence left out
+        # Chunk export time includes decoding the windows the chunk is cut from
+        segmenter = SilenceSegmenter(max_chunk_ms=max_chunk_ms)
+        segments = timed_iter(segmenter.split(timed_iter(blob_windows(blob, max_chunk_ms), 'decode')),
+                              'chunk_export')
+        for chunk_number, (start_time, end_time, pcm) in enumerate(segments, start=1):
+            metadata = {'start_time': start_time, 'end_time': end_time,
+                        'source': blob.source, 'chunk': chunk_number, 'error_message': '',
+                        'total_duration': total_duration, 'total_chunks': total_chunks}
+
+            yield pcm, metadata
 
     def lazy_parse(self, blob: Blob) -> Iterator[Document]:
-        # Set the API key if provided
-        if self.api_key:
-            openai.api_key = self.api_key
+        """
+        Returns a generator of documents
 
-        # Audio file from disk
-        audio = AudioSegment.from_file(blob.path)
+        Chunks are encoded to low bitrate Opus and up to max_concurrency of them are uploaded at once,
+        documents are still yielded in chunk order.
 
-        # Define the duration of each chunk in minutes
-        # Need to meet 25MB size limit for Whisper API
-        chunk_duration = 20
-        chunk_duration_ms = chunk_duration * 60 * 1000
+        Args:
+            blob:   Blobs yielded by a DocumentLoader
 
-        total_duration = len(audio)
-        total_chunks = ceil(total_duration/chunk_duration)
+        Yields:
+            document: where each document contains page_content and metadata(start_time , end_time and chunk_number)
+        """
+        import openai
 
-        # Split the audio into chunk_duration_ms chunks
-        for split_number, start_time in enumerate(range(0, len(audio), chunk_duration_ms)):
-            # Audio chunk
-            end_time = start_time + chunk_duration_ms
-            chunk = audio[start_time: end_time]
-            file_obj = io.BytesIO(chunk.export(format="mp3").read())
-            if blob.source is not None:
-                file_obj.name = f"{self.save_dir}/chunk{split_number}.mp3"
-            else:
-                file_obj.name = f"{self.save_dir}/chunk{split_number}.mp3"
-
-            # Transcribe
-            logging.debug(f"Transcribing part {split_number+1}!")
-            transcript = openai.Audio.transcribe("whisper-1",
-                                                 file_obj,
-                                                 prompt=f"Transcribe this audio in the following language:{self.language.name}")
-
-            yield Document(
-                page_content=transcript.text,
-                metadata={"source": blob.source, "chunk": split_number,
-                          "start_time": start_time, "end_time": end_time,
-                          'error_message': '', 'total_duration': total_duration,
-                          'total_chunks': total_chunks},
-            )
+        # Set the API key if provided
+        if self.api_key:
+            openai.api_key = self.api_key
+
+        yield from ordered_async_map(self._transcribe_chunk,
+                                     self._split_chunks(blob),
+                                     max_pending=self.engine.max_concurrency)
 
 
 class SpeechRecognitionParser(BaseBlobParser):
     def __init__(self, language: Optional[Language] = Language.US_English,
-                 save_dir: Optional[str] = "audio-chunks",
-                 converter_path: Optional[str] = 'ffmpeg.exe') -> None:
+                 converter_path: Optional[str] = 'ffmpeg.exe',
+                 max_workers: Optional[int] = 4,
+                 cache: Optional[TranscriptionCache] = None,
+                 timeout: Optional[float] = 10.0,
+                 max_retries: Optional[int] = 3,
+                 endpoint: Optional[str] = None) -> None:
         """
         Initializes speech recognition module
 
         Args:
             language: The transcribed text will be in this language.
-            save_dir: The directory to save audio chunks in.
             converter_path: Path to ffmpeg converter.
+            max_workers: Maximum number of chunks sent to the recognizer at once. Lower it to stay within rate limits.
+            cache: Cache of previously transcribed chunks. Chunks found here are not sent to the recognizer.
+            timeout: Maximum seconds to wait for the recognizer to answer a chunk, before retrying it
+            max_retries: Number of times a chunk is retried after the recognizer failed or timed out
+            endpoint: URL of the recognition API, e.g. the stand-in server of utils.fake_speech_server.
+                      Defaults to the Google Speech Recognition API.
         """
+        import speech_recognition as sr
+
         self.recognizer = sr.Recognizer()
+        # Bounds every request, including hedged ones whose answer is no longer awaited
+        self.recognizer.operation_timeout = timeout
         self.language = language
         AudioSegment.converter = converter_path
-        self.save_dir = save_dir
+        self.max_workers = max_workers
+        self.cache = cache
+        self.endpoint = endpoint
+        # Room for a request that timed out besides the one retrying it, and for one hedged request, per chunk
+        # in flight. The circuit breaker of the service is shared with every other transcription.
+        self.resilient_recognizer = ResilientRecognizer(self._recognize_once, timeout=timeout,
+                                                        max_retries=max_retries,
+                                                        max_workers=2 * max_workers,
+                                                        max_hedges=max_workers,
+                                                        breaker=get_circuit_breaker(endpoint or 'google'))
+
+    def _recognize_once(self, sound: sr.AudioData) -> str:
+        # Only newer versions of speech_recognition accept an endpoint
+        kwargs = {'endpoint': self.endpoint} if self.endpoint else {}
+        return self.recognizer.recognize_google(sound, language=str(self.language.value), **kwargs)
+
+    def recognize(self, sound: sr.AudioData) -> str:
+        """
+        Sends a single chunk of audio to Google Speech Recognition and returns the text
+
+        Slow requests are hedged and failed ones retried, see ResilientRecognizer.
+        """
+        return self.resilient_recognizer(sound)
+
+    def _transcribe_chunk(self, chunk: Tuple[sr.AudioData, dict]) -> Document:
+        """
+        Transcribes one exported chunk. Runs on a worker thread.
+
+        Args:
+            chunk: Tuple of the recorded audio and the metadata of the chunk
+        Returns:
+            document: Document with the transcribed text, or empty text and an error message
+        """
+        import speech_recognition as sr
+
+        sound, metadata = chunk
+        start_time, end_time = metadata['start_time'], metadata['end_time']
+
+        key = chunk_key(sound.frame_data, str(self.language.value), 'google')
+        if self.cache is not None and (text := self.cache.get(key)) is not None:
+            count_chunk('google', 'cached')
+            return Document(page_content=text, metadata=metadata)
+
+        try:
+            with span('recognition', engine='google'):
+                text = self.recognize(sound)
+            if self.cache is not None:
+                self.cache.put(key, text)
+            count_chunk('google', 'transcribed')
+            return Document(page_content=text, metadata=metadata)
+
+        except sr.UnknownValueError:
+            logging.exception(
+                f"Speech Recognizer could not understand the audio from {format_time(start_time)} to {format_time(end_time)}")
+            metadata['error_message'] = f"Speech Recognizer could not understand the audio from\
+                {format_time(start_time)} to {format_time(end_time)}"
+            count_chunk('google', 'not_understood')
+
+            return Document(page_content='', metadata=metadata)
+
+        except sr.RequestError as e:
+            logging.exception(
+                f"Could not request results from Google Speech Recognition service;")
+            metadata['error_message'] = f"Could not request results from Google Speech Recognition service: {e}"
+            count_chunk('google', 'failed')
+            return Document(page_content='', metadata=metadata)
+
+    def _export_chunks(self, blob: Blob) -> Iterator[Tuple[sr.AudioData, dict]]:
+        """
+        Splits the audio into chunks of at most one minute and yields the recorded audio of each chunk with its metadata
+
+        The source is decoded and resampled to 16 kHz mono once, streamed through an ffmpeg pipe
+        one chunk at a time so memory does not grow with the length of the file.
+        Chunk edges are placed in pauses and long silences are dropped before they reach the recognizer.
+        """
+        import speech_recognition as sr
+
+        chunk_duration = 60 * 1000  # one minute
+        # Duration from container or download metadata, the audio itself is never fully loaded.
+        # Chunks end in pauses and silence is skipped, so total_chunks is an estimate
+        total_duration = blob_duration(blob)
+        total_chunks = ceil(total_duration/chunk_duration)
+
+        logging.info(
+            f'Audio has a total duration of {total_duration/60000} minutes')
+        logging.info(f'Audio split into about {total_chunks} chunks')
+
+        # Chunk export time includes decoding the windows the chunk is cut from
+        segmenter = SilenceSegmenter(max_chunk_ms=chunk_duration)
+        segments = timed_iter(segmenter.split(timed_iter(blob_windows(blob, chunk_duration), 'decode')),
+                              'chunk_export')
+        for chunk_number, (start_time, end_time, pcm) in enumerate(segments, start=1):
+            sound = sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
+
+            metadata = {'start_time': start_time, 'end_time': end_time,
+                        'source': blob.source, 'chunk': chunk_number, 'error_message': '',
+                        'total_duration': total_duration, 'total_chunks': total_chunks}
+
+            yield sound, metadata
 
     def lazy_parse(self, blob: Blob) -> Iterator[Document]:
         """
         Returns a generator of documents
 
+        Up to max_workers chunks are recognized concurrently, documents are still yielded in chunk order.
+
         Args:
             blob:   Blobs yielded by a DocumentLoader
 
@@ -126,65 +371,154 @@ class SpeechRecognitionParser(BaseBlobParser):
         """
 
         try:
-            audio = AudioSegment.from_file(blob.path)
-
-            chunk_duration = 60 * 1000  # one minute
-            total_duration = len(audio)
-            total_chunks = ceil(total_duration/chunk_duration)
-
-            logging.info(
-                f'Audio has a total duration of {total_duration/60000} minutes')
-            logging.info(f'Audio split into {total_chunks} chunks')
-
-            # Create a folder to save audio chunks
-            if not os.path.isdir(self.save_dir):
-                os.mkdir(self.save_dir)
-
-            chunk_number = 1
-            for start_time in range(0, total_duration, chunk_duration):
-                end_time = start_time + chunk_duration
-                chunk = audio[start_time:end_time]
-                file_name = os.path.join(
-                    self.save_dir, f'chunk{chunk_number}.wav')
-                chunk.export(
-                    file_name,
-                    format='wav',
-                    parameters=["-ac", "1", "-ar", "16000"]
-                )
-
-                metadata = {'start_time': start_time, 'end_time': end_time,
-                            'source': blob.source, 'chunk': chunk_number, 'error_message': '',
-                            'total_duration': total_duration, 'total_chunks': total_chunks}
-
-                with sr.AudioFile(file_name) as source:
-                    sound = self.recognizer.record(source)
-                try:
-
-                    text = self.recognizer.recognize_google(
-                        sound, language=str(self.language.value))
-                    yield Document(page_content=text, metadata=metadata)
-
-                except sr.UnknownValueError:
-                    logging.exception(
-                        f"Speech Recognizer could not understand the audio from {format_time(start_time)} to {format_time(end_time)}")
-                    metadata['error_message'] = f"Speech Recognizer could not understand the audio from\
-                        {format_time(start_time)} to {format_time(end_time)}"
-
-                    yield Document(page_content='', metadata=metadata)
-
-                except sr.RequestError as e:
-                    logging.exception(
-                        f"Could not request results from Google Speech Recognition service;")
-                    metadata['error_message'] = f"Could not request results from Google Speech Recognition service"
-                    yield Document(page_content='', metadata=metadata)
-
-                chunk_number += 1
-                logging.info('Saved '+file_name)
-        except:
+            yield from ordered_map(self._transcribe_chunk,
+                                   self._export_chunks(blob),
+                                   max_workers=self.max_workers)
+        except Exception:
             logging.exception('Could not load input')
             raise ValueError('Could not load input')
 
 
+class LocalWhisperParser(BaseBlobParser):
+    def __init__(self, language: Optional[Language] = Language.US_English,
+                 model: Optional[str] = 'base',
+                 cache: Optional[TranscriptionCache] = None,
+                 max_workers: Optional[int] = None,
+                 cpu_threads: Optional[int] = None,
+                 chunk_ms: Optional[int] = 30 * 1000) -> None:
+        """
+        Transcribes audio with a quantized Whisper model on the CPU, see LocalWhisperEngine
+
+        Args:
+            language: The transcribed text will be in this language.
+            model: Name of the Whisper model, or the directory of a converted model to run without a network
+            cache: Cache of previously transcribed chunks. Chunks found here are not transcribed again.
+            max_workers: Number of chunks transcribed at once. Defaults to one per four cores.
+            cpu_threads: Threads per chunk being transcribed. Defaults to an even share of the cores.
+            chunk_ms: Maximum length of a chunk, 30 seconds is the window Whisper decodes at once
+        """
+        self.language = language
+        self.cache = cache
+        self.chunk_ms = chunk_ms
+        self.engine = LocalWhisperEngine(language, model=model, num_workers=max_workers, cpu_threads=cpu_threads)
+
+    def _transcribe_chunk(self, chunk: Tuple[memoryview, dict]) -> Document:
+        """
+        Transcribes one chunk. Runs on a worker thread, the model releases the GIL while decoding.
+        """
+        pcm, metadata = chunk
+
+        key = chunk_key(pcm, str(self.language.value), f'local-{os.path.basename(self.engine.model_name)}')
+        if self.cache is not None and (text := self.cache.get(key)) is not None:
+            count_chunk('local-whisper', 'cached')
+            return Document(page_content=text, metadata=metadata)
+
+        with span('recognition', engine='local-whisper'):
+            text = self.engine.transcribe(bytes(pcm))
+        if not text:
+            metadata['error_message'] = f"Could not understand the audio from\
+                {format_time(metadata['start_time'])} to {format_time(metadata['end_time'])}"
+            count_chunk('local-whisper', 'not_understood')
+            return Document(page_content='', metadata=metadata)
+
+        if self.cache is not None:
+            self.cache.put(key, text)
+        count_chunk('local-whisper', 'transcribed')
+        return Document(page_content=text, metadata=metadata)
+
+    def _split_chunks(self, blob: Blob) -> Iterator[Tuple[memoryview, dict]]:
+        """
+        Splits the audio into chunks of at most chunk_ms and yields the raw PCM of each chunk with its metadata
+        """
+        total_duration = blob_duration(blob)
+        total_chunks = ceil(total_duration/self.chunk_ms)
+
+        logging.info(
+            f'Audio has a total duration of {total_duration/60000} minutes')
+        logging.info(f'Audio split into about {total_chunks} chunks')
+
+        # Chunk export time includes decoding the windows the chunk is cut from
+        segmenter = SilenceSegmenter(max_chunk_ms=self.chunk_ms)
+        segments = timed_iter(segmenter.split(timed_iter(blob_windows(blob, self.chunk_ms), 'decode')),
+                              'chunk_export')
+        for chunk_number, (start_time, end_time, pcm) in enumerate(segments, start=1):
+            metadata = {'start_time': start_time, 'end_time': end_time,
+                        'source': blob.source, 'chunk': chunk_number, 'error_message': '',
+                        'total_duration': total_duration, 'total_chunks': total_chunks}
+
+            yield pcm, metadata
+
+    def lazy_parse(self, blob: Blob) -> Iterator[Document]:
+        """
+        Returns a generator of documents
+
+        Up to max_workers chunks are transcribed at once, documents are still yielded in chunk order.
+
+        Args:
+            blob:   Blobs yielded by a DocumentLoader
+
+        Yields:
+            document: where each document contains page_content and metadata(start_time , end_time and chunk_number)
+        """
+        yield from ordered_map(self._transcribe_chunk,
+                               self._split_chunks(blob),
+                               max_workers=self.engine.num_workers)
+
+
+def _google_parser(language: Language, api_key: Optional[str], max_workers: Optional[int],
+                   cache: Optional[TranscriptionCache], **options: Any) -> BaseBlobParser:
+    # Chunks in flight can be lowered to stay within the rate limits of the service
+    max_workers = max_workers or int(os.environ.get('GOOGLE_MAX_WORKERS', 4))
+    # Keeps the ffmpeg path set by the app or the ingest command
+    return SpeechRecognitionParser(language=language, converter_path=AudioSegment.converter,
+                                   max_workers=max_workers, cache=cache, **options)
+
+
+def _whisper_api_parser(language: Language, api_key: Optional[str], max_workers: Optional[int],
+                        cache: Optional[TranscriptionCache], **options: Any) -> BaseBlobParser:
+    if not api_key or api_key == 'free':
+        raise ValueError('The Whisper API needs an OpenAI API key')
+    return WhisperParser(api_key=api_key, save_dir=options.pop('save_dir', 'audio-chunks'), language=language,
+                         cache=cache, max_concurrency=max_workers or 4, **options)
+
+
+def _local_whisper_parser(language: Language, api_key: Optional[str], max_workers: Optional[int],
+                          cache: Optional[TranscriptionCache], **options: Any) -> BaseBlobParser:
+    # A model directory can be given for machines without a network
+    options.setdefault('model', os.environ.get('LOCAL_WHISPER_MODEL', 'base'))
+    return LocalWhisperParser(language=language, cache=cache, max_workers=max_workers, **options)
+
+
+# How to make the parser of each speech recognition engine. A new engine is added to ASREngine and here.
+PARSER_FACTORIES: Dict[ASREngine, Callable[..., BaseBlobParser]] = {
+    ASREngine.GOOGLE: _google_parser,
+    ASREngine.WHISPER_API: _whisper_api_parser,
+    ASREngine.LOCAL_WHISPER: _local_whisper_parser,
+}
+
+
+def make_parser(engine: ASREngine, language: Language, api_key: Optional[str] = None,
+                max_workers: Optional[int] = None, cache: Optional[TranscriptionCache] = None,
+                **options: Any) -> BaseBlobParser:
+    """
+    Makes the parser transcribing audio with a speech recognition engine
+
+    Args:
+        engine: The speech recognition engine
+        language: The transcribed text will be in this language
+        api_key: OpenAI API key, needed by the Whisper API only
+        max_workers: Maximum number of chunks transcribed at once. Defaults to GOOGLE_MAX_WORKERS, or 4, for
+                     Google, to 4 for the Whisper API and to one per four cores for the local engine.
+        cache: Cache of previously transcribed chunks
+        options: Further arguments of the engine's parser, e.g. endpoint for Google
+    Returns:
+        parser: Parser yielding one document per chunk of audio
+    Raises:
+        ValueError: If the engine cannot be used, e.g. its package is not installed or it needs an API key
+    """
+    return PARSER_FACTORIES[engine](language, api_key, max_workers=max_workers, cache=cache, **options)
+
+
 class AudioLoader(BlobLoader):
     def __init__(self, file_paths: List[str]) -> None:
         """
@@ -203,23 +537,116 @@ class AudioLoader(BlobLoader):
             yield Blob.from_path(path)
 
 
+# Downloads in progress by path, so sessions transcribing the same video at once share one download
+_downloads: Dict[str, GrowingFile] = {}
+_downloads_lock = threading.Lock()
+
+
 class CustomYoutubeAudioLoader(YoutubeAudioLoader):
     """
     Custom Implementation of YoutubeAudioLoader to be able to load from single urls as well. 
     The current implementation of YoutubeAudioLoade uses all downloaded youtube files , 
     doesn't really support operations on single file.
 
-    Also removes sponsor block elements if found.
+    Downloads the smallest audio only format as is, without re-encoding, and yields the blob as soon as
+    the download starts so it is transcribed while downloading. Downloads are kept in save_dir by video id
+    and reused, a video being downloaded for another session is read from that download. Sponsor segments
+    are left out of the transcription.
     """
 
-    def __init__(self, urls: List[str], save_dir: str):
+    def __init__(self, urls: List[str], save_dir: str, max_cache_bytes: Optional[int] = None):
+        """
+        Args:
+            urls: Video urls, or urls of audio files
+            save_dir: Directory the downloads are kept in
+            max_cache_bytes: Least recently used downloads are deleted once the downloads in save_dir exceed
+                             this size. Defaults to YOUTUBE_CACHE_MAX_BYTES, or 2 GiB.
+        """
         super().__init__(urls, save_dir)
+        self.max_cache_bytes = max_cache_bytes if max_cache_bytes is not None else \
+            int(os.environ.get('YOUTUBE_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
 
-    def get_id(self, url: str) -> str:
+    def get_id(self, url: str) -> Optional[str]:
+        """
+        Extracts youtube video id from url, None if it is not a YouTube video url
+        """
+        return parse_video_id(url)
+
+    def _cache_marker(self, video_id: str) -> str:
+        return os.path.join(self.save_dir, f'{video_id}.download.json')
+
+    def _cached_blob(self, video_id: str, skip_ranges: List[Tuple[int, int]]) -> Optional[StreamingBlob]:
+        """
+        Returns the blob of a complete earlier download of the video, or None
         """
-        Extracts youtube video id from url
+        try:
+            with open(self._cache_marker(video_id)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        path = os.path.join(self.save_dir, cached['file'])
+        if not os.path.isfile(path):
+            return None
+        # Marks the download as recently used
+        os.utime(self._cache_marker(video_id))
+        logging.info(f'Using the cached download of {video_id}')
+        return StreamingBlob(path=path, duration_ms=cached['duration_ms'], skip_ranges=skip_ranges)
+
+    def _evict(self, keep: str) -> None:
+        """
+        Deletes the least recently used downloads, except keep, once the downloads in save_dir exceed
+        max_cache_bytes
+        """
+        downloads = []
+        for name in os.listdir(self.save_dir):
+            if not name.endswith('.download.json'):
+                continue
+            marker = os.path.join(self.save_dir, name)
+            try:
+                with open(marker) as f:
+                    path = os.path.join(self.save_dir, json.load(f)['file'])
+                downloads.append((os.path.getmtime(marker), marker, path, os.path.getsize(path)))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        total = sum(size for _, _, _, size in downloads)
+        for _, marker, path, size in sorted(downloads):
+            if total <= self.max_cache_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                # The marker first, so the file is no longer used once it is deleted
+                os.remove(marker)
+                os.remove(path)
+            except OSError:
+                # Still open on Windows, deleted with the next download of the video
+                logging.warning(f'Could not delete the cached download {path}')
+                continue
+            logging.info(f'Deleted the cached download {path}')
+            total -= size
+
+    def _download(self, ydl: Any, info: dict, path: str, download: GrowingFile) -> None:
         """
-        return url.split('?v=')[1]
+        Downloads the selected format and marks it as complete in the cache. Runs on its own thread.
+        """
+        try:
+            with ydl:
+                ydl.process_info(info)
+
+            duration = info['duration'] * 1000 if info.get('duration') else probe_duration(path)
+            with open(self._cache_marker(info['id']), 'w') as f:
+                json.dump({'file': os.path.basename(path), 'duration_ms': int(duration)}, f)
+        except BaseException as e:
+            logging.exception(f'Downloading {info["id"]} failed')
+            download.finish(e)
+        else:
+            download.finish()
+            self._evict(keep=path)
+        finally:
+            with _downloads_lock:
+                _downloads.pop(path, None)
 
     def yield_blobs(self) -> Iterable[Blob]:
         """Yield audio blobs for each url."""
@@ -232,40 +659,58 @@ class CustomYoutubeAudioLoader(YoutubeAudioLoader):
                 "`pip install yt_dlp`"
             )
 
-        # Use yt_dlp to download audio given a YouTube url
+        os.makedirs(self.save_dir, exist_ok=True)
+
+        # Smallest audio only format, preferring Opus which is in a container that decodes while downloading.
+        # The file is written under its final name, the cache marker tells complete downloads apart.
         ydl_opts = {
-            "format": "m4a/bestaudio/best",
+            "format": "bestaudio[acodec=opus]/bestaudio/best",
+            "format_sort": ["+size", "+br"],
             "noplaylist": True,
+            "nopart": True,
             "outtmpl": self.save_dir + "/%(id)s.%(ext)s",
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "m4a",
-                },
-                {
-                    'key': 'SponsorBlock',
-                    'categories': ['sponsor', 'selfpromo', 'interaction', 'outro', 'intro', 'filler']
-                },
-                {
-                    'key': 'ModifyChapters',
-                    'remove_sponsor_segments': ['sponsor', 'selfpromo', 'interaction', 'intro', 'outro', 'filler'],
-
-                }
-
-            ],
         }
 
         for url in self.urls:
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # Download file
-                ydl.download(url)
-
-        # Get the saved file path of the downloaded video
-        output_files = [
-            f"{self.save_dir}/{self.get_id(url)}.m4a" for url in self.urls]
-
-        # Yield the written blobs
-        loader = AudioLoader(output_files)
-        for blob in loader.yield_blobs():
-            yield blob
+            video_id = self.get_id(url)
+            skip_ranges = fetch_skip_ranges(video_id) if video_id else []
+            if video_id and (blob := self._cached_blob(video_id, skip_ranges)) is not None:
+                yield blob
+                continue
+
+            ydl = yt_dlp.YoutubeDL(ydl_opts)
+            info = ydl.extract_info(url, download=False)
+            if video_id is None and (blob := self._cached_blob(info['id'], skip_ranges)) is not None:
+                yield blob
+                continue
+
+            path = ydl.prepare_filename(info)
+            duration_ms = int(info['duration'] * 1000) if info.get('duration') else None
+            streamable = info.get('ext') in ('webm', 'weba', 'ogg', 'opus', 'mka', 'mp3')
+            with _downloads_lock:
+                download = _downloads.get(path)
+                # Checked again, another session may have completed the download meanwhile
+                blob = self._cached_blob(info['id'], skip_ranges) if download is None else None
+                leader = download is None and blob is None
+                if leader:
+                    if os.path.exists(path):
+                        # Left over from an interrupted download, removed before other sessions can open it
+                        os.remove(path)
+                    download = _downloads[path] = GrowingFile(path)
+            if blob is not None:
+                yield blob
+                continue
+            if not leader:
+                logging.info(f'Reading the download of {info["id"]} in progress for another session')
+                yield StreamingBlob(path=path, duration_ms=duration_ms, skip_ranges=skip_ranges, download=download,
+                                    streamable=streamable)
+                continue
+
+            thread = threading.Thread(target=self._download, args=(ydl, info, path, download), daemon=True)
+            thread.start()
+
+            yield StreamingBlob(path=path, duration_ms=duration_ms, skip_ranges=skip_ranges, download=download,
+                                streamable=streamable)
+
+            # The parser is done with the blob, the download has to finish before the next one starts
+            thread.join()
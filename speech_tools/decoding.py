@@ -0,0 +1,137 @@
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import json
+
+import logging
+
+import os
+
+import subprocess
+
+import tempfile
+
+import threading
+
+from pydub import AudioSegment
+
+
+# Audio format expected by the speech recognizers: 16 kHz, 16 bit, mono PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+BYTES_PER_MS = SAMPLE_RATE * SAMPLE_WIDTH * CHANNELS // 1000
+
+
+def probe_duration(path: str, prober: Optional[str] = None) -> int:
+    """
+    Reads the duration of an audio file from its container metadata, without decoding it
+
+    Args:
+        path: Path of the audio file
+        prober: Path to ffprobe. Defaults to AudioSegment.ffprobe
+    Returns:
+        duration: Duration of the audio in milliseconds
+    """
+    command = [prober or AudioSegment.ffprobe, '-v', 'error',
+               '-show_entries', 'format=duration', '-of', 'json', str(path)]
+    output = subprocess.run(command, capture_output=True, check=True).stdout
+    return int(float(json.loads(output)['format']['duration']) * 1000)
+
+
+def _feed(process: subprocess.Popen, source: Iterable[bytes], errors: List[BaseException]) -> None:
+    """
+    Writes the bytes of a source to the stdin of ffmpeg. Runs on its own thread.
+    """
+    try:
+        for chunk in source:
+            process.stdin.write(chunk)
+    except (BrokenPipeError, OSError, ValueError):
+        # ffmpeg stopped reading, it was killed or failed on its own
+        pass
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+def iter_pcm_windows(source: Union[str, Iterable[bytes]], window_ms: int,
+                     converter: Optional[str] = None) -> Iterator[Tuple[int, bytes]]:
+    """
+    Decodes audio through an ffmpeg pipe, one window at a time
+
+    Only one window of 16 kHz mono PCM is held in memory at once, so peak memory is set
+    by window_ms and not by the length of the file.
+
+    Args:
+        source: Path of the audio file, or an iterable of the bytes of the file such as a download in progress
+        window_ms: Duration of each window in milliseconds
+        converter: Path to ffmpeg. Defaults to AudioSegment.converter
+    Yields:
+        window: Tuple of the start time of the window in milliseconds and its raw PCM bytes
+    """
+    streamed = not isinstance(source, (str, os.PathLike))
+    command = [converter or AudioSegment.converter, '-v', 'error',
+               '-i', 'pipe:0' if streamed else str(source),
+               '-f', 's16le', '-acodec', 'pcm_s16le',
+               '-ac', str(CHANNELS), '-ar', str(SAMPLE_RATE),
+               'pipe:1']
+    if not streamed:
+        command.insert(3, '-nostdin')
+    # A file rather than a pipe, ffmpeg would block on a full pipe of warnings while stdout is being read
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE if streamed else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=stderr)
+    feed_errors: List[BaseException] = []
+    if streamed:
+        threading.Thread(target=_feed, args=(process, source, feed_errors), daemon=True).start()
+    window_bytes = window_ms * BYTES_PER_MS
+    start_time = 0
+    finished = False
+    try:
+        while window := process.stdout.read(window_bytes):
+            yield start_time, window
+            start_time += len(window) // BYTES_PER_MS
+        finished = True
+    finally:
+        if not finished:
+            # Consumer stopped early, no need to decode the rest
+            process.kill()
+        process.stdout.close()
+        return_code = process.wait()
+        stderr.seek(0)
+        error = stderr.read().decode(errors='replace')
+        stderr.close()
+
+    if feed_errors:
+        logging.error(f'Reading the audio failed: {feed_errors[0]}')
+        raise feed_errors[0]
+    if return_code != 0:
+        logging.error(f'ffmpeg failed to decode {"stream" if streamed else source}: {error}')
+        raise ValueError(f'Could not decode audio: {error.strip()}')
+
+
+def mute_ranges(windows: Iterable[Tuple[int, bytes]],
+                ranges: List[Tuple[int, int]]) -> Iterator[Tuple[int, bytes]]:
+    """
+    Replaces the audio within the given time ranges by silence, so the segmenter drops it
+
+    Args:
+        windows: Tuples of start time in milliseconds and raw PCM bytes, as yielded by iter_pcm_windows
+        ranges: Sorted start and end times in milliseconds of the audio to mute
+    Yields:
+        window: The same windows with the ranges muted
+    """
+    for start_time, window in windows:
+        end_time = start_time + len(window) // BYTES_PER_MS
+        overlapping = [(start, end) for start, end in ranges if start < end_time and end > start_time]
+        if overlapping:
+            window = bytearray(window)
+            for start, end in overlapping:
+                first = (max(start, start_time) - start_time) * BYTES_PER_MS
+                last = (min(end, end_time) - start_time) * BYTES_PER_MS
+                window[first:last] = bytes(last - first)
+            window = bytes(window)
+        yield start_time, window
@@ -0,0 +1,159 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+import os
+
+import threading
+
+import time
+
+from utils.constants import JobState
+from utils.error_handler import OverloadedError
+from utils.metrics import get_metrics, observe_stage
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+
+class TranscriptionJob:
+    def __init__(self, key: str) -> None:
+        """
+        State of a transcription running in the background, read by the UI on every rerun
+
+        Args:
+            key: Hash of the input and language, the same input is not transcribed twice in a row
+        """
+        self.key = key
+        self.state = JobState.QUEUED
+        # Transcribed documents in chunk order, chunks that could not be transcribed have no text
+        self.results: List[Document] = []
+        # Message to show if the job failed
+        self.error: Optional[str] = None
+        self.processed_ms = 0
+        self.total_ms = 0
+        # Number of documents added to the session's index while transcribing
+        self.indexed = 0
+        self.indexing_failed = False
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self.finished: Optional[float] = None
+
+    @property
+    def docs(self) -> List[Document]:
+        """
+        Transcribed documents with text
+        """
+        return [doc for doc in self.results if doc.page_content]
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def active(self) -> bool:
+        return self.state in (JobState.QUEUED, JobState.RUNNING)
+
+
+class JobManager:
+    def __init__(self, max_workers: Optional[int] = 2, max_queued: Optional[int] = 8) -> None:
+        """
+        Runs transcriptions on a pool of worker threads, outside the Streamlit script thread
+
+        Jobs survive reruns of the script that started them. The pool size caps how many transcriptions
+        decode and recognize audio at once across all sessions, and new jobs are refused once
+        max_queued jobs are already waiting.
+
+        Args:
+            max_workers: Maximum number of transcriptions running at once
+            max_queued: Maximum number of transcriptions waiting for a worker
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transcription')
+        self.active: Dict[int, TranscriptionJob] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key: str, work: Callable[[TranscriptionJob], None]) -> TranscriptionJob:
+        """
+        Queues a transcription
+
+        Args:
+            key: Hash of the input, see TranscriptionJob
+            work: Does the transcription, filling in the job it is given and returning early once it is cancelled.
+                  It sets job.error instead of raising for errors it can explain to the user.
+        Returns:
+            job: The queued job
+        Raises:
+            OverloadedError: If too many jobs are already waiting
+        """
+        with self.lock:
+            queued = sum(job.state == JobState.QUEUED for job in self.active.values())
+            if queued >= self.max_queued:
+                logging.warning(f'Refusing a transcription, {queued} are already waiting')
+                get_metrics().counter('transcription_jobs_total', 'Finished transcription jobs').inc(state='refused')
+                raise OverloadedError('Too many transcriptions are running right now, please try again shortly')
+
+            job = TranscriptionJob(key)
+            self.active[id(job)] = job
+        self.executor.submit(self._run, job, work)
+        return job
+
+    def _run(self, job: TranscriptionJob, work: Callable[[TranscriptionJob], None]) -> None:
+        started = time.time()
+        observe_stage('transcription_queue', started - job.created)
+        try:
+            if not job.cancelled:
+                job.state = JobState.RUNNING
+                work(job)
+        except Exception as e:
+            logging.exception(e)
+            job.error = f':red[{e}]'
+        finally:
+            if job.error is not None:
+                job.state = JobState.FAILED
+            elif job.cancelled:
+                job.state = JobState.CANCELLED
+            else:
+                job.state = JobState.DONE
+            job.finished = time.time()
+            observe_stage('transcription_job', job.finished - started)
+            with self.lock:
+                self.active.pop(id(job), None)
+            get_metrics().counter('transcription_jobs_total', 'Finished transcription jobs').inc(
+                state=job.state.name.lower())
+
+    def cancel(self, job: TranscriptionJob) -> None:
+        """
+        Asks a job to stop. A queued job never starts, a running one stops after its current chunk.
+        """
+        job.cancel_event.set()
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns the number of running and queued jobs
+        """
+        with self.lock:
+            states = [job.state for job in self.active.values()]
+        return {'running': states.count(JobState.RUNNING), 'queued': states.count(JobState.QUEUED)}
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """
+    Returns the job manager shared by every session in the process
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(int(os.environ.get('TRANSCRIPTION_WORKERS', 2)),
+                                  int(os.environ.get('TRANSCRIPTION_MAX_QUEUED', 8)))
+            get_metrics().register_collector('transcription_jobs', 'Running and queued transcription jobs',
+                                             _manager.stats)
+        return _manager
@@ -0,0 +1,88 @@
+from typing import Dict, Optional, Tuple
+
+import logging
+
+import os
+
+import threading
+
+import numpy as np
+
+from utils.constants import Language
+
+
+_models: Dict[Tuple[str, str, int, int], object] = {}
+_models_lock = threading.Lock()
+
+
+def get_local_whisper_model(model: str, compute_type: str, cpu_threads: int, num_workers: int):
+    """
+    Returns a faster-whisper model shared by every parser in the process, loaded on first use
+
+    Raises:
+        ValueError: If faster-whisper is not installed or the model cannot be loaded
+    """
+    try:
+        from faster_whisper import WhisperModel
+    except ImportError:
+        raise ValueError(
+            "faster_whisper package not found, please install it with "
+            "`pip install faster-whisper`"
+        )
+
+    key = (model, compute_type, cpu_threads, num_workers)
+    with _models_lock:
+        if key not in _models:
+            logging.info(f'Loading local Whisper model {model} ({compute_type}, {num_workers} workers '
+                         f'with {cpu_threads} threads each)')
+            try:
+                # Loaded from the local files only if model is a directory, so it also works without a network
+                _models[key] = WhisperModel(model, device='cpu', compute_type=compute_type,
+                                            cpu_threads=cpu_threads, num_workers=num_workers,
+                                            local_files_only=os.path.isdir(model))
+            except Exception as e:
+                logging.exception(f'Could not load local Whisper model {model}')
+                raise ValueError(f'Could not load the local Whisper model {model}: {e}')
+        return _models[key]
+
+
+class LocalWhisperEngine:
+    def __init__(self, language: Optional[Language] = Language.US_English,
+                 model: Optional[str] = 'base',
+                 compute_type: Optional[str] = 'int8',
+                 num_workers: Optional[int] = None,
+                 cpu_threads: Optional[int] = None,
+                 beam_size: Optional[int] = 1) -> None:
+        """
+        Transcribes chunks of audio on the CPU with a quantized Whisper model, without any network calls
+
+        Up to num_workers chunks are transcribed at once, each on its own share of the cores.
+
+        Args:
+            language: The language of the audio
+            model: Name of a Whisper model (tiny, base, small, ...), downloaded on first use,
+                   or the directory of a converted CTranslate2 model for machines without a network
+            compute_type: Quantization of the weights, int8 is the fastest on CPUs
+            num_workers: Number of chunks transcribed at once. Defaults to one per four cores.
+            cpu_threads: Threads per worker. Defaults to an even share of the cores.
+            beam_size: Beam size of the decoder, 1 is greedy decoding
+        """
+        cores = os.cpu_count() or 1
+        self.language = language
+        self.model_name = model
+        self.num_workers = num_workers or max(1, cores // 4)
+        self.cpu_threads = cpu_threads or max(1, cores // self.num_workers)
+        self.beam_size = beam_size
+        self.model = get_local_whisper_model(model, compute_type, self.cpu_threads, self.num_workers)
+
+    def transcribe(self, pcm: bytes) -> str:
+        """
+        Transcribes 16 bit PCM at SAMPLE_RATE and returns the text. Safe to call from several threads.
+        """
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        # Whisper takes ISO 639-1 codes
+        segments, _ = self.model.transcribe(audio, language=str(self.language.value)[:2],
+                                            beam_size=self.beam_size,
+                                            # Chunks are transcribed independently and already cut at pauses
+                                            condition_on_previous_text=False)
+        return ' '.join(segment.text.strip() for segment in segments).strip()
@@ -0,0 +1,254 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from collections import deque
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import logging
+
+import random
+
+import threading
+
+import time
+
+# speech_recognition is imported where it is used, so importing this module stays cheap
+if TYPE_CHECKING:
+    import speech_recognition as sr
+
+
+class LatencyTracker:
+    def __init__(self, window: Optional[int] = 200, min_samples: Optional[int] = 20) -> None:
+        """
+        Keeps the latencies of the most recent calls to estimate percentiles
+
+        Args:
+            window: Number of recent calls kept
+            min_samples: Percentiles are unknown until this many calls were observed
+        """
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Returns the given percentile of the recent latencies in seconds, or None if too few calls were observed
+        """
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(percentile / 100 * len(samples)))]
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: Optional[int] = 5, reset_timeout: Optional[float] = 30.0) -> None:
+        """
+        Stops calls to a service after consecutive failures, so callers fail fast while it is down
+
+        After reset_timeout seconds a single trial call is let through, its outcome closes the circuit again
+        or keeps it open for another reset_timeout.
+
+        Args:
+            failure_threshold: Number of consecutive failures that open the circuit
+            reset_timeout: Seconds the circuit stays open before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a call may be made now
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logging.warning(f'Opening circuit after {self.failures} consecutive failures')
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(service: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of a service, shared by every transcription in the process so an outage
+    seen by one job stops the requests of all of them
+    """
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker()
+        return _breakers[service]
+
+
+class ResilientRecognizer:
+    def __init__(self, recognize: Callable[[sr.AudioData], str],
+                 timeout: Optional[float] = 10.0,
+                 max_retries: Optional[int] = 3,
+                 backoff: Optional[float] = 0.5,
+                 max_backoff: Optional[float] = 8.0,
+                 hedge_percentile: Optional[float] = 95.0,
+                 max_workers: Optional[int] = 8,
+                 max_hedges: Optional[int] = None,
+                 breaker: Optional[CircuitBreaker] = None) -> None:
+        """
+        Wraps a speech recognition call with timeouts, retries, hedging and a circuit breaker
+
+        Every attempt waits at most timeout seconds from when its request is sent, time spent queued for a
+        worker does not count. If it is still running once it took longer than hedge_percentile of recent calls,
+        a duplicate request is sent and whichever answers first wins, so one straggler does not hold up a long
+        transcription. Duplicates run on workers of their own and are only sent while one is free, so they never
+        delay first requests. Failed attempts are retried with exponential backoff, and while the circuit is open
+        calls fail right away.
+
+        Args:
+            recognize: The call to wrap, raising sr.RequestError on failures and sr.UnknownValueError
+                       when the audio is not understood. The latter is never retried.
+            timeout: Maximum seconds to wait for an attempt, including its hedged duplicate
+            max_retries: Number of times a failed attempt is retried
+            backoff: Delay before the first retry in seconds, doubled on every further retry
+            max_backoff: Maximum delay between retries in seconds
+            hedge_percentile: Percentile of recent latencies after which a duplicate request is sent.
+                              Until enough calls were seen, half the timeout is used.
+            max_workers: Maximum number of first requests in flight, including ones that timed out and are no
+                         longer awaited
+            max_hedges: Maximum number of duplicate requests in flight. Defaults to half of max_workers.
+            breaker: Circuit breaker of the service, see get_circuit_breaker. A new one is made if not given.
+        """
+        self.recognize = recognize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+        # Requests that lost a race or timed out are left to finish here in the background
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recognizer')
+        max_hedges = max_hedges or max(1, max_workers // 2)
+        self.hedge_executor = ThreadPoolExecutor(max_workers=max_hedges, thread_name_prefix='recognizer-hedge')
+        self.hedge_slots = threading.BoundedSemaphore(max_hedges)
+
+        self.retries = 0
+        self.hedges = 0
+
+    def _timed_recognize(self, sound: sr.AudioData, started: Optional[threading.Event] = None) -> str:
+        import speech_recognition as sr
+
+        if started is not None:
+            started.set()
+        start = time.perf_counter()
+        try:
+            text = self.recognize(sound)
+        except sr.UnknownValueError:
+            # Still an answer from the service, so its latency counts
+            self.latencies.observe(time.perf_counter() - start)
+            raise
+        self.latencies.observe(time.perf_counter() - start)
+        return text
+
+    def hedge_delay(self) -> float:
+        """
+        Seconds after which an attempt gets a duplicate request
+        """
+        delay = self.latencies.percentile(self.hedge_percentile)
+        return delay if delay is not None else self.timeout / 2
+
+    def _attempt(self, sound: sr.AudioData) -> str:
+        """
+        Makes one attempt, hedged once it runs late, and returns the first answer
+        """
+        import speech_recognition as sr
+
+        started = threading.Event()
+        pending = {self.executor.submit(self._timed_recognize, sound, started)}
+        # The deadline is the service's, it starts once a worker sends the request
+        started.wait()
+        start = time.monotonic()
+        hedge_at = start + self.hedge_delay()
+        deadline = start + self.timeout
+        hedged = False
+        error: Optional[Exception] = None
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                raise sr.RequestError(f'recognition request timed out after {self.timeout}s')
+
+            done, pending = wait(pending, timeout=(deadline if hedged else min(hedge_at, deadline)) - now,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except (sr.RequestError, OSError) as e:
+                    error = e
+
+            if not hedged and pending and time.monotonic() >= hedge_at:
+                hedged = True
+                # A duplicate that has to queue would not answer sooner, it is skipped instead
+                if not self.hedge_slots.acquire(blocking=False):
+                    logging.debug('Not hedging a recognition request, all hedging workers are busy')
+                    continue
+                self.hedges += 1
+                logging.debug(f'Hedging a recognition request after {time.monotonic() - start:.2f}s')
+                hedge = self.hedge_executor.submit(self._timed_recognize, sound)
+                hedge.add_done_callback(lambda _: self.hedge_slots.release())
+                pending.add(hedge)
+
+        raise error
+
+    def __call__(self, sound: sr.AudioData) -> str:
+        """
+        Recognizes the audio, raising sr.RequestError once all retries failed or while the circuit is open
+        """
+        import speech_recognition as sr
+
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise sr.RequestError('speech recognition service is unavailable, not sending requests for now')
+
+            try:
+                text = self._attempt(sound)
+            except sr.UnknownValueError:
+                self.breaker.record_success()
+                raise
+            except (sr.RequestError, OSError) as e:
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise sr.RequestError(f'{e} (after {attempt + 1} attempts)')
+
+                self.retries += 1
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+                logging.warning(f'Recognition request failed ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            return text
@@ -0,0 +1,261 @@
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from math import ceil
+
+import numpy as np
+
+from speech_tools.decoding import SAMPLE_RATE
+
+
+class Segment(NamedTuple):
+    """
+    A span of speech cut from the decoded audio
+
+    start_time and end_time are in milliseconds from the start of the file, pcm is a
+    zero-copy view of the 16 bit mono samples.
+    """
+    start_time: int
+    end_time: int
+    pcm: memoryview
+
+
+class SilenceSegmenter:
+    def __init__(self, max_chunk_ms: int,
+                 min_chunk_ms: Optional[int] = None,
+                 silence_threshold: Optional[float] = -40.0,
+                 noise_margin: Optional[float] = 15.0,
+                 min_silence_ms: Optional[int] = 300,
+                 max_silence_ms: Optional[int] = 2000,
+                 keep_silence_ms: Optional[int] = 200,
+                 min_speech_ms: Optional[int] = 100,
+                 frame_ms: Optional[int] = 30) -> None:
+        """
+        Splits decoded audio into chunks that end in pauses, dropping the silence in between
+
+        Args:
+            max_chunk_ms: No chunk is longer than this. Chunks are hard cut here if no pause is found.
+            min_chunk_ms: Pauses before this point are not used as chunk edges. Defaults to half of max_chunk_ms.
+            silence_threshold: Frames quieter than this (dBFS) are silent.
+            noise_margin: Frames less than this many dB above the noise floor are also silent,
+                          the lower of the two thresholds is used so quiet recordings keep their speech.
+            min_silence_ms: Shortest pause that can be used as a chunk edge.
+            max_silence_ms: Pauses longer than this always end a chunk, so long silences such as
+                            muted sponsor segments are never sent to the recognizer.
+            keep_silence_ms: Silence kept around speech so words are not clipped.
+            min_speech_ms: Chunks with less speech than this (clicks, breaths) are dropped.
+            frame_ms: Length of the frames the energy is measured over.
+        """
+        self.frame_ms = frame_ms
+        self.frame_samples = SAMPLE_RATE * frame_ms // 1000
+        self.max_frames = max_chunk_ms // frame_ms
+        self.min_frames = (min_chunk_ms if min_chunk_ms is not None else max_chunk_ms // 2) // frame_ms
+        self.min_silence_frames = ceil(min_silence_ms / frame_ms)
+        self.max_silence_frames = ceil(max_silence_ms / frame_ms)
+        self.keep_frames = keep_silence_ms // frame_ms
+        self.min_speech_frames = ceil(min_speech_ms / frame_ms)
+        self.silence_threshold = silence_threshold
+        self.noise_margin = noise_margin
+
+    def frame_energy(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Returns the sum of squared samples of every complete frame
+        """
+        n_frames = len(samples) // self.frame_samples
+        frames = samples[:n_frames * self.frame_samples].reshape(n_frames, self.frame_samples).astype(np.int64)
+        return np.einsum('ij,ij->i', frames, frames)
+
+    def threshold(self, energy: np.ndarray) -> float:
+        """
+        Mean square amplitude above which audio is speech, from the silence threshold and the noise floor
+
+        The threshold is rounded to whole dB, so the same recording cut at a different point gets the same
+        threshold, and the same chunk edges.
+
+        Args:
+            energy: Frame energies, as returned by frame_energy
+        """
+        threshold = self.silence_threshold
+        # Digital silence, e.g. muted sponsor segments, says nothing about the noise of the recording
+        audible = energy[energy > 0]
+        if audible.size:
+            rms = np.sqrt(np.percentile(audible, 10) / self.frame_samples)
+            threshold = min(threshold, round(20 * np.log10(rms / 32768) + self.noise_margin))
+        return float((32768 * 10 ** (threshold / 20)) ** 2)
+
+    def voiced_frames(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean array with one entry per complete frame, True where the frame has speech
+        """
+        energy = self.frame_energy(samples)
+        return energy > self.threshold(energy) * self.frame_samples
+
+    def loud_samples(self, samples: np.ndarray, threshold: float, start: Optional[int] = 0,
+                     stop: Optional[int] = None) -> np.ndarray:
+        """
+        Returns a boolean array with one entry per sample from start to stop, True where the frame centered on
+        the sample has speech
+
+        Unlike voiced_frames, the result does not depend on where the frames start, so chunk edges placed
+        with it stay on the same samples when the start of the recording is trimmed.
+        """
+        stop = len(samples) if stop is None else min(stop, len(samples))
+        if start >= stop:
+            return np.zeros(0, dtype=bool)
+        half = self.frame_samples // 2
+        first = max(start - half, 0)
+        # Sums of squares of 16 bit samples are exact in 64 bit integers, rounding would move edges a sample
+        energy = np.concatenate(([0], np.cumsum(np.square(
+            samples[first:min(stop - half + self.frame_samples, len(samples))].astype(np.int64)))))
+        positions = np.arange(start, stop)
+        low = np.maximum(positions - half, 0) - first
+        high = np.minimum(positions - half + self.frame_samples, len(samples)) - first
+        return energy[high] - energy[low] > threshold * self.frame_samples
+
+    def _find_pause(self, voiced: np.ndarray, start: int) -> Optional[Tuple[int, int]]:
+        """
+        Finds the longest pause between min_frames and max_frames after start, preferring later ones on ties
+
+        Returns:
+            pause: Tuple of the first frame and the length of the pause, or None if there is no usable pause
+        """
+        window_start = start + self.min_frames
+        silent = ~voiced[window_start:start + self.max_frames]
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+        run_starts, run_lengths = edges[0::2], edges[1::2] - edges[0::2]
+        usable = run_lengths >= self.min_silence_frames
+        if not usable.any():
+            return None
+
+        run_starts, run_lengths = run_starts[usable], run_lengths[usable]
+        longest = len(run_lengths) - 1 - np.argmax(run_lengths[::-1])
+        return window_start + run_starts[longest], run_lengths[longest]
+
+    def _find_long_pause(self, voiced: np.ndarray, start: int) -> Optional[int]:
+        """
+        Returns the first frame of the first pause of at least max_silence_frames within max_frames after start
+        """
+        silent = ~voiced[start:start + self.max_frames]
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.astype(np.int8), [0]))))
+        run_starts, run_lengths = edges[0::2], edges[1::2] - edges[0::2]
+        long_runs = np.flatnonzero(run_lengths >= self.max_silence_frames)
+        return start + run_starts[long_runs[0]] if long_runs.size else None
+
+    def _speech_edges(self, samples: np.ndarray, threshold: float, pause_start: int,
+                      pause_length: int) -> Tuple[int, int]:
+        """
+        Returns the sample the speech before a pause ends at and the sample the speech after it starts at
+
+        Speech after the pause is only looked for as far as it can move the end of the chunk, the length of the
+        samples is returned if there is none.
+        """
+        middle = (pause_start + pause_length // 2) * self.frame_samples + self.frame_samples // 2
+        first = max(pause_start - 1, 0) * self.frame_samples
+        before = np.flatnonzero(self.loud_samples(samples, threshold, first, middle))
+        speech_end = first + before[-1] + 1 if before.size else first
+        after = np.flatnonzero(self.loud_samples(
+            samples, threshold, middle, speech_end + 2 * self.keep_frames * self.frame_samples))
+        return speech_end, (middle + after[0] if after.size else len(samples))
+
+    def _next_cut(self, samples: np.ndarray, final: bool) -> Tuple[Optional[int], int]:
+        """
+        Picks the end of the chunk starting at the first buffered sample
+
+        Edges are placed where the speech around them starts and ends, to the sample, rather than on the frame
+        grid, and the buffer is cut at every edge. Frames and the speech threshold are measured from the start
+        of the chunk, so a recording trimmed by any number of samples is cut into the same chunks once it
+        passes the first pause.
+
+        Args:
+            samples: Buffered samples
+            final: Whether the end of the audio has been reached
+        Returns:
+            end: End sample of the chunk, None if no chunk can be cut yet or the chunk has too little speech
+            consumed: Number of samples that no longer need to be buffered
+        """
+        if not final and len(samples) // self.frame_samples <= self.max_frames:
+            # Wait for more audio, the next pause may be in the next window
+            return None, 0
+
+        max_samples = self.max_frames * self.frame_samples
+        keep_samples = self.keep_frames * self.frame_samples
+        # Enough to find the speech after a pause the chunk can end in
+        window = samples[:max_samples + 2 * keep_samples + self.frame_samples]
+        energy = self.frame_energy(window)
+        threshold = self.threshold(energy[:self.max_frames])
+        voiced = energy > threshold * self.frame_samples
+        if not voiced.any():
+            # Only silence, keep enough of it as lead-in for the speech after it
+            lead_in = (2 * self.keep_frames + 1) * self.frame_samples
+            return None, len(samples) if final and len(window) == len(samples) else len(window) - lead_in
+
+        # The first loud sample rather than the first voiced frame, which depends on where the frames start
+        first_voiced = np.argmax(voiced)
+        start = int(np.argmax(self.loud_samples(
+            window, threshold, 0, first_voiced * self.frame_samples + self.frame_samples // 2 + 1))) - keep_samples
+        if start > 0:
+            # Drop the silence first, the chunk is measured from its start
+            return None, start
+
+        if (long_pause := self._find_long_pause(voiced, 0)) is not None:
+            end = min(self._speech_edges(window, threshold, long_pause, self.max_silence_frames)[0] + keep_samples,
+                      len(window))
+            consumed = end
+        elif len(voiced) <= self.max_frames:
+            last_voiced = (len(voiced) - 1 - np.argmax(voiced[::-1])) * self.frame_samples
+            loud = np.flatnonzero(self.loud_samples(window, threshold, last_voiced))
+            end = min(last_voiced + loud[-1] + 1 + keep_samples, len(window))
+            consumed = len(window)
+        else:
+            pause = self._find_pause(voiced, 0)
+            if pause is None:
+                end = max_samples
+            else:
+                speech_end, speech_start = self._speech_edges(window, threshold, *pause)
+                end = min(speech_end + min(keep_samples, (speech_start - speech_end) // 2), max_samples)
+            consumed = end
+
+        if np.count_nonzero(voiced[:ceil(end / self.frame_samples)]) < self.min_speech_frames:
+            return None, consumed
+        return end, consumed
+
+    def split(self, windows: Iterable[Tuple[int, bytes]]) -> Iterator[Segment]:
+        """
+        Splits streamed PCM windows into speech segments
+
+        Only the unfinished tail of the audio is buffered between windows, so memory stays
+        around two windows regardless of the length of the file.
+
+        Args:
+            windows: Tuples of start time in milliseconds and raw PCM bytes, as yielded by iter_pcm_windows
+        Yields:
+            segment: Speech segments with accurate start and end times
+        """
+        buffer = np.empty(0, dtype=np.int16)
+        # Position of the first buffered sample from the start of the audio
+        offset = 0
+        windows = iter(windows)
+        final = False
+        while not final:
+            window = next(windows, None)
+            if window is None:
+                final = True
+            else:
+                samples = np.frombuffer(window[1], dtype=np.int16)
+                if buffer.size == 0:
+                    buffer, offset = samples, window[0] * SAMPLE_RATE // 1000
+                else:
+                    buffer = np.concatenate((buffer, samples))
+
+            while True:
+                end, consumed = self._next_cut(buffer, final)
+                if consumed == 0:
+                    break
+                if end is not None:
+                    yield Segment(
+                        start_time=int(offset * 1000 // SAMPLE_RATE),
+                        end_time=int((offset + end) * 1000 // SAMPLE_RATE),
+                        pcm=memoryview(buffer[:end]).cast('B'),
+                    )
+
+                buffer = buffer[consumed:]
+                offset += consumed
@@ -1,23 +1,28 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional, List, Iterator, Union
+from typing import TYPE_CHECKING, Callable, Optional, Iterator, Union
 
 import logging
 
-from langchain.schema import Document
+import hashlib
+
+import os
 
-from utils.constants import FileType, Language
+from functools import partial
+
+from langchain.schema import Document
 
-from yt_dlp.utils import DownloadError
+from utils.constants import ASREngine, FileType, JobState, Language
 
 import streamlit as st
 
 from langchain.document_loaders.generic import GenericLoader
 
-from openai.error import AuthenticationError, APIConnectionError
 
+from speech_tools.audio_processing import format_time, make_parser, AudioLoader, CustomYoutubeAudioLoader
+from speech_tools.jobs import JobManager, TranscriptionJob, get_job_manager
+from speech_tools.transcription_cache import get_transcription_cache
 
-from speech_tools.audio_processing import format_time, AudioLoader,\
-    SpeechRecognitionParser, CustomYoutubeAudioLoader, WhisperParser
+from utils.metrics import log_transcript, span
 
 if TYPE_CHECKING:
     from streamlit.delta_generator import DeltaGenerator
@@ -25,18 +30,16 @@ if TYPE_CHECKING:
 
 
 def get_generator(_loader: BlobLoader,
-                   language: Language = Optional[Language.US_English],
-                     api_key: Optional[str] = "free") -> Iterator[Document]:
-    """
-    Returns a generator yielding documents from a BlobLoader and integrates with SpeechRecognition Parser
+                  language: Language = Optional[Language.US_English],
+                  api_key: Optional[str] = "free",
+                  engine: Optional[ASREngine] = ASREngine.GOOGLE) -> Iterator[Document]:
     """
+    Returns a generator yielding documents from a BlobLoader, transcribed by the given speech recognition engine
 
-    # Decided not to use WhisperParser because of high cost and less accurate results for different languages. But is still supported
-    # parser = SpeechRecognitionParser(
-    #   language=language) if api_key == 'free' else WhisperParser(api_key=api_key, save_dir='audio-chunks/', language=language)
-
-    parser = SpeechRecognitionParser(
-        language=language)
+    Raises:
+        ValueError: If the engine cannot be used, see make_parser
+    """
+    parser = make_parser(engine, language, api_key, cache=get_transcription_cache())
     loader = GenericLoader(_loader, parser)
     text_generator = loader.lazy_load()
     return text_generator
@@ -45,15 +48,18 @@ def get_generator(_loader: BlobLoader,
 class Transcriber:
     '''
         Transcribes speech to text , either using the GoogleSpeechRecognitionAPI or Whisper API
+
+        Transcription runs as a background job, so it carries on across reruns of the Streamlit script.
+        The script starts it with transcribe and draws its progress with render on every rerun.
     '''
 
-    def __init__(self, api_key: Optional[str] = 'free'):
-        self.type = type
-        self.got_input = False
-        self.processing = False
-        self.docs = []
-        self.data = None
+    def __init__(self, api_key: Optional[str] = 'free', jobs: Optional[JobManager] = None):
+        # The current transcription job, kept across reruns
+        self.job: Optional[TranscriptionJob] = None
+        # Hash of the last input, so the upload itself does not have to be kept around
+        self.data_hash = None
         self.api_key = api_key
+        self.jobs = jobs or get_job_manager()
 
     def set_container(self, container: DeltaGenerator) -> None:
         """
@@ -62,47 +68,68 @@ class Transcriber:
         self.container = container
 
     def get_docs(self) -> list:
-        return self.docs
+        return self.job.docs if self.job is not None else []
 
     def get_text(self) -> str:
         """
         returns the full transcribed text over all documents
         """
-        return '\n'.join([x.page_content for x in self.docs])
+        return '\n'.join([x.page_content for x in self.get_docs()])
+
+    @property
+    def processing(self) -> bool:
+        """
+        Whether the current job is still queued or running
+        """
+        return self.job is not None and self.job.active
+
+    @staticmethod
+    def input_key(data: Union[bytes, str], language: Language, engine: ASREngine) -> str:
+        """
+        Hash of an input and how it is transcribed, the key of its transcription job
+        """
+        data_hash = hashlib.sha256(data.encode() if isinstance(data, str) else data)
+        data_hash.update(str(language.value).encode())
+        data_hash.update(engine.value.encode())
+        return data_hash.hexdigest()
 
     def transcribe(self,
                    data: Union[bytes, str],
                    file_path: str,
                    input_type: FileType,
-                   language: Language = Optional[Language.US_English]) -> List[Document]:
+                   language: Language = Optional[Language.US_English],
+                   on_document: Optional[Callable[[Document], None]] = None,
+                   engine: Optional[ASREngine] = ASREngine.GOOGLE) -> TranscriptionJob:
         '''
-        Displays the Transcribed text using GoogleSpeechRecognitionAPI , results may be inaccurate.
+        Starts transcribing in the background, unless the same input is already being or has been transcribed
 
         Args:
             data: The audio data in bytes or youtube url
-            file_path: The file path to save the audio at
+            file_path: The file path to save the audio at, made unique per input
             input_type: Whether the audio is from a file or from the microphone or a youtube url. Deafaults to File Input.
             language: The language the transcribed text should be in. Defaults to US English.
+            on_document: Called on the job's thread with every transcribed document as soon as it is available,
+                         e.g. to index it while the rest of the audio is still being transcribed.
+            engine: The speech recognition engine to transcribe with. Defaults to Google.
         Returns:
-            docs: List of transcribed documents as langchain Documents
+            job: The job transcribing this input
+        Raises:
+            OverloadedError: If too many transcriptions are waiting already
         '''
-
         logging.debug(f"Transcribe free method is called with File Path:{file_path} , Input Type:{input_type} and\
                       Language:{str(language.value)}")
 
-        # If same audio data is passed , just return already computed documents
-        if data == self.data:
-            self.container.markdown(f':green[**{self.get_text()}**]')
-            return self.docs
-        else:
-            self.data = data
-
-        self.got_input = False
-        self.processing = False
-
-        self.loading_text = self.container.empty()
+        # If same audio data is passed , just return the job that transcribed it
+        data_hash = self.input_key(data, language, engine)
+        # A cancelled or failed job of the same input is started again rather than shown
+        if (self.job is not None and data_hash == self.data_hash
+                and (self.job.active or self.job.state == JobState.DONE)):
+            return self.job
 
         if input_type != FileType.YOUTUBE:
+            # Unique per input, so sessions transcribing at the same time do not overwrite each other's audio
+            root, extension = os.path.splitext(file_path)
+            file_path = f'{root}-{data_hash[:16]}{extension}'
             with open(file_path, 'wb') as f:
                 f.write(data)
 
@@ -111,65 +138,98 @@ class Transcriber:
         else:
             loader = CustomYoutubeAudioLoader([data], save_dir=file_path)
 
-        try:
-            with self.loading_text.container():
-                st.markdown(
-                    f':blue[Speech Processing In Progress...Please Wait...]')
+        job = self.jobs.submit(data_hash, partial(
+            self._run, loader=loader, language=language, on_document=on_document, engine=engine))
+        if self.job is not None:
+            self.jobs.cancel(self.job)
+        self.job, self.data_hash = job, data_hash
+        return job
 
-            self.got_input = True
-            self.processing = True
+    def _run(self, job: TranscriptionJob, loader: BlobLoader, language: Language,
+             on_document: Optional[Callable[[Document], None]], engine: ASREngine) -> None:
+        '''
+        Transcribes the audio of a loader into the job. Runs on a worker thread of the job manager.
+        '''
 
-            self.container.markdown(f':blue[Transcribed Text:]')
-            text_generator = get_generator(loader, language, self.api_key)
+        # Only needed for their exceptions, imported here to keep importing this module cheap
+        from yt_dlp.utils import DownloadError
+        from openai.error import AuthenticationError, APIConnectionError
 
-            self.docs = []
+        text_generator = None
+        try:
+            text_generator = get_generator(loader, language, self.api_key, engine)
             for result in text_generator:
-                self.loading_text.empty()
+                if job.cancelled:
+                    break
 
-                chunk_time = format_time(
-                    result.metadata["start_time"]) + ' to ' + format_time(result.metadata["end_time"])
+                job.processed_ms = result.metadata["end_time"]
+                job.total_ms = result.metadata["total_duration"]
+                job.results.append(result)
 
                 chunk = result.metadata["chunk"]
-
-                total_chunks = result.metadata["total_chunks"]
-
-                with self.loading_text.container():
-                    st.markdown(
-                        f':orange[Processed chunk {chunk} / {total_chunks} ({chunk_time})]')
-
-                with self.container:
-                    text = result.page_content
-                    if text:
-                        self.container.markdown(f':green[**{text}**]')
-                        logging.debug(
-                            f'Transcribed Text of {chunk} : {text}')
-                        self.docs.append(result)
-                    else:
-                        logging.debug(
-                            f'Could not transcribe Text of {chunk}')
-                        self.container.markdown(
-                            f':red[**Could not transcribe audio from {chunk_time}**]')
-
-            return self.docs
+                if not result.page_content:
+                    logging.debug(f'Could not transcribe Text of {chunk}')
+                    continue
+
+                log_transcript(lambda: f'Transcribed Text of {chunk} : {result.page_content}')
+                if on_document is not None and not job.indexing_failed:
+                    try:
+                        with span('indexing'):
+                            on_document(result)
+                        job.indexed += 1
+                    except Exception:
+                        # The whole transcript is indexed once transcription is done instead
+                        logging.exception(f'Could not index chunk {chunk}')
+                        job.indexing_failed = True
 
         except ValueError as e:
             logging.exception(e)
-            self.container.markdown(f':red[{e}]')
+            job.error = f':red[{e}]'
         except ConnectionError as e:
             logging.exception(e)
-            self.container.markdown(f':red[{e}]')
+            job.error = f':red[{e}]'
         except DownloadError as e:
             logging.exception(e)
-            self.container.markdown(f':red[Invalid Youtube URL]')
+            job.error = f':red[Invalid Youtube URL]'
         except AuthenticationError as e:
             logging.exception(e)
-            self.container.markdown(f':red[Invalid API Key]')
+            job.error = f':red[Invalid API Key]'
         except APIConnectionError as e:
             logging.exception(e)
-            self.container.markdown(f':red[Error communicating with OpenAI]')
-        except Exception as e:
-            logging.exception(e)
-            self.container.markdown(f':red[{e}]')
+            job.error = f':red[Error communicating with OpenAI]'
         finally:
-            self.loading_text.empty()
-            self.processing = False
+            # Stops decoding and recognition if the job was cancelled
+            if text_generator is not None:
+                text_generator.close()
+
+    def render(self) -> None:
+        '''
+        Displays the transcribed text and the progress of the current job in the container
+        '''
+        job = self.job
+        if job is None:
+            return
+
+        with self.container:
+            st.markdown(f':blue[Transcribed Text:]')
+            for result in list(job.results):
+                if result.page_content:
+                    st.markdown(f':green[**{result.page_content}**]')
+                else:
+                    chunk_time = format_time(
+                        result.metadata["start_time"]) + ' to ' + format_time(result.metadata["end_time"])
+                    st.markdown(f':red[**Could not transcribe audio from {chunk_time}**]')
+
+            if job.state == JobState.QUEUED:
+                st.markdown(f':blue[Waiting for other transcriptions to finish...]')
+            elif job.state == JobState.RUNNING:
+                if job.results:
+                    # Chunks end in pauses and silences are skipped, so progress is shown in time rather than chunks
+                    processed = format_time(job.processed_ms) + ' / ' + format_time(job.total_ms)
+                    st.markdown(f':orange[Processed {processed} of audio]')
+                else:
+                    st.markdown(f':blue[Speech Processing In Progress...Please Wait...]')
+            elif job.state == JobState.FAILED:
+                st.markdown(job.error)
+            elif job.state == JobState.CANCELLED:
+                st.markdown(f':orange[Transcription cancelled]')
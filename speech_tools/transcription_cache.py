@@ -0,0 +1,139 @@
+from typing import Optional
+
+import hashlib
+
+import logging
+
+import os
+
+import sqlite3
+
+import threading
+
+import time
+
+from utils.metrics import get_metrics
+
+
+# Bytes hashed per update, so large chunks are hashed without an extra copy
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def chunk_key(pcm: memoryview, language: str, engine: str) -> str:
+    """
+    Content address of a chunk of decoded audio
+
+    Args:
+        pcm: Raw PCM bytes of the chunk
+        language: Language code the chunk is transcribed in
+        engine: Name of the speech recognition engine
+    Returns:
+        key: Hex digest identifying the chunk, language and engine
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{engine}\0{language}\0'.encode())
+    pcm = memoryview(pcm).cast('B')
+    for offset in range(0, len(pcm), HASH_BLOCK_SIZE):
+        digest.update(pcm[offset:offset + HASH_BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+class TranscriptionCache:
+    def __init__(self, path: Optional[str] = 'cache/transcriptions.sqlite3',
+                 max_bytes: Optional[int] = 256 * 1024 * 1024) -> None:
+        """
+        On disk cache of transcribed text per chunk of audio, shared by all sessions and restarts
+
+        Args:
+            path: Path of the SQLite database
+            max_bytes: Least recently used entries are evicted once the stored text exceeds this size
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Shared with the worker processes of the ingest command, which wait for each other's writes
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS transcriptions '
+                '(key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS transcriptions_last_used ON transcriptions (last_used)')
+            self.size = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM transcriptions').fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached text of a chunk, or None on a miss
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT text FROM transcriptions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute(
+                'UPDATE transcriptions SET last_used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, text: str) -> None:
+        """
+        Stores the text of a chunk, evicting least recently used chunks if the cache is full
+        """
+        size = len(key) + len(text.encode())
+        with self.lock, self.connection:
+            previous = self.connection.execute(
+                'SELECT size FROM transcriptions WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO transcriptions (key, text, size, last_used) VALUES (?, ?, ?, ?)',
+                (key, text, size, time.time()))
+            self.size += size - (previous[0] if previous else 0)
+
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Deletes least recently used entries until the cache is within max_bytes. Caller holds the lock.
+        """
+        rows = self.connection.execute(
+            'SELECT key, size FROM transcriptions ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if self.size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self.size -= size
+
+        self.connection.executemany('DELETE FROM transcriptions WHERE key = ?', evicted)
+        logging.debug(f'Evicted {len(evicted)} chunks from the transcription cache')
+
+    def stats(self) -> dict[str, int]:
+        """
+        Returns hit and miss counters and the size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_transcription_cache() -> TranscriptionCache:
+    """
+    Returns the transcription cache shared by every parser in the process
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TranscriptionCache()
+            get_metrics().register_collector('transcription_cache', 'Transcription cache counters', _cache.stats)
+        return _cache
@@ -0,0 +1,157 @@
+from typing import Optional
+
+import asyncio
+
+import io
+
+import logging
+
+import random
+
+from pydub import AudioSegment
+
+from speech_tools.decoding import SAMPLE_RATE, CHANNELS
+
+from utils.constants import Language
+
+
+# Largest file the Whisper API accepts
+UPLOAD_LIMIT_BYTES = 25 * 1024 * 1024
+
+
+def max_chunk_ms_for_limit(bitrate: int, upload_limit: Optional[int] = UPLOAD_LIMIT_BYTES,
+                           margin: Optional[float] = 0.9) -> int:
+    """
+    Longest chunk whose encoding stays under the upload limit
+
+    Args:
+        bitrate: Target bitrate of the encoding in bits per second
+        upload_limit: Maximum size of an upload in bytes
+        margin: Fraction of the limit to use, leaving room for container overhead and bitrate variation
+    Returns:
+        duration: Maximum chunk duration in milliseconds
+    """
+    return int(upload_limit * margin * 8 / bitrate * 1000)
+
+
+async def encode_opus(pcm: bytes, bitrate: int, converter: Optional[str] = None) -> bytes:
+    """
+    Encodes 16 kHz mono PCM to Opus in an Ogg container through an ffmpeg pipe
+
+    Args:
+        pcm: Raw 16 bit PCM at SAMPLE_RATE
+        bitrate: Target bitrate in bits per second
+        converter: Path to ffmpeg. Defaults to AudioSegment.converter
+    Returns:
+        audio: The encoded file
+    """
+    command = [converter or AudioSegment.converter, '-v', 'error',
+               '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), '-i', 'pipe:0',
+               '-c:a', 'libopus', '-b:a', str(bitrate), '-application', 'voip',
+               '-f', 'ogg', 'pipe:1']
+    process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    try:
+        audio, error = await process.communicate(pcm)
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    if process.returncode != 0:
+        error = error.decode(errors='replace').strip()
+        logging.error(f'ffmpeg failed to encode a chunk: {error}')
+        raise ValueError(f'Could not encode audio: {error}')
+    return audio
+
+
+class WhisperEngine:
+    def __init__(self, api_key: str, language: Optional[Language] = Language.US_English,
+                 api_base: Optional[str] = None,
+                 model: Optional[str] = 'whisper-1',
+                 bitrate: Optional[int] = 24000,
+                 max_chunk_ms: Optional[int] = 10 * 60 * 1000,
+                 max_concurrency: Optional[int] = 4,
+                 max_retries: Optional[int] = 5,
+                 backoff: Optional[float] = 1.0,
+                 max_backoff: Optional[float] = 30.0,
+                 converter: Optional[str] = None) -> None:
+        """
+        Transcribes chunks of audio with the Whisper API, as coroutines so several chunks can be uploaded at once
+
+        Args:
+            api_key: OpenAI API key
+            language: Language of the audio
+            api_base: Base URL of the API, e.g. to point at a local stand-in of the transcription endpoint
+            model: Name of the Whisper model
+            bitrate: Bitrate of the Opus encoding the chunks are uploaded in, in bits per second
+            max_chunk_ms: Maximum chunk duration. Capped so a chunk always fits the upload limit,
+                          shorter chunks let more of them upload concurrently.
+            max_concurrency: Maximum number of chunks being encoded or uploaded at once
+            max_retries: Number of times a chunk is retried after a transient error
+            backoff: Delay before the first retry in seconds, doubled on every further retry
+            max_backoff: Maximum delay between retries in seconds
+            converter: Path to ffmpeg. Defaults to AudioSegment.converter
+        """
+        self.api_key = api_key
+        self.language = language
+        self.api_base = api_base
+        self.model = model
+        self.bitrate = bitrate
+        self.max_chunk_ms = min(max_chunk_ms, max_chunk_ms_for_limit(bitrate))
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.converter = converter
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        """
+        Exponential backoff with jitter, or the delay the server asked for if it did
+        """
+        headers = getattr(error, 'headers', None) or {}
+        try:
+            return min(float(headers['retry-after']), self.max_backoff)
+        except (KeyError, TypeError, ValueError):
+            return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    async def transcribe(self, pcm: bytes, name: str) -> str:
+        """
+        Encodes and transcribes one chunk, retrying transient errors with exponential backoff
+
+        Args:
+            pcm: Raw 16 bit mono PCM of the chunk at SAMPLE_RATE
+            name: Name of the uploaded file, without extension
+        Returns:
+            text: The transcribed text
+        """
+        import openai
+        from openai.error import APIConnectionError, APIError, RateLimitError, \
+            ServiceUnavailableError, Timeout, TryAgain
+
+        audio = await encode_opus(pcm, self.bitrate, self.converter)
+        if len(audio) > UPLOAD_LIMIT_BYTES:
+            raise ValueError(f'Encoded chunk {name} is larger than the upload limit of the Whisper API')
+
+        for attempt in range(self.max_retries + 1):
+            file_obj = io.BytesIO(audio)
+            file_obj.name = f'{name}.ogg'
+            try:
+                transcript = await openai.Audio.atranscribe(
+                    self.model, file_obj,
+                    api_key=self.api_key, api_base=self.api_base,
+                    language=self.language.value[:2],
+                    prompt=f"Transcribe this audio in the following language:{self.language.name}")
+                return transcript.text
+
+            except (APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain, APIError) as e:
+                # Client errors such as an invalid key or request are not worth retrying
+                if type(e) is APIError and e.http_status is not None and e.http_status < 500:
+                    raise
+                if attempt == self.max_retries:
+                    raise
+
+                delay = self._retry_delay(attempt, e)
+                logging.warning(f'Transcribing {name} failed ({e}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
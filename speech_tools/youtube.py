@@ -0,0 +1,116 @@
+from typing import Iterator, List, Optional, Tuple
+
+from urllib.parse import parse_qs, urlparse
+
+import logging
+
+import os
+
+import threading
+
+
+# Segments of these categories are treated as silence, so they are not transcribed
+SPONSOR_CATEGORIES = ['sponsor', 'selfpromo', 'interaction', 'intro', 'outro', 'filler']
+
+
+def parse_video_id(url: str) -> Optional[str]:
+    """
+    Extracts the video id from the common forms of YouTube urls
+
+    Handles watch urls with extra parameters such as &t=, youtu.be links, shorts, embeds and live urls.
+
+    Args:
+        url: The url of the video
+    Returns:
+        video_id: The id of the video, or None if the url is not a YouTube video url
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().split(':')[0]
+    for prefix in ('www.', 'm.', 'music.'):
+        host = host.removeprefix(prefix)
+    parts = [part for part in parsed.path.split('/') if part]
+
+    if host == 'youtu.be':
+        return parts[0] if parts else None
+    if host in ('youtube.com', 'youtube-nocookie.com'):
+        if video_id := parse_qs(parsed.query).get('v'):
+            return video_id[0]
+        if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v', 'e'):
+            return parts[1]
+    return None
+
+
+def fetch_skip_ranges(video_id: str, categories: Optional[List[str]] = None) -> List[Tuple[int, int]]:
+    """
+    Fetches the sponsor segments of a video from SponsorBlock
+
+    Args:
+        video_id: The id of the YouTube video
+        categories: Categories of segments to fetch. Defaults to SPONSOR_CATEGORIES
+    Returns:
+        ranges: Start and end of every segment in milliseconds, empty if there are none or SponsorBlock is unreachable
+    """
+    try:
+        import sponsorblock as sb
+
+        segments = sb.Client().get_skip_segments(video_id, categories=categories or SPONSOR_CATEGORIES)
+    except Exception as e:
+        # Also raised when the video has no segments
+        logging.debug(f'No sponsor segments for {video_id}: {e}')
+        return []
+    return sorted((int(segment.start * 1000), int(segment.end * 1000)) for segment in segments)
+
+
+class GrowingFile:
+    def __init__(self, path: str, poll_interval: Optional[float] = 0.1) -> None:
+        """
+        A file that is still being written by a download, which can be read while it grows
+
+        Args:
+            path: Path the download writes to
+            poll_interval: Seconds to wait for more data when the reader caught up with the download
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Called by the downloader once it wrote the whole file, or failed with error
+        """
+        self.error = error
+        self.done.set()
+
+    def wait(self) -> None:
+        """
+        Blocks until the download is complete, raising its error if it failed
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def iter_bytes(self, chunk_size: Optional[int] = 64 * 1024) -> Iterator[bytes]:
+        """
+        Yields the content of the file as it is written, until the download is complete
+
+        Raises:
+            The error of the download if it failed
+        """
+        while not os.path.exists(self.path):
+            if self.done.wait(self.poll_interval):
+                self.wait()
+                break
+
+        with open(self.path, 'rb') as file:
+            while True:
+                # Checked before reading, so nothing written before completion is missed
+                finished = self.done.is_set()
+                if chunk := file.read(chunk_size):
+                    yield chunk
+                elif finished:
+                    break
+                else:
+                    self.done.wait(self.poll_interval)
+
+        self.wait()
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def working_dir(tmp_path, monkeypatch):
+    """
+    Runs every test in its own directory, the app writes its caches and logs to the working directory
+    """
+    monkeypatch.chdir(tmp_path)
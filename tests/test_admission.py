@@ -0,0 +1,101 @@
+import threading
+
+import time
+
+import pytest
+
+from query_handler.admission import AdmissionController, SingleFlight
+
+from utils.error_handler import OverloadedError
+
+
+def start(target, count=1):
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_error_of_leader_reaches_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        release.wait()
+        raise ConnectionError('LLM is down')
+
+    def ask():
+        try:
+            flight.do('question', fail)
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = start(ask, 4)
+    while len(flight.calls) == 0:
+        time.sleep(0.01)
+    # Every caller has joined the flight before the leader fails
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert len(errors) == 4
+    assert len({id(error) for error in errors}) == 1
+    assert flight.calls == {}
+
+
+def test_shed_once_queue_is_full():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=1)
+    release = threading.Event()
+
+    def hold():
+        with controller.admit():
+            release.wait()
+
+    threads = start(hold, 2)
+    while controller.active < 1 or controller.waiting < 1:
+        time.sleep(0.01)
+
+    assert controller.is_full()
+    with pytest.raises(OverloadedError):
+        controller.acquire()
+    assert controller.shed == 1
+
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert controller.active == 0 and controller.waiting == 0
+
+
+def test_shed_after_waiting_too_long():
+    controller = AdmissionController('test', max_concurrency=1, max_queue=1, queue_timeout=0.1)
+    controller.acquire()
+
+    with pytest.raises(OverloadedError):
+        controller.acquire()
+    controller.release()
+    assert controller.waiting == 0
+
+
+def test_concurrent_calls_capped():
+    controller = AdmissionController('test', max_concurrency=2, max_queue=10)
+    lock = threading.Lock()
+    running = 0
+    most = 0
+
+    def call():
+        nonlocal running, most
+        with controller.admit():
+            with lock:
+                running += 1
+                most = max(most, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+
+    for thread in start(call, 8):
+        thread.join(timeout=5)
+
+    assert most == 2
+    assert controller.active == 0
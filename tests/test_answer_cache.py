@@ -0,0 +1,89 @@
+import hashlib
+
+import re
+
+import numpy as np
+
+import pytest
+
+pytest.importorskip('faiss')
+
+from query_handler import answer_cache
+from query_handler.answer_cache import AnswerCache
+
+
+TRANSCRIPT = 'transcript-key:stub-llm'
+STOP_WORDS = {'the', 'a', 'is', 'of', 'when', 'what', 'did', 'they', 'will'}
+
+
+def embed(question):
+    """
+    Bag of words embedding, questions with the same content words get the same vector
+    """
+    vector = np.zeros(64, dtype=np.float32)
+    for word in re.findall(r'\w+', question.lower()):
+        if word not in STOP_WORDS:
+            vector[int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), 'little') % 64] += 1
+    return vector.tolist()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(answer_cache.time, 'time', clock)
+    return clock
+
+
+def store(cache, question, answer):
+    cache.store(TRANSCRIPT, question, embed(question), answer, latency=2.0)
+
+
+def test_similar_question_hits(tmp_path, clock):
+    cache = AnswerCache(str(tmp_path / 'answers.sqlite3'))
+    store(cache, 'When is the launch date?', 'In March.')
+
+    assert cache.lookup(TRANSCRIPT, embed('when is the launch date')) == 'In March.'
+    assert cache.lookup(TRANSCRIPT, embed('What did they decide about the budget?')) is None
+    assert cache.lookup('other-transcript:stub-llm', embed('When is the launch date?')) is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3, 'saved_seconds': 2.0}
+
+
+def test_expired_answer_misses(tmp_path, clock):
+    cache = AnswerCache(str(tmp_path / 'answers.sqlite3'), ttl=60)
+    store(cache, 'When is the launch date?', 'In March.')
+    assert cache.lookup(TRANSCRIPT, embed('When is the launch date?')) == 'In March.'
+
+    clock.now += 61
+    assert cache.lookup(TRANSCRIPT, embed('When is the launch date?')) is None
+    # Also not loaded again from disk
+    assert AnswerCache(str(tmp_path / 'answers.sqlite3'), ttl=60).lookup(
+        TRANSCRIPT, embed('When is the launch date?')) is None
+
+
+def test_least_recently_used_answer_evicted(tmp_path, clock):
+    cache = AnswerCache(str(tmp_path / 'answers.sqlite3'), max_entries=2)
+    store(cache, 'When is the launch date?', 'In March.')
+    store(cache, 'Who approved the budget?', 'The board.')
+    assert cache.lookup(TRANSCRIPT, embed('When is the launch date?')) == 'In March.'
+
+    store(cache, 'Where does the office move?', 'To the fourth floor.')
+
+    assert cache.lookup(TRANSCRIPT, embed('When is the launch date?')) == 'In March.'
+    assert cache.lookup(TRANSCRIPT, embed('Who approved the budget?')) is None
+    assert cache.lookup(TRANSCRIPT, embed('Where does the office move?')) == 'To the fourth floor.'
+
+
+def test_answers_reloaded_from_disk(tmp_path, clock):
+    store(AnswerCache(str(tmp_path / 'answers.sqlite3')), 'When is the launch date?', 'In March.')
+
+    cache = AnswerCache(str(tmp_path / 'answers.sqlite3'))
+    assert cache.lookup(TRANSCRIPT, embed('When is the launch date?')) == 'In March.'
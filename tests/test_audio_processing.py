@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+sr = pytest.importorskip('speech_recognition')
+pytest.importorskip('langchain')
+
+from langchain.document_loaders.blob_loaders import Blob
+
+from speech_tools.audio_processing import SAMPLE_RATE, SAMPLE_WIDTH
+
+from utils.benchmark import StubSpeechRecognitionParser
+
+
+LATENCY = 0.2
+CHUNKS = 8
+
+
+class ChunkedStubParser(StubSpeechRecognitionParser):
+    """
+    Stand-in recognizer fed with one second chunks of distinct audio, without decoding a file
+    """
+
+    def _export_chunks(self, blob):
+        for number in range(1, CHUNKS + 1):
+            pcm = bytes([number]) * (SAMPLE_RATE * SAMPLE_WIDTH)
+            metadata = {'start_time': (number - 1) * 1000, 'end_time': number * 1000, 'source': blob.source,
+                        'chunk': number, 'error_message': '', 'total_duration': CHUNKS * 1000,
+                        'total_chunks': CHUNKS}
+            yield sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH), metadata
+
+
+def transcribe(max_workers):
+    parser = ChunkedStubParser(latency=LATENCY, max_workers=max_workers)
+    start = time.perf_counter()
+    docs = list(parser.lazy_parse(Blob(data=b'', path='stub.wav')))
+    return time.perf_counter() - start, docs
+
+
+def test_chunks_recognized_concurrently_in_order():
+    serial_time, serial_docs = transcribe(1)
+    parallel_time, parallel_docs = transcribe(4)
+
+    assert serial_time >= CHUNKS * LATENCY
+    assert parallel_time < serial_time / 2
+    assert [doc.metadata['chunk'] for doc in parallel_docs] == list(range(1, CHUNKS + 1))
+    assert [doc.page_content for doc in parallel_docs] == [doc.page_content for doc in serial_docs]
+
+
+def test_google_concurrency_from_env(monkeypatch):
+    from speech_tools.audio_processing import _google_parser
+    from utils.constants import Language
+
+    monkeypatch.setenv('GOOGLE_MAX_WORKERS', '3')
+    assert _google_parser(Language.US_English, None, None, None).max_workers == 3
+    assert _google_parser(Language.US_English, None, 6, None).max_workers == 6
@@ -0,0 +1,84 @@
+import pytest
+
+pytest.importorskip('langchain')
+
+from langchain.chains import RetrievalQA
+from langchain.schema import Document
+
+from query_handler.bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+
+from utils.constants import RetrievalMode
+
+
+CORPUS = [
+    'The launch moves to the second week of March because the supplier is late.',
+    'Marketing will announce the new launch date on Friday.',
+    'The quarterly budget was approved, with more money for hiring engineers.',
+    'Two senior engineers and a designer join the team in April.',
+    'The office moves to the fourth floor of the building next month.',
+]
+
+
+def make_index():
+    index = BM25Index()
+    index.add_documents([Document(page_content=text, metadata={'chunk': number})
+                         for number, text in enumerate(CORPUS)])
+    return index
+
+
+def test_tokenize_drops_stop_words():
+    assert tokenize('When will THE launch happen, and where?') == ['launch', 'happen']
+
+
+def test_rare_words_rank_first():
+    index = make_index()
+
+    # supplier is in one document, launch in two
+    ranked = [doc.metadata['chunk'] for doc, _ in index.search('launch supplier', k=5)]
+    assert ranked == [0, 1]
+    # Documents sharing no word with the query are not returned
+    assert sorted(doc.metadata['chunk'] for doc, _ in index.search('engineers', k=5)) == [2, 3]
+    assert index.search('what is it', k=5) == []
+
+
+def test_repeated_term_scores_higher():
+    index = BM25Index()
+    index.add_documents([Document(page_content='budget review notes today'),
+                         Document(page_content='budget budget review today')])
+
+    (best, best_score), (other, other_score) = index.search('budget')
+    assert best.page_content == 'budget budget review today'
+    assert best_score > other_score > 0
+
+
+def test_saved_index_ranks_the_same(tmp_path):
+    index = make_index()
+    index.save_local(str(tmp_path))
+
+    loaded = BM25Index.load_local(str(tmp_path))
+    assert [doc.page_content for doc, _ in loaded.search('launch supplier')] == \
+        [doc.page_content for doc, _ in index.search('launch supplier')]
+
+
+def test_fusion_favours_documents_both_rankings_agree_on():
+    a, b, c = (Document(page_content=text) for text in 'abc')
+
+    # b is second in both rankings, a and c first in only one
+    assert reciprocal_rank_fusion([[a, b], [c, b]])[0] is b
+    assert reciprocal_rank_fusion([[a, b, c], [a, c, b]]) == [a, b, c]
+
+
+@pytest.mark.parametrize('mode', [RetrievalMode.BM25, RetrievalMode.HYBRID])
+def test_lexical_retrievers_answer_through_retrieval_qa(tmp_path, mode):
+    pytest.importorskip('faiss')
+    from utils.benchmark import BenchmarkQueryHandler
+
+    handler = BenchmarkQueryHandler(str(tmp_path), embedding_latency=0.0, llm_latency=0.0, retrieval_mode=mode)
+    handler.load_text([Document(page_content=text, metadata={'start_time': 0, 'end_time': 1000})
+                       for text in CORPUS], 'session')
+
+    session = handler.sessions.get('session', handler.new_memory)
+    assert isinstance(session.qa_chain, RetrievalQA)
+    assert handler.query('Why is the supplier late?', 'session') == handler.falcon_llm.answer
+    # The best matching chunk made it into the prompt
+    assert CORPUS[0] in handler.falcon_llm.prompts[-1]
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip('tiktoken')
+pytest.importorskip('langchain')
+
+from langchain.schema import Document
+
+from query_handler.context_packing import GAP, ContextPacker, split_spans
+
+
+SENTENCES = [f'Item {number} of the agenda went on for a while without any decision.' for number in range(30)]
+MATCH = 'The launch moves to the second week of March because the supplier is late.'
+
+
+def make_packer(max_tokens):
+    packer = ContextPacker(max_tokens=max_tokens)
+    # Counted from the characters, so the budget does not depend on the tiktoken encoding being downloaded
+    packer.encoding = None
+    return packer
+
+
+def spent(packer, text):
+    """
+    Budget the spans of a packed text took, a token each for the space they are joined with
+    """
+    return sum(packer.count_tokens(span) + 1 for span in split_spans(text, packer.max_span_words))
+
+
+def test_budget_filled_around_the_match():
+    text = ' '.join(SENTENCES[:15] + [MATCH] + SENTENCES[15:])
+    packer = make_packer(120)
+
+    [doc] = packer.pack('When is the launch?', [Document(page_content=text)])
+
+    assert MATCH in doc.page_content
+    # The sentences on both sides of the match fill the budget, rather than the match alone
+    assert f'{SENTENCES[14]} {MATCH} {SENTENCES[15]}' in doc.page_content
+    assert GAP not in doc.page_content
+    # Less is left than another sentence would take
+    assert 120 - packer.count_tokens(SENTENCES[0]) - 1 < spent(packer, doc.page_content) <= 120
+
+
+def test_best_ranked_documents_kept_without_matches():
+    docs = [Document(page_content=' '.join(SENTENCES[:15])), Document(page_content=' '.join(SENTENCES[15:]))]
+    packer = make_packer(100)
+
+    packed = packer.pack('What did they conclude about pricing?', docs)
+
+    assert len(packed) == 1
+    assert packed[0].page_content.startswith(f'{SENTENCES[0]} {SENTENCES[1]}')
+    assert 100 - packer.count_tokens(SENTENCES[0]) - 1 < spent(packer, packed[0].page_content) <= 100
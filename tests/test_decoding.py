@@ -0,0 +1,42 @@
+import stat
+
+import sys
+
+import threading
+
+import pytest
+
+pytest.importorskip('pydub')
+
+from speech_tools.decoding import BYTES_PER_MS, iter_pcm_windows
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the stand-in converter is a script')
+
+SECONDS = 2
+
+
+@pytest.fixture
+def noisy_converter(tmp_path):
+    """
+    Stand-in for ffmpeg writing far more warnings than a pipe holds before any audio
+    """
+    script = tmp_path / 'ffmpeg'
+    script.write_text(f'#!{sys.executable}\n'
+                      'import sys\n'
+                      'sys.stderr.write("warning: damaged frame\\n" * 20000)\n'
+                      'sys.stderr.flush()\n'
+                      f'sys.stdout.buffer.write(bytes({SECONDS * 1000 * BYTES_PER_MS}))\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script)
+
+
+def test_warnings_do_not_block_decoding(noisy_converter, tmp_path):
+    windows = []
+    reader = threading.Thread(target=lambda: windows.extend(
+        iter_pcm_windows(str(tmp_path / 'audio.mp3'), 1000, converter=noisy_converter)), daemon=True)
+    reader.start()
+    reader.join(timeout=30)
+
+    assert not reader.is_alive()
+    assert [start for start, _ in windows] == [1000 * second for second in range(SECONDS)]
@@ -0,0 +1,100 @@
+import numpy as np
+
+import pytest
+
+faiss = pytest.importorskip('faiss')
+pytest.importorskip('langchain')
+
+from query_handler.faiss_index import (IndexOptions, build_index, faiss_from_embeddings, index_type_of,
+                                       rebuild_for_size)
+
+from utils.benchmark import StubEmbeddings
+from utils.constants import IndexType
+
+
+DIMENSION = 32
+
+
+def clustered_vectors(count, seed=0):
+    """
+    Vectors around 20 centers, as embeddings of a transcript cluster around its topics
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((20, DIMENSION))
+    return (centers[rng.integers(0, 20, count)] + 0.3 * rng.standard_normal((count, DIMENSION))).astype(np.float32)
+
+
+def make_db(vectors):
+    return faiss_from_embeddings([(f'chunk {i}', vector.tolist()) for i, vector in enumerate(vectors)],
+                                 StubEmbeddings(dimension=DIMENSION, latency=0.0),
+                                 metadatas=[{'chunk': i} for i in range(len(vectors))])
+
+
+def test_index_type_by_size():
+    options = IndexOptions(hnsw_min_vectors=100, ivfpq_min_vectors=1000)
+
+    assert options.index_type(99) == IndexType.FLAT
+    assert options.index_type(100) == IndexType.HNSW
+    assert options.index_type(999) == IndexType.HNSW
+    assert options.index_type(1000) == IndexType.IVF_PQ
+
+
+def test_options_from_env(monkeypatch):
+    monkeypatch.setenv('RETRIEVAL_K', '5')
+    monkeypatch.setenv('FAISS_HNSW_MIN_VECTORS', '2000')
+    monkeypatch.setenv('FAISS_NPROBE', '32')
+    monkeypatch.setenv('FAISS_THREADS', '')
+
+    options = IndexOptions.from_env()
+    assert (options.k, options.hnsw_min_vectors, options.nprobe) == (5, 2000, 32)
+    defaults = IndexOptions()
+    assert (options.ivfpq_min_vectors, options.ef_search, options.refine_factor, options.threads) == \
+        (defaults.ivfpq_min_vectors, defaults.ef_search, defaults.refine_factor, defaults.threads)
+
+
+@pytest.mark.parametrize('index_type', list(IndexType))
+def test_built_index_has_type_and_search_params(index_type):
+    options = IndexOptions(k=5, ef_search=40, nprobe=7, refine_factor=9, threads=1)
+    index = build_index(clustered_vectors(2000), index_type, options)
+
+    assert index_type_of(index) == index_type
+    assert index.ntotal == 2000
+    if index_type == IndexType.HNSW:
+        assert index.hnsw.efSearch == 40
+    if index_type == IndexType.IVF_PQ:
+        assert faiss.try_extract_index_ivf(index).nprobe == 7
+        assert index.k_factor == 9
+
+
+@pytest.mark.parametrize('index_type, options', [
+    (IndexType.HNSW, IndexOptions(hnsw_min_vectors=1000, ivfpq_min_vectors=10000, threads=1)),
+    (IndexType.IVF_PQ, IndexOptions(hnsw_min_vectors=500, ivfpq_min_vectors=1000, threads=1)),
+])
+def test_rebuild_keeps_documents_and_results(index_type, options):
+    vectors = clustered_vectors(2000)
+    db = make_db(vectors)
+    queries = clustered_vectors(50, seed=1)
+    expected = [[doc.metadata['chunk'] for doc in db.similarity_search_by_vector(query.tolist(), k=3)]
+                for query in queries]
+    docstore_ids = dict(db.index_to_docstore_id)
+
+    assert rebuild_for_size(db, options)
+    assert index_type_of(db.index) == index_type
+    assert db.index_to_docstore_id == docstore_ids
+    # A stored vector finds its own document
+    assert db.similarity_search_by_vector(vectors[123].tolist(), k=1)[0].page_content == 'chunk 123'
+
+    found = [[doc.metadata['chunk'] for doc in db.similarity_search_by_vector(query.tolist(), k=3)]
+             for query in queries]
+    recall = np.mean([len(set(a) & set(b)) / 3 for a, b in zip(expected, found)])
+    assert recall >= 0.9
+    # Already of the type for its size
+    assert not rebuild_for_size(db, options)
+
+
+def test_small_transcript_keeps_flat_index():
+    db = make_db(clustered_vectors(200))
+    index = db.index
+
+    assert not rebuild_for_size(db, IndexOptions())
+    assert db.index is index
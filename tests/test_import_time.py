@@ -0,0 +1,56 @@
+import ast
+
+import os
+
+import subprocess
+
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['torch', 'langchain', 'transformers', 'sentence_transformers', 'faiss', 'openai']
+# Streamlit itself takes most of it, torch or langchain alone take longer. Set IMPORT_TIME_BUDGET_MS on slow machines.
+BUDGET_US = int(os.environ.get('IMPORT_TIME_BUDGET_MS', 3000)) * 1000
+MARKER = 'main imports start'
+
+
+def main_imports():
+    """
+    Modules main.py imports at the top level, before the first page is rendered
+    """
+    with open(os.path.join(ROOT, 'main.py')) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module != '__future__':
+            modules.append(node.module)
+    return modules
+
+
+def test_main_imports_stay_light():
+    modules = main_imports()
+    assert 'streamlit' in modules
+    for module in modules:
+        pytest.importorskip(module)
+
+    code = (f'import sys\n'
+            f'sys.stderr.write({MARKER!r} + "\\n")\n'
+            f'import {", ".join(modules)}\n'
+            f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            check=True, cwd=ROOT)
+
+    lines = result.stderr.splitlines()
+    imports = [line for line in lines[lines.index(MARKER) + 1:] if line.startswith('import time:')]
+    # Modules main imported first hand, the cumulative time of each includes everything it imported in turn
+    top_level = [line for line in imports if line.split('|')[2].startswith(' ') and line.split('|')[2][1] != ' ']
+    total = sum(int(line.split('|')[1]) for line in top_level)
+    slowest = '\n'.join(sorted(imports, key=lambda line: -int(line.split('|')[1]))[:10])
+
+    loaded = result.stdout.strip()
+    assert not loaded, f'main.py imports {loaded}, slowest imports:\n{slowest}'
+    assert total <= BUDGET_US, f'main.py imports take {total / 1000:.0f} ms, slowest imports:\n{slowest}'
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+import pytest
+
+pytest.importorskip('faster_whisper')
+pytest.importorskip('langchain')
+
+from langchain.document_loaders.blob_loaders import Blob
+
+from speech_tools.audio_processing import SAMPLE_RATE, LocalWhisperParser
+from speech_tools.transcription_cache import TranscriptionCache
+
+
+CHUNKS = 4
+
+
+def fixture_chunks():
+    """
+    One second chunks of tones and noise, distinct so none is served from the cache of another
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    for number in range(1, CHUNKS + 1):
+        signal = 0.3 * np.sin(2 * np.pi * 220 * number * t) + 0.05 * rng.standard_normal(SAMPLE_RATE)
+        pcm = (signal * 32767).astype(np.int16).tobytes()
+        metadata = {'start_time': (number - 1) * 1000, 'end_time': number * 1000, 'source': 'fixture.wav',
+                    'chunk': number, 'error_message': '', 'total_duration': CHUNKS * 1000,
+                    'total_chunks': CHUNKS}
+        yield memoryview(pcm), metadata
+
+
+@pytest.fixture
+def parser(tmp_path):
+    """
+    Parser on the tiny model, or on the converted model in LOCAL_WHISPER_MODEL on machines without a network
+    """
+    try:
+        return LocalWhisperParser(model=os.environ.get('LOCAL_WHISPER_MODEL', 'tiny'),
+                                  cache=TranscriptionCache(str(tmp_path / 'transcriptions.sqlite3')),
+                                  max_workers=2, cpu_threads=1)
+    except ValueError as e:
+        pytest.skip(f'Local Whisper model is not available: {e}')
+
+
+def test_chunks_transcribed_concurrently_in_order(parser, monkeypatch):
+    serial = [parser.engine.transcribe(bytes(pcm)) for pcm, _ in fixture_chunks()]
+
+    monkeypatch.setattr(parser, '_split_chunks', lambda blob: fixture_chunks())
+    docs = list(parser.lazy_parse(Blob(data=b'', path='fixture.wav')))
+
+    assert [doc.metadata['chunk'] for doc in docs] == list(range(1, CHUNKS + 1))
+    # Greedy decoding gives the same text on any worker
+    assert [doc.page_content for doc in docs] == serial
+    for doc in docs:
+        assert bool(doc.metadata['error_message']) == (doc.page_content == '')
+
+
+def test_transcribed_chunks_read_from_cache(parser, monkeypatch):
+    first = [parser._transcribe_chunk(chunk) for chunk in fixture_chunks()]
+
+    def transcribe(pcm):
+        raise AssertionError('transcribed a cached chunk')
+
+    monkeypatch.setattr(parser.engine, 'transcribe', transcribe)
+    for doc, chunk in zip(first, fixture_chunks()):
+        # Chunks nothing was understood in are not cached
+        if doc.page_content:
+            assert parser._transcribe_chunk(chunk).page_content == doc.page_content
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+import pytest
+
+pytest.importorskip('onnxruntime')
+pytest.importorskip('tokenizers')
+pytest.importorskip('torch')
+pytest.importorskip('sentence_transformers')
+pytest.importorskip('langchain')
+
+from query_handler.onnx_embeddings import MODEL_FILE, OnnxEmbeddings, default_onnx_dir
+
+from utils.embedding_accuracy import embed, overlap, top_k
+
+
+# Resolved before the tests change directory, see conftest.py
+FOLDER = os.path.abspath(os.environ.get('ONNX_EMBEDDING_MODEL') or os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), default_onnx_dir('sentence-transformers/all-MiniLM-L6-v2')))
+MIN_COSINE = 0.98
+MIN_OVERLAP = 0.9
+K = 3
+
+DOCUMENTS = [
+    'The launch of the new app moves to the second week of March because the supplier is late.',
+    'Marketing will announce the new launch date to customers on Friday.',
+    'The quarterly budget was approved, with more money for hiring engineers.',
+    'Two senior engineers and a designer will join the team in April.',
+    'The office moves to the fourth floor of the building next month.',
+    'Parking permits for the new building are handed out at the front desk.',
+    'Customer support tickets doubled after the last release because of a login bug.',
+    'The login bug was fixed and the patch ships with the next release.',
+    'The team agreed to hold the retrospective every other Thursday afternoon.',
+    'Lunch on Thursdays is catered by the Italian place around the corner.',
+    'The data center migration finished without downtime over the weekend.',
+    'Backups now run every night and are kept for ninety days.',
+]
+QUESTIONS = [
+    'When is the app launching?',
+    'Who is being hired?',
+    'Where is the office moving?',
+    'Why did support tickets go up?',
+    'How often is the retrospective?',
+    'How long are backups kept?',
+]
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    """
+    Vectors of the corpus and questions from the int8 export and from the full precision model it was exported from
+    """
+    if not os.path.exists(os.path.join(FOLDER, MODEL_FILE)):
+        pytest.skip(f'No exported model in {FOLDER}, export one with `python -m utils.export_onnx_embeddings`')
+    int8_embeddings = OnnxEmbeddings(FOLDER)
+    int8_documents, int8_queries, _ = embed(int8_embeddings, DOCUMENTS, QUESTIONS)
+
+    from langchain.embeddings import HuggingFaceEmbeddings, HuggingFaceInstructEmbeddings
+
+    model_name = int8_embeddings.config['model_name']
+    embeddings_class = HuggingFaceInstructEmbeddings if int8_embeddings.config['instructor'] else HuggingFaceEmbeddings
+    try:
+        torch_embeddings = embeddings_class(model_name=model_name, model_kwargs={'device': 'cpu'})
+    except Exception as e:
+        pytest.skip(f'Could not load {model_name}: {e}')
+    documents, queries, _ = embed(torch_embeddings, DOCUMENTS, QUESTIONS)
+    return documents, queries, int8_documents, int8_queries
+
+
+def test_int8_vectors_close_to_full_precision(vectors):
+    documents, queries, int8_documents, int8_queries = vectors
+    for expected, found in ((documents, int8_documents), (queries, int8_queries)):
+        cosine = (expected * found).sum(axis=1) / np.linalg.norm(expected, axis=1) / np.linalg.norm(found, axis=1)
+        assert cosine.min() >= MIN_COSINE
+
+
+def test_int8_retrieves_the_same_documents(vectors):
+    documents, queries, int8_documents, int8_queries = vectors
+    expected = top_k(documents, queries, K)
+
+    assert (top_k(int8_documents, int8_queries, K)[:, 0] == expected[:, 0]).all()
+    assert overlap(expected, top_k(int8_documents, int8_queries, K)) >= MIN_OVERLAP
+    # The index keeps the int8 vectors as float16
+    float16_documents = int8_documents.astype(np.float16).astype(np.float32)
+    assert overlap(expected, top_k(float16_documents, int8_queries, K)) >= MIN_OVERLAP
@@ -0,0 +1,160 @@
+import threading
+
+import time
+
+import pytest
+
+pytest.importorskip('langchain')
+pytest.importorskip('faiss')
+
+from langchain.schema import Document
+
+from utils.benchmark import BenchmarkQueryHandler, StubLLM
+
+
+ANSWER = 'The meeting moved the launch to the second week of March.'
+TRANSCRIPT = ('We talked about the launch date. The launch moves to the second week of March because the '
+              'supplier is late. Marketing will announce the new date on Friday.')
+
+
+class StreamingStubLLM(StubLLM):
+    """
+    Stub LLM handing its answer to the callbacks a word at a time, as a streaming LLM does
+    """
+    answer: str = ANSWER
+    token_delay: float = 0.02
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(prompt)
+        for i, word in enumerate(self.answer.split(' ')):
+            time.sleep(self.token_delay)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(word if i == 0 else ' ' + word)
+        return self.answer
+
+
+class StreamingHandler(BenchmarkQueryHandler):
+    def load_llm(self):
+        self.falcon_llm = StreamingStubLLM(prompts=[])
+
+
+def make_handler(cache_dir, session_id):
+    handler = StreamingHandler(str(cache_dir), embedding_latency=0.0, llm_latency=0.0)
+    handler.begin_text(session_id)
+    handler.add_documents([Document(page_content=TRANSCRIPT, metadata={'start_time': 0, 'end_time': 10000})],
+                          session_id)
+    handler.finish_text(session_id)
+    return handler
+
+
+def test_stream_query_yields_tokens_as_generated(tmp_path):
+    handler = make_handler(tmp_path / 'streaming', 'session')
+    question = 'When is the launch?'
+
+    arrivals = []
+    tokens = []
+    for token in handler.stream_query(question, 'session'):
+        arrivals.append(time.perf_counter())
+        tokens.append(token)
+
+    # One piece per word, the first one long before the answer is complete
+    assert len(tokens) == len(ANSWER.split(' '))
+    assert arrivals[-1] - arrivals[0] > 0.5 * handler.falcon_llm.token_delay * (len(tokens) - 1)
+    assert ''.join(tokens) == ANSWER
+
+    # Same answer and prompt as the non streaming path
+    plain = make_handler(tmp_path / 'plain', 'session')
+    assert plain.query(question, 'session') == ''.join(tokens)
+    assert plain.falcon_llm.prompts == handler.falcon_llm.prompts
+
+    # The streamed answer was cached, asking again makes no LLM call
+    calls = len(handler.falcon_llm.prompts)
+    assert list(handler.stream_query(question, 'session')) == [ANSWER]
+    assert handler.query(question, 'session') == ANSWER
+    assert len(handler.falcon_llm.prompts) == calls
+
+
+def test_documents_added_while_answer_streams(tmp_path):
+    handler = StreamingHandler(str(tmp_path / 'growing'), embedding_latency=0.0, llm_latency=0.0)
+    handler.begin_text('session')
+    handler.add_documents([Document(page_content=TRANSCRIPT, metadata={'start_time': 0, 'end_time': 10000})],
+                          'session')
+
+    tokens = handler.stream_query('When is the launch?', 'session')
+    first = next(tokens)
+    more = Document(page_content='The budget for the launch was approved as well.',
+                    metadata={'start_time': 10000, 'end_time': 20000})
+    adding = threading.Thread(target=handler.add_documents, args=([more], 'session'))
+    adding.start()
+    # The session is not locked while the LLM answers
+    adding.join(timeout=5 * handler.falcon_llm.token_delay)
+    done = not adding.is_alive()
+
+    assert first + ''.join(tokens) == ANSWER
+    adding.join()
+    assert done
+
+
+def index_incrementally(handler, session_id, input_key=None):
+    handler.begin_text(session_id)
+    for sentence in TRANSCRIPT.split('. '):
+        handler.add_documents([Document(page_content=sentence, metadata={'start_time': 0, 'end_time': 10000})],
+                              session_id)
+    handler.finish_text(session_id, input_key)
+    return handler.sessions.get(session_id, handler.new_memory)
+
+
+def test_transcript_indexed_again_shares_stored_index(tmp_path, monkeypatch):
+    handler = StreamingHandler(str(tmp_path / 'shared'), embedding_latency=0.0, llm_latency=0.0)
+    first = index_incrementally(handler, 'first')
+
+    def save(key, db):
+        raise AssertionError('saved an index already in the store')
+
+    monkeypatch.setattr(handler.index_store, 'save', save)
+    second = index_incrementally(handler, 'second')
+
+    assert second.index_key == first.index_key
+    assert second.db is first.db
+    assert handler.query('When is the launch?', 'second') == ANSWER
+
+
+def test_input_indexed_before_loaded_without_embedding(tmp_path, monkeypatch):
+    handler = StreamingHandler(str(tmp_path / 'inputs'), embedding_latency=0.0, llm_latency=0.0)
+    first = index_incrementally(handler, 'first', input_key='upload-hash')
+    assert not handler.load_input('other-upload-hash', 'second')
+
+    def embed_documents(texts):
+        raise AssertionError('embedded a transcript already in the store')
+
+    monkeypatch.setattr(handler.embeddings, 'embed_documents', embed_documents)
+    assert handler.load_input('upload-hash', 'second')
+
+    second = handler.sessions.get('second', handler.new_memory)
+    assert second.index_key == first.index_key
+    assert second.db is first.db
+    assert second.pending_key is None
+    assert handler.query('When is the launch?', 'second') == ANSWER
+
+
+def test_identical_questions_share_one_llm_call(tmp_path):
+    handler = make_handler(tmp_path / 'flight', 'session-0')
+    for number in range(1, 5):
+        handler.load_text([Document(page_content=TRANSCRIPT, metadata={'start_time': 0, 'end_time': 10000})],
+                          f'session-{number}')
+    calls = len(handler.falcon_llm.prompts)
+    barrier = threading.Barrier(5)
+    answers = []
+
+    def ask(session_id):
+        barrier.wait()
+        answers.append(handler.query('When is the launch?', session_id))
+
+    threads = [threading.Thread(target=ask, args=(f'session-{number}',)) for number in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert answers == [ANSWER] * 5
+    assert len(handler.falcon_llm.prompts) == calls + 1
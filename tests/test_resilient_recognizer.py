@@ -0,0 +1,112 @@
+import random
+
+import threading
+
+import time
+
+import pytest
+
+sr = pytest.importorskip('speech_recognition')
+pytest.importorskip('langchain')
+
+from speech_tools.audio_processing import SAMPLE_RATE, SAMPLE_WIDTH, SpeechRecognitionParser
+from speech_tools.resilient_recognizer import ResilientRecognizer
+
+from utils.fake_speech_server import FaultInjection, serve
+
+
+@pytest.fixture
+def speech_server():
+    servers = []
+
+    def start(**faults):
+        faults = FaultInjection(**faults)
+        servers.append(serve(faults))
+        return faults, f'http://127.0.0.1:{servers[-1].server_address[1]}/speech-api/v2/recognize'
+
+    random.seed(0)
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def sound(number=1):
+    return sr.AudioData(bytes([number]) * (SAMPLE_RATE * SAMPLE_WIDTH // 4), SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+def make_parser(endpoint, **kwargs):
+    parser = SpeechRecognitionParser(endpoint=endpoint, **kwargs)
+    parser.resilient_recognizer.backoff = 0.01
+    return parser
+
+
+def test_time_queued_for_a_worker_is_not_a_timeout():
+    def recognize(_):
+        time.sleep(0.3)
+        return 'ok'
+
+    # Four callers share one worker, the last one waits three requests before its own is sent
+    recognizer = ResilientRecognizer(recognize, timeout=0.5, max_retries=0, max_workers=1)
+    results = []
+    callers = [threading.Thread(target=lambda: results.append(recognizer(sound()))) for _ in range(4)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+
+    assert results == ['ok'] * 4
+
+
+def test_hedges_never_queue_behind_first_requests():
+    release = threading.Event()
+
+    def recognize(_):
+        release.wait(5)
+        return 'ok'
+
+    recognizer = ResilientRecognizer(recognize, timeout=1.0, max_retries=0, max_workers=2, max_hedges=1)
+    recognizer.hedge_delay = lambda: 0.05
+    callers = [threading.Thread(target=recognizer, args=(sound(),)) for _ in range(2)]
+    for caller in callers:
+        caller.start()
+    time.sleep(0.3)
+    release.set()
+    for caller in callers:
+        caller.join()
+
+    # Only one hedging worker, the second straggler is not duplicated
+    assert recognizer.hedges == 1
+
+
+def test_failed_requests_retried(speech_server):
+    faults, endpoint = speech_server(error_rate=0.3, latency=0.01)
+    parser = make_parser(endpoint, max_retries=6)
+
+    assert [parser.recognize(sound(i)) for i in range(10)] == ['hello world'] * 10
+    assert parser.resilient_recognizer.retries > 0
+
+
+def test_slow_requests_hedged(speech_server):
+    faults, endpoint = speech_server(slow_rate=0.4, slow_seconds=5.0, latency=0.02)
+    parser = make_parser(endpoint, timeout=2.0)
+
+    for i in range(10):
+        start = time.perf_counter()
+        assert parser.recognize(sound(i)) == 'hello world'
+        assert time.perf_counter() - start < faults.slow_seconds
+    assert parser.resilient_recognizer.hedges > 0
+
+
+def test_open_circuit_shared_by_transcriptions(speech_server):
+    faults, endpoint = speech_server(down=True)
+    parser = make_parser(endpoint, max_retries=0)
+    for _ in range(parser.resilient_recognizer.breaker.failure_threshold):
+        with pytest.raises(sr.RequestError):
+            parser.recognize(sound())
+    requests = faults.requests
+
+    # Another transcription of the same service fails fast, without sending a request
+    other = make_parser(endpoint, max_retries=0)
+    with pytest.raises(sr.RequestError, match='unavailable'):
+        other.recognize(sound())
+    assert faults.requests == requests
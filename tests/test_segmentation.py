@@ -0,0 +1,69 @@
+import numpy as np
+
+import pytest
+
+pytest.importorskip('pydub')
+
+from speech_tools.decoding import SAMPLE_RATE
+from speech_tools.segmentation import SilenceSegmenter
+from speech_tools.transcription_cache import chunk_key
+
+
+def speech_like(seconds, seed=0):
+    """
+    Harmonic tones of one to six seconds separated by pauses of faint noise
+    """
+    rng = np.random.default_rng(seed)
+    parts = []
+    voiced = True
+    while sum(len(part) for part in parts) < seconds * SAMPLE_RATE:
+        length = int(rng.uniform(1.0, 6.0) * SAMPLE_RATE if voiced else rng.uniform(0.3, 1.2) * SAMPLE_RATE)
+        t = np.arange(length) / SAMPLE_RATE
+        if voiced:
+            pitch = rng.uniform(100, 250)
+            signal = sum(np.sin(2 * np.pi * pitch * harmonic * t) / harmonic for harmonic in range(1, 5))
+            signal = 0.3 * signal * (0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 6) * t))
+            signal += 0.01 * rng.standard_normal(length)
+        else:
+            signal = 0.001 * rng.standard_normal(length)
+        parts.append((np.clip(signal, -1, 1) * 32767).astype(np.int16))
+        voiced = not voiced
+    return np.concatenate(parts)[:seconds * SAMPLE_RATE]
+
+
+def windows(samples, window_ms=60 * 1000):
+    step = SAMPLE_RATE * window_ms // 1000
+    for start in range(0, len(samples), step):
+        yield start * 1000 // SAMPLE_RATE, samples[start:start + step].tobytes()
+
+
+def chunk_keys(samples, max_chunk_ms):
+    segmenter = SilenceSegmenter(max_chunk_ms=max_chunk_ms)
+    return [chunk_key(segment.pcm, 'en-US', 'google') for segment in segmenter.split(windows(samples))]
+
+
+def test_chunks_end_in_pauses_within_max_length():
+    samples = speech_like(300)
+    segments = list(SilenceSegmenter(max_chunk_ms=30 * 1000).split(windows(samples)))
+
+    assert len(segments) > 5
+    for previous, segment in zip(segments, segments[1:]):
+        assert previous.end_time <= segment.start_time
+    for segment in segments:
+        assert len(segment.pcm) // 2 <= 30 * SAMPLE_RATE
+    for segment in segments[:-1]:
+        # Chunks ending in a pause end in the faint noise, not in a tone
+        tail = np.frombuffer(segment.pcm, dtype=np.int16)[-80:]
+        assert np.abs(tail).max() < 1000 or len(segment.pcm) // 2 == 30 * SAMPLE_RATE
+
+
+@pytest.mark.parametrize('trim', [480, 1234, 5 * SAMPLE_RATE + 7])
+@pytest.mark.parametrize('max_chunk_ms', [30 * 1000, 60 * 1000])
+def test_trimmed_recording_reuses_chunks(trim, max_chunk_ms):
+    samples = speech_like(600)
+    keys = set(chunk_keys(samples, max_chunk_ms))
+    trimmed = chunk_keys(samples[trim:], max_chunk_ms)
+
+    # The first chunk starts at the cut, the chunks after it start at the same pauses
+    hits = sum(key in keys for key in trimmed[1:])
+    assert hits >= 0.8 * (len(trimmed) - 1)
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+sr = pytest.importorskip('speech_recognition')
+pytest.importorskip('streamlit')
+pytest.importorskip('langchain')
+
+from speech_tools import transcriber
+from speech_tools.audio_processing import SAMPLE_RATE, SAMPLE_WIDTH
+from speech_tools.jobs import JobManager
+from speech_tools.transcriber import Transcriber
+
+from utils.benchmark import StubSpeechRecognitionParser
+from utils.constants import FileType, JobState, Language
+
+
+LATENCY = 0.1
+CHUNKS = 20
+
+
+class ChunkedStubParser(StubSpeechRecognitionParser):
+    """
+    Stand-in recognizer fed with one second chunks of distinct audio, without decoding a file
+    """
+
+    def _export_chunks(self, blob):
+        for number in range(1, CHUNKS + 1):
+            pcm = bytes([number]) * (SAMPLE_RATE * SAMPLE_WIDTH)
+            metadata = {'start_time': (number - 1) * 1000, 'end_time': number * 1000, 'source': blob.source,
+                        'chunk': number, 'error_message': '', 'total_duration': CHUNKS * 1000,
+                        'total_chunks': CHUNKS}
+            yield sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH), metadata
+
+
+@pytest.fixture
+def stub_parser(monkeypatch):
+    monkeypatch.setattr(transcriber, 'make_parser',
+                        lambda *args, **kwargs: ChunkedStubParser(latency=LATENCY, max_workers=1))
+
+
+def wait(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_cancelled_mid_stream(stub_parser):
+    speech = Transcriber(jobs=JobManager(max_workers=1))
+    job = speech.transcribe(b'audio', 'audio.wav', FileType.FILE, Language.US_English)
+    wait(lambda: len(job.results) >= 2)
+
+    speech.jobs.cancel(job)
+    wait(lambda: not job.active)
+
+    assert job.state == JobState.CANCELLED
+    assert job.error is None
+    assert len(job.results) < CHUNKS
+
+
+def test_cancelled_input_transcribed_again(stub_parser):
+    speech = Transcriber(jobs=JobManager(max_workers=1))
+    cancelled = speech.transcribe(b'audio', 'audio.wav', FileType.FILE, Language.US_English)
+    speech.jobs.cancel(cancelled)
+    wait(lambda: not cancelled.active)
+
+    job = speech.transcribe(b'audio', 'audio.wav', FileType.FILE, Language.US_English)
+    assert job is not cancelled
+    wait(lambda: not job.active, timeout=CHUNKS * LATENCY + 10)
+
+    assert job.state == JobState.DONE
+    assert len(job.results) == CHUNKS
+    assert speech.transcribe(b'audio', 'audio.wav', FileType.FILE, Language.US_English) is job
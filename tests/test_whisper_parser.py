@@ -0,0 +1,104 @@
+import asyncio
+
+import json
+
+import shutil
+
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('langchain')
+
+from speech_tools.audio_processing import SAMPLE_RATE, WhisperParser
+
+
+FFMPEG = shutil.which('ffmpeg')
+pytestmark = pytest.mark.skipif(FFMPEG is None, reason='ffmpeg is not installed')
+
+
+class TranscriptionServer:
+    """
+    Local stand-in of the transcription endpoint of the OpenAI API, answering with the given statuses in turn
+    """
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.uploads = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                server.uploads.append((self.path, body))
+                status = server.statuses.pop(0) if len(server.statuses) > 1 else server.statuses[0]
+                if status == 200:
+                    response = {'text': 'hello world'}
+                else:
+                    response = {'error': {'message': f'injected {status}', 'type': 'server_error'}}
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.api_base = f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+
+
+@pytest.fixture
+def transcription_server():
+    servers = []
+
+    def start(*statuses):
+        servers.append(TranscriptionServer(statuses))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.httpd.shutdown()
+
+
+def transcribe(server, max_retries=2):
+    parser = WhisperParser('sk-test', 'test', api_base=server.api_base)
+    parser.engine.converter = FFMPEG
+    parser.engine.max_retries = max_retries
+    parser.engine.backoff = 0.01
+    pcm = memoryview(bytes(SAMPLE_RATE * 2))
+    metadata = {'start_time': 0, 'end_time': 1000, 'source': 'test', 'chunk': 1, 'error_message': ''}
+    return asyncio.run(parser._transcribe_chunk((pcm, metadata)))
+
+
+def test_chunk_uploaded_as_opus(transcription_server):
+    server = transcription_server(200)
+    doc = transcribe(server)
+
+    assert doc.page_content == 'hello world'
+    path, body = server.uploads[0]
+    assert path == '/v1/audio/transcriptions'
+    assert b'test/chunk1.ogg' in body and b'OggS' in body
+
+
+def test_server_errors_retried(transcription_server):
+    server = transcription_server(500, 503, 200)
+    doc = transcribe(server)
+
+    assert doc.page_content == 'hello world'
+    assert len(server.uploads) == 3
+
+
+def test_persistent_server_error_fails_only_the_chunk(transcription_server):
+    server = transcription_server(500)
+    doc = transcribe(server, max_retries=1)
+
+    assert doc.page_content == ''
+    assert 'Whisper API' in doc.metadata['error_message']
+    assert len(server.uploads) == 2
@@ -0,0 +1,122 @@
+import os
+
+import threading
+
+import time
+
+from functools import partial
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('yt_dlp')
+pytest.importorskip('langchain')
+
+from speech_tools import audio_processing
+from speech_tools.audio_processing import CustomYoutubeAudioLoader
+
+
+class SlowFileHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files a few kilobytes at a time, so downloads of them overlap, counting the files served in full
+    """
+    served = []
+
+    def copyfile(self, source, outputfile):
+        while chunk := source.read(16 * 1024):
+            outputfile.write(chunk)
+            time.sleep(0.01)
+        self.served.append(self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # yt_dlp closes the connection once it has seen enough of a file to extract its info
+        pass
+
+
+@pytest.fixture
+def file_server(tmp_path, monkeypatch):
+    served = tmp_path / 'served'
+    served.mkdir()
+    for name in ('talk', 'other'):
+        (served / f'{name}.wav').write_bytes(name.encode() * 200000)
+    SlowFileHandler.served = []
+
+    server = QuietServer(('127.0.0.1', 0), partial(SlowFileHandler, directory=str(served)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Direct file links report no duration, the files are not real audio to probe
+    monkeypatch.setattr(audio_processing, 'probe_duration', lambda path: 1000)
+    yield served, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def load(url, save_dir, **kwargs):
+    """
+    Reads the audio of url the way the parsers do, as it downloads
+    """
+    blob, = CustomYoutubeAudioLoader([url], str(save_dir), **kwargs).yield_blobs()
+    if blob.download is None:
+        with open(blob.path, 'rb') as f:
+            return f.read()
+    return b''.join(blob.download.iter_bytes())
+
+
+def test_sessions_share_a_download_in_progress(file_server, tmp_path):
+    served, base_url = file_server
+    save_dir = tmp_path / 'downloads'
+    results = []
+    sessions = [threading.Thread(target=lambda: results.append(load(f'{base_url}/talk.wav', save_dir)))
+                for _ in range(3)]
+    # Each session starts while the download of the one before it is in progress
+    for session in sessions:
+        session.start()
+        time.sleep(0.2)
+    for session in sessions:
+        session.join()
+
+    assert results == [(served / 'talk.wav').read_bytes()] * 3
+    # The server counts a file once it wrote its last bytes, shortly after the client read them
+    time.sleep(0.5)
+    assert SlowFileHandler.served == ['/talk.wav']
+    assert sorted(os.listdir(save_dir)) == ['talk.download.json', 'talk.wav']
+    # Complete, later sessions read the cached file
+    assert load(f'{base_url}/talk.wav', save_dir) == (served / 'talk.wav').read_bytes()
+
+
+def test_cache_keeps_recent_downloads_within_budget(file_server, tmp_path):
+    served, base_url = file_server
+    save_dir = tmp_path / 'downloads'
+    budget = os.path.getsize(served / 'talk.wav') + os.path.getsize(served / 'other.wav') // 2
+
+    load(f'{base_url}/talk.wav', save_dir, max_cache_bytes=budget)
+    load(f'{base_url}/other.wav', save_dir, max_cache_bytes=budget)
+
+    assert sorted(os.listdir(save_dir)) == ['other.download.json', 'other.wav']
+    assert load(f'{base_url}/talk.wav', save_dir, max_cache_bytes=budget) == (served / 'talk.wav').read_bytes()
+    assert sorted(os.listdir(save_dir)) == ['talk.download.json', 'talk.wav']
+
+
+def test_leftover_download_removed_before_it_is_shared(file_server, tmp_path, monkeypatch):
+    served, base_url = file_server
+    save_dir = tmp_path / 'downloads'
+    save_dir.mkdir()
+    # An interrupted download leaves a partial file and no cache marker
+    leftover = save_dir / 'talk.wav'
+    leftover.write_bytes(b'partial')
+    removed = []
+    remove = os.remove
+
+    def record_remove(path, *args, **kwargs):
+        removed.append((str(path), str(path) in audio_processing._downloads))
+        remove(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'remove', record_remove)
+
+    assert load(f'{base_url}/talk.wav', save_dir) == (served / 'talk.wav').read_bytes()
+    # Sessions joining the download never see the leftover
+    assert removed == [(str(leftover), False)]
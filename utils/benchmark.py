@@ -0,0 +1,443 @@
+"""
+Benchmark of the audio -> transcript -> index -> answer pipeline
+
+Generates synthetic speech-like audio of several lengths and runs it through the real parser, text
+splitter, FAISS index and retrieval chain. The speech recognizer, embedding model and LLM are replaced by
+stubs with a configurable latency, so runs are reproducible, free and do not need a network.
+
+For every audio length it records the wall time and peak resident memory of each stage:
+    decode        ffmpeg decoding the file into 16 kHz mono windows
+    chunk_export  decode, plus splitting at pauses and packing chunks for the recognizer
+    recognition   the whole parser, chunks recognized concurrently by the stub recognizer
+    split         splitting the transcript into the documents that get embedded
+    embed         embedding the split documents, through the embedding cache as the app does
+    index         load_text building and saving the FAISS index, embeddings already cached
+    retrieval     similarity searches of the questions, per question latency
+    answer        questions answered by the retrieval chain with the stub LLM, per question latency, and the
+                  mean tokens of the prompts sent to it
+
+Usage:
+    python -m utils.benchmark --minutes 1 10 60 180 --output benchmark.json
+    python -m utils.benchmark --minutes 1 10 --baseline benchmark.json --tolerance 0.2
+
+With --baseline the run is compared against an earlier result and the command fails if a stage got slower
+by more than the tolerance.
+"""
+from typing import Any, Dict, List, Optional
+
+import argparse
+
+import hashlib
+
+import json
+
+import logging
+
+import os
+
+import platform
+
+import sys
+
+import tempfile
+
+import threading
+
+import time
+
+import wave
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.document_loaders.blob_loaders import Blob
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+# Imported before the ffmpeg path is overridden, it sets the web app's paths on import
+from speech_tools.audio_processing import AudioSegment, SpeechRecognitionParser, blob_windows
+
+from query_handler.abstract_query_handler import AbstractQueryHandler
+from query_handler.answer_cache import AnswerCache
+from query_handler.cached_embeddings import CachedEmbeddings, EmbeddingStore
+from query_handler.index_store import IndexStore
+
+from utils.constants import RetrievalMode
+
+
+SAMPLE_RATE = 16000
+WORDS_PER_MINUTE = 150
+SESSION_ID = 'benchmark'
+# Slowdowns smaller than this are noise, whatever the relative change
+MIN_REGRESSION_MS = 5
+
+
+def current_rss() -> Optional[int]:
+    """
+    Returns the resident memory of this process in bytes, or None if it cannot be read on this platform
+    """
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class PeakRss:
+    def __init__(self, interval: Optional[float] = 0.01) -> None:
+        """
+        Samples the resident memory of the process on a background thread and keeps the peak
+
+        Args:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            if (rss := current_rss()) is not None:
+                self.peak = max(self.peak or 0, rss)
+
+    def __enter__(self) -> 'PeakRss':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stopped.set()
+        self.thread.join()
+        if (rss := current_rss()) is not None:
+            self.peak = max(self.peak or 0, rss)
+
+
+@contextmanager
+def stage(results: Dict[str, dict], name: str):
+    """
+    Records the wall time and peak resident memory of the code run in the block under results[name]
+
+    The block can add its own measurements to the dictionary it is given.
+    """
+    result = {}
+    start = time.perf_counter()
+    with PeakRss() as rss:
+        yield result
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = rss.peak / 2 ** 20 if rss.peak is not None else None
+    results[name] = result
+    logging.info(f'{name}: {result["seconds"]:.2f}s')
+
+
+def latency_summary(latencies: List[float]) -> dict:
+    """
+    Median, 95th percentile and maximum of latencies in milliseconds
+    """
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'max_ms': float(latencies.max())}
+
+
+def synthesize_speech(path: str, seconds: int, seed: Optional[int] = 0) -> None:
+    """
+    Writes a 16 kHz mono WAV file that looks like speech to the segmenter
+
+    Voiced stretches of one to six seconds are harmonic tones with a syllable rate envelope, separated by
+    pauses of faint noise, so chunks are cut in pauses as they are for real recordings.
+
+    Args:
+        path: Path of the WAV file
+        seconds: Length of the audio
+        seed: Seed of the random generator, the same seed always gives the same file
+    """
+    rng = np.random.default_rng(seed)
+    remaining = seconds * SAMPLE_RATE
+    voiced = True
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        while remaining > 0:
+            length = min(remaining, int(rng.uniform(1.0, 6.0) * SAMPLE_RATE if voiced
+                                        else rng.uniform(0.3, 1.2) * SAMPLE_RATE))
+            t = np.arange(length) / SAMPLE_RATE
+            if voiced:
+                pitch = rng.uniform(100, 250)
+                signal = sum(np.sin(2 * np.pi * pitch * harmonic * t) / harmonic for harmonic in range(1, 5))
+                envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 6) * t)
+                signal = 0.3 * signal * envelope + 0.01 * rng.standard_normal(length)
+            else:
+                signal = 0.001 * rng.standard_normal(length)
+
+            f.writeframes((np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+            remaining -= length
+            voiced = not voiced
+
+
+def stub_words(seed: bytes, count: int) -> str:
+    """
+    Pseudo random words, the same seed always gives the same text
+    """
+    rng = np.random.default_rng(int.from_bytes(hashlib.blake2b(seed, digest_size=8).digest(), 'little'))
+    syllables = ['ka', 'lo', 'mi', 'ne', 'su', 'ta', 'ri', 'po', 'da', 've', 'zu', 'ba']
+    return ' '.join(''.join(rng.choice(syllables, rng.integers(1, 4))) for _ in range(count))
+
+
+class StubSpeechRecognitionParser(SpeechRecognitionParser):
+    def __init__(self, latency: float, **kwargs: Any) -> None:
+        """
+        SpeechRecognitionParser whose recognizer waits latency seconds and returns pseudo random words
+        at a speaking rate, instead of calling the Google Speech Recognition API
+
+        Requests still go through the retrying and hedging recognizer, as in the app.
+        """
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def _recognize_once(self, sound: Any) -> str:
+        time.sleep(self.latency)
+        seconds = len(sound.frame_data) / sound.sample_rate / sound.sample_width
+        return stub_words(sound.frame_data[:4096], max(1, int(seconds / 60 * WORDS_PER_MINUTE)))
+
+
+class StubEmbeddings(Embeddings):
+    def __init__(self, dimension: Optional[int] = 768, latency: Optional[float] = 0.002) -> None:
+        """
+        Embedding model returning a pseudo random unit vector per text
+
+        Args:
+            dimension: Size of the vectors, 768 as instructor-xl
+            latency: Seconds spent per embedded text
+        """
+        self.dimension = dimension
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        rng = np.random.default_rng(int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little'))
+        vector = rng.standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+class StubLLM(LLM):
+    """
+    LLM that waits latency seconds and returns a fixed answer, keeping the prompts it was sent
+    """
+    latency: float = 0.5
+    answer: str = 'This is a benchmark answer.'
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return 'stub'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        self.prompts.append(prompt)
+        time.sleep(self.latency)
+        return self.answer
+
+
+class BenchmarkQueryHandler(AbstractQueryHandler):
+    embedding_model_name = 'benchmark-stub-embeddings'
+    llm_model_name = 'benchmark-stub-llm'
+
+    def __init__(self, cache_dir: str, embedding_latency: float, llm_latency: float,
+                 retrieval_mode: Optional[RetrievalMode] = RetrievalMode.VECTOR) -> None:
+        """
+        Query handler with stub embeddings and LLM, caching indexes, embeddings and answers in cache_dir
+        so runs do not share or leave behind state
+        """
+        self.cache_dir = cache_dir
+        self.embedding_latency = embedding_latency
+        self.llm_latency = llm_latency
+        super().__init__(retrieval_mode=retrieval_mode)
+        self.index_store = IndexStore(os.path.join(cache_dir, 'indexes'))
+        self.answer_cache = AnswerCache(os.path.join(cache_dir, 'answers.sqlite3'))
+
+    def load_embeddings(self):
+        self.embeddings = CachedEmbeddings(
+            StubEmbeddings(latency=self.embedding_latency),
+            model_name=self.embedding_model_name,
+            store=EmbeddingStore(os.path.join(self.cache_dir, 'embeddings.sqlite3')),
+            batch_size=64,
+        )
+
+    def load_llm(self):
+        self.falcon_llm = StubLLM(latency=self.llm_latency)
+
+
+def benchmark_audio(audio_path: str, minutes: int, args: argparse.Namespace) -> dict:
+    """
+    Runs every stage of the pipeline on one audio file
+
+    Returns:
+        result: Audio length and the measurements of every stage
+    """
+    results = {}
+    audio_seconds = minutes * 60
+    blob = Blob.from_path(audio_path)
+
+    with stage(results, 'decode') as result:
+        result['windows'] = sum(1 for _ in blob_windows(blob, 60 * 1000))
+
+    parser = StubSpeechRecognitionParser(latency=args.recognizer_latency, converter_path=AudioSegment.converter,
+                                         max_workers=args.workers)
+    with stage(results, 'chunk_export') as result:
+        result['chunks'] = sum(1 for _ in parser._export_chunks(blob))
+
+    with stage(results, 'recognition') as result:
+        docs = [doc for doc in parser.lazy_parse(blob) if doc.page_content]
+        result['chunks'] = len(docs)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        handler = BenchmarkQueryHandler(cache_dir, args.embedding_latency, args.llm_latency)
+
+        with stage(results, 'split') as result:
+            texts = handler.text_splitter.split_documents(docs)
+            result['documents'] = len(texts)
+
+        with stage(results, 'embed') as result:
+            handler.embeddings.embed_documents([text.page_content for text in texts])
+            result['documents'] = len(texts)
+
+        with stage(results, 'index') as result:
+            handler.load_text(docs, SESSION_ID)
+
+        questions = [f'What is said about {stub_words(str(i).encode(), 3)}?' for i in range(args.questions)]
+        db = handler.sessions.get(SESSION_ID, handler.new_memory).db
+        with stage(results, 'retrieval') as result:
+            latencies = []
+            for question in questions:
+                start = time.perf_counter()
+                db.similarity_search(question, k=3)
+                latencies.append(time.perf_counter() - start)
+            result.update(latency_summary(latencies))
+
+        with stage(results, 'answer') as result:
+            latencies = []
+            for question in questions:
+                start = time.perf_counter()
+                handler.query(question, SESSION_ID)
+                latencies.append(time.perf_counter() - start)
+            result.update(latency_summary(latencies))
+            if prompts := handler.falcon_llm.prompts:
+                result['prompt_tokens'] = float(np.mean([handler.context_packer.count_tokens(prompt)
+                                                         for prompt in prompts]))
+
+    # Audio seconds processed per wall second, for the stages that go through the whole audio
+    for name in ('decode', 'chunk_export', 'recognition'):
+        results[name]['realtime_factor'] = audio_seconds / results[name]['seconds']
+
+    return {'minutes': minutes, 'stages': results}
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Prints the change of every stage against a baseline run
+
+    Returns:
+        regressions: Stages that got slower by more than tolerance, as 'minutes/stage'
+    """
+    regressions = []
+    baseline_runs = {run['minutes']: run for run in baseline['runs']}
+    print(f'{"audio":>8} {"stage":<14} {"baseline":>10} {"now":>10} {"change":>8}')
+    for run in result['runs']:
+        if (old_run := baseline_runs.get(run['minutes'])) is None:
+            continue
+        for name, measurements in run['stages'].items():
+            if (old := old_run['stages'].get(name)) is None:
+                continue
+            # Latency stages are compared on their median, the others on their wall time
+            metric = 'p50_ms' if 'p50_ms' in measurements else 'seconds'
+            change = measurements[metric] / old[metric] - 1 if old[metric] else 0.0
+            # Stages taking a few milliseconds vary more than that between runs
+            slowdown_ms = (measurements[metric] - old[metric]) * (1 if metric == 'p50_ms' else 1000)
+            flag = ''
+            if change > tolerance and slowdown_ms > MIN_REGRESSION_MS:
+                regressions.append(f'{run["minutes"]}/{name}')
+                flag = '  REGRESSION'
+            print(f'{run["minutes"]:>7}m {name:<14} {old[metric]:>10.3f} {measurements[metric]:>10.3f} '
+                  f'{change:>+8.1%}{flag}')
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=int, nargs='+', default=[1, 10, 60, 180],
+                        help='Lengths of the synthetic audio to benchmark')
+    parser.add_argument('--audio-dir', help='Directory to keep the synthetic audio in between runs, '
+                                            'a temporary directory by default')
+    parser.add_argument('--workers', type=int, default=4, help='Chunks recognized at once')
+    parser.add_argument('--recognizer-latency', type=float, default=0.3, help='Seconds per recognized chunk')
+    parser.add_argument('--embedding-latency', type=float, default=0.002, help='Seconds per embedded text')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='Seconds per LLM answer')
+    parser.add_argument('--questions', type=int, default=10, help='Questions asked per audio length')
+    parser.add_argument('--ffmpeg', help='Path to ffmpeg, defaults to the one the web app uses')
+    parser.add_argument('--ffprobe', help='Path to ffprobe, defaults to the one the web app uses')
+    parser.add_argument('--output', default='benchmark.json', help='Where to write the results')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Slowdown of a stage against the baseline that counts as a regression')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.ffmpeg:
+        AudioSegment.converter = AudioSegment.ffmpeg = args.ffmpeg
+    if args.ffprobe:
+        AudioSegment.ffprobe = args.ffprobe
+
+    result = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'config': {name: value for name, value in vars(args).items()
+                   if name not in ('output', 'baseline', 'tolerance', 'verbose', 'audio_dir', 'ffmpeg', 'ffprobe')},
+        'runs': [],
+    }
+
+    with tempfile.TemporaryDirectory() as temporary:
+        audio_dir = args.audio_dir or temporary
+        os.makedirs(audio_dir, exist_ok=True)
+        for minutes in args.minutes:
+            audio_path = os.path.join(audio_dir, f'synthetic-{minutes}m.wav')
+            if not os.path.exists(audio_path):
+                logging.info(f'Synthesizing {minutes} minutes of audio')
+                synthesize_speech(audio_path, minutes * 60)
+
+            logging.info(f'Benchmarking {minutes} minutes of audio')
+            result['runs'].append(benchmark_audio(audio_path, minutes, args))
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if regressions := compare(result, baseline, args.tolerance):
+            print(f'{len(regressions)} stages regressed by more than {args.tolerance:.0%}: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+from typing import Awaitable, Callable, Iterable, Iterator, TypeVar
+
+import asyncio
+
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def ordered_map(func: Callable[[T], R], items: Iterable[T], max_workers: int = 4) -> Iterator[R]:
+    """
+    Lazily maps func over items on a thread pool, keeping at most max_workers calls in flight.
+
+    Results are yielded in the same order as the input items, so consumers can render
+    progress exactly as they would for a serial loop.
+
+    Args:
+        func: The function to call for every item
+        items: An iterable of items, consumed only as workers free up
+        max_workers: Maximum number of concurrent calls. 1 runs serially in the calling thread.
+    Yields:
+        result: func(item) for every item, in input order
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight: deque[Future] = deque()
+    try:
+        for item in items:
+            in_flight.append(executor.submit(func, item))
+            if len(in_flight) >= max_workers:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        # Stop pending work if the consumer stops iterating early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _cancel_tasks() -> None:
+    """
+    Cancels every other task of the running loop and waits for them to finish
+    """
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def ordered_async_map(func: Callable[[T], Awaitable[R]], items: Iterable[T], max_pending: int = 4) -> Iterator[R]:
+    """
+    Lazily runs the coroutine function func over items on an event loop, keeping at most max_pending calls in flight.
+
+    Same contract as ordered_map, for IO bound work that is cheaper to run as coroutines than on threads.
+    The event loop runs on its own thread, so this can be consumed from synchronous code such as a Streamlit script.
+
+    Args:
+        func: The coroutine function to await for every item
+        items: An iterable of items, consumed only as calls complete
+        max_pending: Maximum number of concurrent calls
+    Yields:
+        result: The result of func(item) for every item, in input order
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    in_flight: deque[Future] = deque()
+    try:
+        for item in items:
+            in_flight.append(asyncio.run_coroutine_threadsafe(func(item), loop))
+            if len(in_flight) >= max_pending:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        # Stop pending work if the consumer stops iterating early
+        asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -7,6 +7,37 @@ class FileType(Enum):
     YOUTUBE = 2
 
 
+class ASREngine(str, Enum):
+    GOOGLE = "google"
+    WHISPER_API = "whisper-api"
+    LOCAL_WHISPER = "local-whisper"
+
+
+class RetrievalMode(str, Enum):
+    VECTOR = "vector"
+    BM25 = "bm25"
+    HYBRID = "hybrid"
+
+
+class IndexType(str, Enum):
+    FLAT = "flat"
+    HNSW = "hnsw"
+    IVF_PQ = "ivfpq"
+
+
+class EmbeddingRuntime(str, Enum):
+    TORCH = "torch"
+    ONNX = "onnx"
+
+
+class JobState(Enum):
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    CANCELLED = 4
+
+
 class Language(str, Enum):
     US_English = "en-US"
     IN_English = "en-IN"
@@ -0,0 +1,138 @@
+"""
+Accuracy regression check of the int8 ONNX embeddings against the full precision model
+
+Embeds the split documents of a transcript and questions about it with both the torch model the app uses
+by default and its int8 export, and compares what retrieval would return:
+    overlap      share of the k documents retrieved with the full precision model that are also retrieved
+                 with the int8 model, averaged over the questions
+    top1         share of questions whose best document is the same
+    float16      overlap when the int8 vectors are also stored as float16 in the index, as the app does
+    cosine       mean cosine similarity of the two vectors of each document
+It also reports the time each model took to embed the documents.
+
+Usage:
+    python -m utils.embedding_accuracy --transcript ingested/transcripts/talk.jsonl
+    python -m utils.embedding_accuracy --transcript talk.jsonl --model sentence-transformers/all-MiniLM-L6-v2
+
+The command fails if the overlap is below --min-overlap, so it can gate a new export.
+"""
+from typing import List, Tuple
+
+import argparse
+
+import json
+
+import logging
+
+import sys
+
+import time
+
+import numpy as np
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from query_handler.onnx_embeddings import OnnxEmbeddings, default_onnx_dir
+
+from utils.benchmark import current_rss
+from utils.retrieval_benchmark import make_questions, read_transcript
+
+
+def top_k(documents: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the k nearest documents of every query, nearest first, as an exact FAISS search returns them
+    """
+    # Squared L2 distances without the norms of the queries, which do not change the order
+    distances = (documents ** 2).sum(axis=1)[None, :] - 2 * queries @ documents.T
+    return np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+
+def overlap(expected: np.ndarray, found: np.ndarray) -> float:
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected, found)]))
+
+
+def embed(embeddings, texts: List[str], questions: List[str]) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Returns the document vectors, the query vectors and the seconds spent embedding the documents
+    """
+    start = time.perf_counter()
+    documents = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    seconds = time.perf_counter() - start
+    queries = np.array([embeddings.embed_query(question) for question in questions], dtype=np.float32)
+    return documents, queries, seconds
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transcript', required=True, help='Transcript written by the ingest command')
+    parser.add_argument('--model', default='hkunlp/instructor-xl', help='Name of the full precision model')
+    parser.add_argument('--onnx-model', help='Folder of its export, defaults to the one the app uses')
+    parser.add_argument('--questions', type=int, default=100, help='Questions asked about the transcript')
+    parser.add_argument('--k', type=int, default=3, help='Documents retrieved per question, 3 as in the app')
+    parser.add_argument('--threads', type=int, help='Threads of the ONNX session, defaults to one per core')
+    parser.add_argument('--min-overlap', type=float, default=0.9,
+                        help='Lowest overlap that passes the check')
+    parser.add_argument('--output', help='Where to write the results as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    docs = read_transcript(args.transcript)
+    # Split as the query handlers split
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
+    texts = [doc.page_content for doc in splitter.split_documents(docs)]
+    questions = [question for question, _ in make_questions(docs, args.questions, seed=0)]
+    logging.info(f'{len(texts)} documents, {len(questions)} questions')
+
+    rss = current_rss()
+    onnx_embeddings = OnnxEmbeddings(args.onnx_model or default_onnx_dir(args.model), intra_op_threads=args.threads)
+    onnx_rss = current_rss()
+    int8_documents, int8_queries, int8_seconds = embed(onnx_embeddings, texts, questions)
+    del onnx_embeddings
+
+    from langchain.embeddings import HuggingFaceEmbeddings, HuggingFaceInstructEmbeddings
+
+    embeddings_class = HuggingFaceInstructEmbeddings if 'instructor' in args.model else HuggingFaceEmbeddings
+    before = current_rss()
+    torch_embeddings = embeddings_class(model_name=args.model, model_kwargs={'device': 'cpu'})
+    torch_rss = current_rss()
+    documents, queries, seconds = embed(torch_embeddings, texts, questions)
+
+    expected = top_k(documents, queries, args.k)
+    found = top_k(int8_documents, int8_queries, args.k)
+    found_float16 = top_k(int8_documents.astype(np.float16).astype(np.float32), int8_queries, args.k)
+    result = {
+        'documents': len(texts),
+        'questions': len(questions),
+        'k': args.k,
+        'overlap': overlap(expected, found),
+        'top1': float(np.mean(expected[:, 0] == found[:, 0])),
+        'float16': overlap(expected, found_float16),
+        'cosine': float(np.mean((documents * int8_documents).sum(axis=1)
+                                / np.linalg.norm(documents, axis=1) / np.linalg.norm(int8_documents, axis=1))),
+        'torch_seconds': seconds,
+        'onnx_seconds': int8_seconds,
+        # Growth of the process when loading each model, None where memory cannot be read
+        'torch_load_mb': (torch_rss - before) / 2 ** 20 if rss is not None else None,
+        'onnx_load_mb': (onnx_rss - rss) / 2 ** 20 if rss is not None else None,
+    }
+
+    print(f'overlap@{args.k} {result["overlap"]:.3f}, top1 {result["top1"]:.3f}, '
+          f'float16 {result["float16"]:.3f}, cosine {result["cosine"]:.4f}')
+    print(f'embedding {len(texts)} documents: torch {seconds:.1f}s, onnx int8 {int8_seconds:.1f}s '
+          f'({seconds / int8_seconds:.1f}x)')
+    if rss is not None:
+        print(f'model memory: torch {result["torch_load_mb"]:.0f} MB, onnx int8 {result["onnx_load_mb"]:.0f} MB')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if result['overlap'] < args.min_overlap or result['float16'] < args.min_overlap:
+        print(f'Overlap is below {args.min_overlap}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,12 @@
 
 import logging
 from typing import Callable, Any, Union
-from openai.error import AuthenticationError, APIConnectionError
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a request is shed because the backend is already handling as many requests as it can
+    """
 
 
 def openai_error_handler(func: Callable, func_args: Any) -> dict[str, Union[str, bool]]:
@@ -15,6 +20,9 @@ def openai_error_handler(func: Callable, func_args: Any) -> dict[str, Union[str,
         result: dictionary containing the result or error as 'result' key's value and 
                 'error_message' is True or False depending on whether an error occured.
     """
+    # Imported here so that importing this module does not load openai
+    from openai.error import AuthenticationError, APIConnectionError
+
     error_occured = True
     try:
         result = func(func_args)
@@ -23,6 +31,8 @@ def openai_error_handler(func: Callable, func_args: Any) -> dict[str, Union[str,
         result = f':red[{e}]'
     except ConnectionError:
         result = ':red[Failed to Connect]'
+    except OverloadedError as e:
+        result = f':orange[{e}]'
     except ValueError as e:
         logging.exception(e)
         result = f':red[{e}]'
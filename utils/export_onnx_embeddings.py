@@ -0,0 +1,136 @@
+"""
+Exports a sentence-transformers or Instructor embedding model to ONNX with int8 weights, for OnnxEmbeddings
+
+The transformer is exported with torch and its weights quantized to int8 with onnxruntime's dynamic
+quantization. The pooling, dense and normalization layers that follow it are small and kept as numpy arrays.
+Exporting needs torch, sentence_transformers, InstructorEmbedding (for Instructor models), onnx and
+onnxruntime. Running the exported model needs only onnxruntime and tokenizers.
+
+Usage:
+    python -m utils.export_onnx_embeddings hkunlp/instructor-xl
+    python -m utils.export_onnx_embeddings sentence-transformers/all-MiniLM-L6-v2 --output models/minilm
+
+The folder defaults to the one HuggingFaceQueryHandler looks in. Check the exported model against the
+original with utils.embedding_accuracy before using it.
+"""
+import argparse
+
+import json
+
+import logging
+
+import os
+
+import shutil
+
+import sys
+
+import tempfile
+
+import numpy as np
+
+from query_handler.onnx_embeddings import CONFIG_FILE, HEAD_FILE, MODEL_FILE, TOKENIZER_FILE, default_onnx_dir
+
+
+def load_sentence_model(model_name: str):
+    """
+    Loads the model the query handlers embed with through langchain, on the CPU
+    """
+    if 'instructor' in model_name:
+        from InstructorEmbedding import INSTRUCTOR
+
+        return INSTRUCTOR(model_name, device='cpu')
+
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name, device='cpu')
+
+
+def export(model_name: str, folder: str, opset: int) -> None:
+    """
+    Writes the int8 ONNX transformer, the tokenizer, the layers after the transformer and their config to folder
+    """
+    import torch
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError:
+        raise ValueError(
+            "onnxruntime package not found, please install it with "
+            "`pip install onnxruntime onnx`"
+        )
+
+    model = load_sentence_model(model_name)
+    transformer, pooling = model[0], model[1]
+    encoder = transformer.auto_model.eval()
+
+    class Encoder(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, input_ids, attention_mask):
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    head = {}
+    config = {
+        'model_name': model_name,
+        'instructor': 'instructor' in model_name,
+        'max_seq_length': transformer.max_seq_length,
+        'pad_token_id': transformer.tokenizer.pad_token_id,
+        'pooling': 'cls' if pooling.pooling_mode_cls_token else 'mean',
+        'dense_activation': None,
+        'normalize': False,
+        'dimension': model.get_sentence_embedding_dimension(),
+    }
+    for module in list(model)[2:]:
+        name = type(module).__name__
+        if name == 'Dense':
+            head['weight'] = module.linear.weight.detach().numpy()
+            if module.linear.bias is not None:
+                head['bias'] = module.linear.bias.detach().numpy()
+            config['dense_activation'] = 'tanh' if isinstance(module.activation_function, torch.nn.Tanh) else None
+        elif name == 'Normalize':
+            config['normalize'] = True
+        else:
+            raise ValueError(f'Cannot export the {name} layer of {model_name}')
+
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.TemporaryDirectory() as temporary:
+        # Large models are written with their weights in external files, quantizing brings them under 2 GB
+        fp32_path = os.path.join(temporary, 'model.onnx')
+        dummy = transformer.tokenizer(['an example text'], return_tensors='pt')
+        logging.info(f'Exporting {model_name} to ONNX')
+        with torch.no_grad():
+            torch.onnx.export(Encoder(), (dummy['input_ids'], dummy['attention_mask']), fp32_path,
+                              input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                              dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                            'attention_mask': {0: 'batch', 1: 'sequence'},
+                                            'last_hidden_state': {0: 'batch', 1: 'sequence'}},
+                              opset_version=opset)
+
+        logging.info('Quantizing the weights to int8')
+        int8_path = os.path.join(temporary, MODEL_FILE)
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        shutil.move(int8_path, os.path.join(folder, MODEL_FILE))
+
+    transformer.tokenizer.backend_tokenizer.save(os.path.join(folder, TOKENIZER_FILE))
+    np.savez(os.path.join(folder, HEAD_FILE), **head)
+    with open(os.path.join(folder, CONFIG_FILE), 'w') as f:
+        json.dump(config, f, indent=2)
+    logging.info(f'Exported {model_name} to {folder}')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model', nargs='?', default='hkunlp/instructor-xl', help='Name of the model to export')
+    parser.add_argument('--output', help='Folder to write the model to')
+    parser.add_argument('--opset', type=int, default=14, help='ONNX opset version')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    export(args.model, args.output or default_onnx_dir(args.model), args.opset)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Fault injecting stand-in for the Google Speech Recognition API
+
+Answers recognition requests like the real service, while failing, slowing down or dropping a share
+of them, to see how the transcription pipeline copes with an unreliable service.
+
+Usage:
+    python -m utils.fake_speech_server --port 8099 --error-rate 0.1 --slow-rate 0.05 --slow-seconds 20
+
+Then point the parser at it:
+    SpeechRecognitionParser(endpoint='http://127.0.0.1:8099/speech-api/v2/recognize')
+"""
+from typing import Optional
+
+import argparse
+
+import json
+
+import logging
+
+import random
+
+import threading
+
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FaultInjection:
+    def __init__(self, error_rate: Optional[float] = 0.0,
+                 slow_rate: Optional[float] = 0.0,
+                 slow_seconds: Optional[float] = 20.0,
+                 latency: Optional[float] = 0.2,
+                 down: Optional[bool] = False,
+                 text: Optional[str] = 'hello world') -> None:
+        """
+        Faults injected by the stand-in server, can be changed while it is running
+
+        Args:
+            error_rate: Share of requests answered with a 500 error
+            slow_rate: Share of requests answered only after slow_seconds
+            slow_seconds: Delay of slow requests in seconds
+            latency: Delay of every other request in seconds
+            down: Answer every request with a 503 error, as during an outage
+            text: Transcript returned for every successful request
+        """
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.latency = latency
+        self.down = down
+        self.text = text
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+def make_handler(faults: FaultInjection) -> type:
+    class FakeSpeechHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with faults.lock:
+                faults.requests += 1
+
+            if faults.down:
+                self.send_error(503, 'Service Unavailable')
+                return
+            roll = random.random()
+            if roll < faults.error_rate:
+                self.send_error(500, 'Injected Error')
+                return
+            time.sleep(faults.slow_seconds if roll < faults.error_rate + faults.slow_rate else faults.latency)
+
+            result = {'result': [{'alternative': [{'transcript': faults.text, 'confidence': 0.9}],
+                                  'final': True}], 'result_index': 0}
+            body = ('{"result":[]}\n' + json.dumps(result) + '\n').encode()
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on a slow request
+                pass
+
+        def log_message(self, format: str, *args) -> None:
+            logging.debug(format % args)
+
+    return FakeSpeechHandler
+
+
+def serve(faults: FaultInjection, host: Optional[str] = '127.0.0.1', port: Optional[int] = 0) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in server on a background thread
+
+    Args:
+        faults: Faults to inject
+        host: Address to listen on
+        port: Port to listen on, 0 picks a free one
+    Returns:
+        server: The running server, its endpoint is at /speech-api/v2/recognize on server.server_address
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(faults))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with a 500')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Share of requests answered late')
+    parser.add_argument('--slow-seconds', type=float, default=20.0, help='Delay of late requests')
+    parser.add_argument('--latency', type=float, default=0.2, help='Delay of every other request')
+    parser.add_argument('--down', action='store_true', help='Fail every request with a 503')
+    args = parser.parse_args()
+
+    faults = FaultInjection(args.error_rate, args.slow_rate, args.slow_seconds, args.latency, args.down)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(faults))
+    print(f'Listening on http://{args.host}:{args.port}/speech-api/v2/recognize')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Import time budget check
+
+Runs `python -X importtime` on the given modules in a fresh interpreter and fails if importing them
+takes longer than the budget or pulls in a forbidden module such as torch.
+
+Usage:
+    python -m utils.import_time speech_tools.transcriber query_handler.openai_query_handler --budget 3 --forbid torch
+"""
+from typing import Dict, List, Tuple
+
+import argparse
+
+import subprocess
+
+import sys
+
+
+def measure_imports(modules: List[str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Imports modules in a fresh interpreter and returns the import time of every module that got loaded
+
+    Args:
+        modules: Names of the modules to import
+    Returns:
+        times: Mapping of module name to (self, cumulative) import time in microseconds
+    """
+    code = '; '.join(f'import {module}' for module in modules)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True).stderr
+
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='+', help='Modules to import')
+    parser.add_argument('--budget', type=float, default=3.0,
+                        help='Maximum total import time in seconds')
+    parser.add_argument('--forbid', action='append', default=[],
+                        help='Module that must not be imported, can be given several times')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of slowest modules to report')
+    args = parser.parse_args()
+
+    times = measure_imports(args.modules)
+    total = sum(self_us for self_us, _ in times.values()) / 1e6
+
+    print(f'Imported {len(times)} modules in {total:.2f}s (budget {args.budget:.2f}s)')
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:args.top]
+    for name, (_, cumulative_us) in slowest:
+        print(f'{cumulative_us / 1e6:8.3f}s  {name}')
+
+    failed = False
+    for module in args.forbid:
+        if any(name == module or name.startswith(module + '.') for name in times):
+            print(f'FAIL: {module} was imported')
+            failed = True
+    if total > args.budget:
+        print(f'FAIL: import time {total:.2f}s is over the budget of {args.budget:.2f}s')
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
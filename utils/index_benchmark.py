@@ -0,0 +1,170 @@
+"""
+Benchmark of the FAISS index types the query handlers choose by transcript length
+
+For every corpus size it builds a flat, an HNSW and an IVF-PQ index over the same vectors and reports, against
+the exact results of the flat index:
+    build      seconds to build the index, training included, on all cores unless --threads is given
+    recall     share of the k exact nearest documents found, averaged over the queries
+    latency    per query search latency, as the retriever of a chain searches one question at a time
+    size       approximate memory of the index
+HNSW is measured for every --ef-search and IVF-PQ for every --nprobe, to pick the search parameters
+(FAISS_EF_SEARCH and FAISS_NPROBE of the app).
+
+Vectors are synthetic clusters of unit vectors, like embeddings of a long recording revisiting a few topics,
+or read from a .npy file of real embeddings with --vectors. Queries are perturbed held out vectors.
+
+Usage:
+    python -m utils.index_benchmark --sizes 1000 10000 50000 --output index_benchmark.json
+    python -m utils.index_benchmark --vectors embeddings.npy --ef-search 32 64 128 --nprobe 8 16 32
+"""
+from typing import List, Optional
+
+import argparse
+
+import json
+
+import logging
+
+import os
+
+import platform
+
+import sys
+
+import time
+
+import numpy as np
+
+from query_handler.faiss_index import IndexOptions, build_index, faiss_index_nbytes
+
+from utils.benchmark import latency_summary
+from utils.constants import IndexType
+
+
+def synthetic_vectors(count: int, dimension: int, seed: Optional[int] = 0) -> np.ndarray:
+    """
+    Unit vectors scattered around one cluster center per hundred vectors
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 100), dimension)).astype(np.float32)
+    vectors = centers[rng.integers(len(centers), size=count)] + 0.6 * rng.standard_normal(
+        (count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: Optional[int] = 1) -> np.ndarray:
+    """
+    Queries near random vectors of the corpus, as questions are near the passages that answer them
+    """
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(len(vectors), size=count)] + 0.3 * rng.standard_normal(
+        (count, vectors.shape[1])).astype(np.float32) / np.sqrt(vectors.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def search(index, queries: np.ndarray, k: int) -> dict:
+    """
+    Searches one query at a time and returns the results with the latencies
+    """
+    found = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        found.append(ids[0])
+    return {'ids': np.array(found), **latency_summary(latencies)}
+
+
+def recall(expected: np.ndarray, found: np.ndarray) -> float:
+    return float(np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(expected, found)]))
+
+
+def benchmark_size(vectors: np.ndarray, queries: np.ndarray, args: argparse.Namespace) -> List[dict]:
+    """
+    Builds every index type over vectors and measures it against the flat index
+    """
+    import faiss
+
+    rows = []
+    exact = None
+    for index_type in IndexType:
+        options = IndexOptions(k=args.k, threads=args.threads)
+        start = time.perf_counter()
+        index = build_index(vectors, index_type, options, float16=args.float16)
+        build_seconds = time.perf_counter() - start
+        # Searches are timed on one thread, as concurrent sessions each search on their own
+        faiss.omp_set_num_threads(1)
+
+        if index_type == IndexType.HNSW:
+            settings = [('ef_search', value) for value in args.ef_search]
+        elif index_type == IndexType.IVF_PQ:
+            settings = [('nprobe', value) for value in args.nprobe]
+        else:
+            settings = [(None, None)]
+
+        for name, value in settings:
+            if name == 'ef_search':
+                index.hnsw.efSearch = value
+            elif name == 'nprobe':
+                faiss.extract_index_ivf(index).nprobe = value
+            result = search(index, queries, args.k)
+            if exact is None:
+                exact = result['ids']
+            row = {'vectors': len(vectors), 'type': index_type.value, 'parameter': name, 'value': value,
+                   'build_seconds': build_seconds, 'recall': recall(exact, result['ids']),
+                   'size_mb': faiss_index_nbytes(index) / 2 ** 20,
+                   **{key: result[key] for key in ('p50_ms', 'p95_ms', 'max_ms')}}
+            rows.append(row)
+            setting = f'{name}={value}' if name else ''
+            print(f'{len(vectors):>8} {index_type.value:<6} {setting:<14} {build_seconds:>8.2f} {row["recall"]:>7.3f} '
+                  f'{row["p50_ms"]:>8.3f} {row["p95_ms"]:>8.3f} {row["size_mb"]:>8.1f}')
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='Numbers of vectors to index, prefixes of --vectors if given')
+    parser.add_argument('--vectors', help='.npy file of embeddings to index instead of synthetic vectors')
+    parser.add_argument('--dimension', type=int, default=768, help='Dimension of synthetic vectors, '
+                                                                   '768 as instructor-xl')
+    parser.add_argument('--queries', type=int, default=200, help='Queries per size')
+    parser.add_argument('--k', type=int, default=3, help='Documents retrieved per query, 3 as in the app')
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--float16', action='store_true', help='Store full vectors as float16, as the ONNX '
+                                                               'embedding runtime does')
+    parser.add_argument('--threads', type=int, help='Threads building the indexes, defaults to one per core')
+    parser.add_argument('--output', default='index_benchmark.json', help='Where to write the results')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.vectors:
+        corpus = np.load(args.vectors).astype(np.float32)
+    else:
+        corpus = synthetic_vectors(max(args.sizes), args.dimension)
+
+    result = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'config': {name: value for name, value in vars(args).items() if name != 'output'},
+        'rows': [],
+    }
+
+    print(f'{"vectors":>8} {"type":<6} {"parameter":<14} {"build s":>8} {"recall":>7} {"p50 ms":>8} '
+          f'{"p95 ms":>8} {"size MB":>8}')
+    for size in args.sizes:
+        vectors = corpus[:size]
+        result['rows'] += benchmark_size(vectors, make_queries(vectors, args.queries), args)
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
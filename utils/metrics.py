@@ -0,0 +1,305 @@
+"""
+Counters, histograms and timing spans of the pipeline stages, rendered in the Prometheus text format
+
+Stages are timed with span, which feeds the stage_duration_seconds histogram. Metrics are served on
+http://127.0.0.1:<METRICS_PORT>/metrics if the METRICS_PORT environment variable is set, and written to the
+file named by METRICS_FILE every few seconds if that is set.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import logging
+
+import os
+
+import random
+
+import threading
+
+import time
+
+from contextlib import contextmanager
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PREFIX = 'chat_with_audio_'
+# Seconds, from a fast retrieval to recognizing a long chunk or building the index of a long transcript
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+T = TypeVar('T')
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str) -> None:
+        """
+        Monotonically increasing count, one value per combination of labels
+        """
+        self.name = name
+        self.help = help
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: Optional[float] = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(dict(key))} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Optional[Iterable[float]] = DEFAULT_BUCKETS) -> None:
+        """
+        Distribution of observed values in cumulative buckets, one per combination of labels
+
+        Args:
+            name: Name of the metric
+            help: Description of the metric
+            buckets: Upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # Per label combination: count per bucket, then the sum and count of all observations
+        self.values: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                labels = dict(key)
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels({**labels, "le": str(bound)})} {count}')
+                lines.append(f'{self.name}_bucket{format_labels({**labels, "le": "+Inf"})} {counts[-1]}')
+                lines.append(f'{self.name}_sum{format_labels(labels)} {counts[-2]}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {counts[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        """
+        The metrics of the process, and collectors reporting the state of caches and queues as gauges
+        """
+        self.metrics: Dict[str, object] = {}
+        self.collectors: Dict[str, Tuple[str, Callable[[], Dict[str, float]]]] = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, help: str) -> Counter:
+        """
+        Returns the counter of that name, made on first use
+        """
+        with self.lock:
+            if (metric := self.metrics.get(PREFIX + name)) is None:
+                metric = self.metrics[PREFIX + name] = Counter(PREFIX + name, help)
+            return metric
+
+    def histogram(self, name: str, help: str, buckets: Optional[Iterable[float]] = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Returns the histogram of that name, made on first use
+        """
+        with self.lock:
+            if (metric := self.metrics.get(PREFIX + name)) is None:
+                metric = self.metrics[PREFIX + name] = Histogram(PREFIX + name, help, buckets)
+            return metric
+
+    def register_collector(self, name: str, help: str, collect: Callable[[], Dict[str, float]]) -> None:
+        """
+        Reports the values returned by collect as gauges named <name>_<key> on every render
+
+        Registering the same name again replaces the previous collector.
+        """
+        with self.lock:
+            self.collectors[name] = (help, collect)
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors.items())
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for name, (help, collect) in collectors:
+            try:
+                values = collect()
+            except Exception:
+                logging.exception(f'Could not collect {name} metrics')
+                continue
+            for key, value in values.items():
+                gauge = f'{PREFIX}{name}_{key}'
+                lines += [f'# HELP {gauge} {help}', f'# TYPE {gauge} gauge', f'{gauge} {float(value)}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """
+        Writes all metrics to a file, e.g. for the textfile collector of the Prometheus node exporter
+        """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """
+    Returns the metrics registry shared by the process
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+        return _registry
+
+
+def observe_stage(stage: str, seconds: float, **labels: str) -> None:
+    """
+    Records the duration of one run of a pipeline stage
+    """
+    get_metrics().histogram(
+        'stage_duration_seconds', 'Duration of pipeline stages in seconds').observe(seconds, stage=stage, **labels)
+
+
+@contextmanager
+def span(stage: str, **labels: str):
+    """
+    Times the code run in the block as one run of a pipeline stage
+
+    Failed runs are timed too, and counted in stage_errors_total.
+
+    Args:
+        stage: Name of the stage, e.g. decode, recognition or embed
+        labels: Further labels, e.g. the engine or backend
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            get_metrics().counter('stage_errors_total', 'Failed runs of pipeline stages').inc(stage=stage, **labels)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, **labels)
+
+
+def timed_iter(items: Iterable[T], stage: str, **labels: str) -> Iterator[T]:
+    """
+    Yields the items of an iterator, timing how long producing each of them took as one run of a stage
+
+    Used for lazily decoded audio, where the work happens while the consumer asks for the next item.
+    """
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe_stage(stage, time.perf_counter() - start, **labels)
+        yield item
+
+
+def log_transcript(message: Callable[[], str]) -> None:
+    """
+    Logs transcribed text at DEBUG level for a share of the calls given by the TRANSCRIPT_LOG_RATE environment
+    variable, between 0 and 1. Off by default, so transcripts cost no I/O per chunk.
+
+    Args:
+        message: Returns the message to log, only called if it is logged
+    """
+    rate = float(os.environ.get('TRANSCRIPT_LOG_RATE', 0))
+    if rate > 0 and random.random() < rate and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(message())
+
+
+def make_handler(registry: MetricsRegistry) -> type:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return MetricsHandler
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters() -> None:
+    """
+    Starts serving metrics on METRICS_PORT and writing them to METRICS_FILE, for those of the environment
+    variables that are set. Only the first call in a process starts anything, so it can be called on every
+    rerun of the Streamlit script.
+    """
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+
+    registry = get_metrics()
+    if port := os.environ.get('METRICS_PORT'):
+        host = os.environ.get('METRICS_HOST', '127.0.0.1')
+        try:
+            server = ThreadingHTTPServer((host, int(port)), make_handler(registry))
+        except OSError as e:
+            # Another process of the app serves metrics on this port already
+            logging.warning(f'Could not serve metrics on {host}:{port}: {e}')
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+            logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    if path := os.environ.get('METRICS_FILE'):
+        interval = float(os.environ.get('METRICS_FILE_INTERVAL', 15))
+
+        def write_periodically() -> None:
+            while True:
+                try:
+                    registry.write(path)
+                except OSError:
+                    logging.exception(f'Could not write metrics to {path}')
+                time.sleep(interval)
+
+        threading.Thread(target=write_periodically, daemon=True, name='metrics-writer').start()
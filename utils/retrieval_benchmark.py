@@ -0,0 +1,208 @@
+"""
+Benchmark of the retrieval modes of the query handlers: vector (FAISS), bm25 and hybrid
+
+Every mode indexes the same transcript and answers the same questions in a process of its own, so the
+resident memory of a mode counts the models it loads and nothing else. For every mode it records:
+    load       constructing the query handler, which loads the embedding model unless the mode is bm25
+    build      load_text building the index of the transcript, with an empty embedding cache
+    retrieval  per question latency of the retriever the retrieval chain uses
+    hit_rate   share of questions whose source passage is among the k retrieved documents
+    index_mb   approximate size of the index in memory
+
+Questions are phrases taken from the transcript, so each one has a known source passage.
+
+Usage:
+    python -m utils.retrieval_benchmark --minutes 60 --output retrieval.json
+    python -m utils.retrieval_benchmark --transcript ingested/transcripts/talk.jsonl --modes bm25 vector
+    python -m utils.retrieval_benchmark --backend stub --minutes 10 180
+
+The huggingface backend uses the models of the free tier of the app, instructor-xl for the vector mode. The
+stub backend replaces the embedding model with the stub of utils.benchmark, its hit rates are meaningless.
+"""
+from typing import List, Tuple
+
+import argparse
+
+import json
+
+import logging
+
+import os
+
+import platform
+
+import sys
+
+import tempfile
+
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import multiprocessing
+
+import numpy as np
+
+from langchain.schema import Document
+
+from query_handler.cached_embeddings import EmbeddingStore
+from query_handler.index_store import IndexStore
+from query_handler.sessions import index_nbytes
+
+from utils.benchmark import WORDS_PER_MINUTE, BenchmarkQueryHandler, current_rss, latency_summary, stage, stub_words
+from utils.constants import EmbeddingRuntime, RetrievalMode
+
+
+SESSION_ID = 'retrieval-benchmark'
+# Seconds of speech per transcribed document, about what the parsers produce
+CHUNK_SECONDS = 30
+QUESTION_WORDS = 5
+
+
+def synthetic_transcript(minutes: int) -> List[Document]:
+    """
+    Transcript of pseudo random words at a speaking rate, the same length always gives the same text
+    """
+    words = CHUNK_SECONDS * WORDS_PER_MINUTE // 60
+    return [Document(page_content=stub_words(f'{minutes}:{i}'.encode(), words),
+                     metadata={'chunk': i, 'start_time': i * CHUNK_SECONDS * 1000})
+            for i in range(minutes * 60 // CHUNK_SECONDS)]
+
+
+def read_transcript(path: str) -> List[Document]:
+    """
+    Reads a transcript written by the ingest command
+    """
+    docs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            chunk = json.loads(line)
+            if chunk['text']:
+                docs.append(Document(page_content=chunk['text'],
+                                     metadata={'chunk': chunk['chunk'], 'start_time': chunk['start_time']}))
+    return docs
+
+
+def make_questions(docs: List[Document], count: int, seed: int) -> List[Tuple[str, str]]:
+    """
+    Returns questions about phrases of random documents, with the phrase each answer has to contain
+    """
+    rng = np.random.default_rng(seed)
+    questions = []
+    for _ in range(count):
+        words = docs[rng.integers(len(docs))].page_content.split()
+        start = rng.integers(max(1, len(words) - QUESTION_WORDS))
+        phrase = ' '.join(words[start:start + QUESTION_WORDS])
+        questions.append((f'What is said about {phrase}?', phrase))
+    return questions
+
+
+def benchmark_mode(mode: RetrievalMode, docs: List[Document], questions: List[Tuple[str, str]],
+                   args: argparse.Namespace) -> dict:
+    """
+    Builds and queries the index of one retrieval mode. Runs in a process of its own.
+    """
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    results = {}
+    rss = current_rss()
+    start_rss_mb = rss / 2 ** 20 if rss is not None else None
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with stage(results, 'load'):
+            if args.backend == 'stub':
+                handler = BenchmarkQueryHandler(cache_dir, args.embedding_latency, 0, retrieval_mode=mode)
+            else:
+                from query_handler.huggingface_query_handler import HuggingFaceQueryHandler
+                handler = HuggingFaceQueryHandler(with_llm=False, retrieval_mode=mode,
+                                                  embedding_runtime=EmbeddingRuntime(args.embedding_runtime))
+
+        # Nothing built or embedded by earlier runs is reused
+        handler.index_store = IndexStore(os.path.join(cache_dir, 'indexes'))
+        if handler.embeddings is not None:
+            handler.embeddings.store = EmbeddingStore(os.path.join(cache_dir, 'embeddings.sqlite3'))
+
+        with stage(results, 'build'):
+            handler.load_text(docs, SESSION_ID)
+        db = handler.sessions.get(SESSION_ID, handler.new_memory).db
+        results['build']['index_mb'] = index_nbytes(db) / 2 ** 20
+
+        retriever = db.as_retriever(search_kwargs={'k': args.k})
+        with stage(results, 'retrieval') as result:
+            latencies = []
+            hits = 0
+            for question, phrase in questions:
+                start = time.perf_counter()
+                found = retriever.get_relevant_documents(question)
+                latencies.append(time.perf_counter() - start)
+                hits += any(phrase in doc.page_content for doc in found)
+            result.update(latency_summary(latencies))
+            result['hit_rate'] = hits / len(questions)
+
+    return {'mode': mode.value, 'model': handler.index_model_name, 'start_rss_mb': start_rss_mb,
+            'peak_rss_mb': max(result['peak_rss_mb'] or 0 for result in results.values()), 'stages': results}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=[mode.value for mode in RetrievalMode],
+                        choices=[mode.value for mode in RetrievalMode])
+    parser.add_argument('--backend', default='huggingface', choices=['huggingface', 'stub'])
+    parser.add_argument('--embedding-runtime', default=EmbeddingRuntime.TORCH.value,
+                        choices=[runtime.value for runtime in EmbeddingRuntime],
+                        help='Runtime of the huggingface embeddings')
+    parser.add_argument('--minutes', type=int, nargs='+', default=[60],
+                        help='Lengths of the synthetic transcripts to benchmark')
+    parser.add_argument('--transcript', help='Transcript written by the ingest command, used instead of '
+                                             'synthetic transcripts')
+    parser.add_argument('--questions', type=int, default=50, help='Questions asked per transcript')
+    parser.add_argument('--k', type=int, default=3, help='Documents retrieved per question, 3 as in the app')
+    parser.add_argument('--embedding-latency', type=float, default=0.002,
+                        help='Seconds per embedded text of the stub backend')
+    parser.add_argument('--output', default='retrieval_benchmark.json', help='Where to write the results')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.transcript:
+        transcripts = [(os.path.basename(args.transcript), read_transcript(args.transcript))]
+    else:
+        transcripts = [(f'{minutes}m', synthetic_transcript(minutes)) for minutes in args.minutes]
+
+    result = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'verbose')},
+        'runs': [],
+    }
+
+    print(f'{"transcript":<12} {"mode":<8} {"load s":>8} {"build s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"hits":>6} {"index MB":>9} {"RSS MB":>8}')
+    for name, docs in transcripts:
+        questions = make_questions(docs, args.questions, seed=0)
+        for mode in args.modes:
+            logging.info(f'Benchmarking {mode} retrieval on the {name} transcript')
+            # A fresh process per mode, so memory and models of one mode do not count for the next
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                run = executor.submit(benchmark_mode, RetrievalMode(mode), docs, questions, args).result()
+            run['transcript'] = name
+            run['documents'] = len(docs)
+            result['runs'].append(run)
+
+            stages = run['stages']
+            print(f'{name:<12} {mode:<8} {stages["load"]["seconds"]:>8.2f} {stages["build"]["seconds"]:>8.2f} '
+                  f'{stages["retrieval"]["p50_ms"]:>8.2f} {stages["retrieval"]["p95_ms"]:>8.2f} '
+                  f'{stages["retrieval"]["hit_rate"]:>6.0%} {stages["build"]["index_mb"]:>9.2f} '
+                  f'{run["peak_rss_mb"]:>8.0f}')
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())